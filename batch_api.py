@@ -0,0 +1,294 @@
+import os
+import sys
+import glob
+import json
+import time
+import logging
+import argparse
+
+import requests
+from tqdm import tqdm
+
+import vision_common
+import batch_planner
+import manifest as job_manifest
+import metrics
+import hedging
+import log_setup
+import page_classifier
+import dedup
+
+ENDPOINT = '/v1/chat/completions'
+COMPLETION_WINDOW = '24h'
+# Requests files, results and the job list live here, apart from the batch files
+WORK_DIR_NAME = '.batch_api'
+JOBS_FILE_NAME = 'jobs.json'
+# The Batch API takes up to 50,000 requests and 200MB per input file
+MAX_REQUESTS_PER_FILE = 50000
+MAX_FILE_BYTES = 190 * 1024 * 1024
+FINAL_STATUSES = ('completed', 'failed', 'expired', 'cancelled')
+
+
+class BatchClient:
+    # The Files and Batches endpoints, over one keep-alive session
+
+    def __init__(self, api_key, base_url=None):
+        self.base_url = base_url or vision_common.API_BASE_URL
+        self.session = requests.Session()
+        self.session.headers['Authorization'] = f"Bearer {api_key}"
+
+    def request(self, method, path, **kwargs):
+        # A stalled connection fails the call rather than hanging the run
+        kwargs.setdefault('timeout', hedging.get_hedger().timeout)
+        response = self.session.request(method, self.base_url + path, **kwargs)
+        response.raise_for_status()
+        return response
+
+    def upload(self, jsonl_path):
+        with open(jsonl_path, 'rb') as jsonl_file:
+            files = {'file': (os.path.basename(jsonl_path), jsonl_file, 'application/jsonl')}
+            return self.request('POST', '/files', data={'purpose': 'batch'}, files=files).json()['id']
+
+    def create(self, input_file_id, metadata=None):
+        return self.request('POST', '/batches', json={
+            'input_file_id': input_file_id, 'endpoint': ENDPOINT,
+            'completion_window': COMPLETION_WINDOW, 'metadata': metadata}).json()
+
+    def retrieve(self, batch_id):
+        return self.request('GET', f"/batches/{batch_id}").json()
+
+    def download(self, file_id, path):
+        # Results can be large, so they go straight to disk
+        with self.request('GET', f"/files/{file_id}/content", stream=True) as response, \
+                open(path, 'wb') as result_file:
+            for chunk in response.iter_content(chunk_size=1024 * 1024):
+                result_file.write(chunk)
+        return path
+
+
+class JobList:
+    # Batch jobs that were submitted but not yet collected. Saved after every
+    # change, so a run interrupted while waiting can pick its results up with
+    # --resume instead of paying for the same requests again.
+
+    def __init__(self, path):
+        self.path = path
+        self.jobs = []
+        if os.path.exists(path):
+            with open(path, 'r') as jobs_file:
+                self.jobs = json.load(jobs_file)['jobs']
+
+    def save(self):
+        job_manifest.write_json_atomic(self.path, {'jobs': self.jobs})
+
+    def add(self, job):
+        self.jobs.append(job)
+        self.save()
+
+    def remove(self, job):
+        self.jobs = [entry for entry in self.jobs if entry['id'] != job['id']]
+        self.save()
+
+    def clear(self):
+        if self.jobs:
+            logging.warning(f"Abandoning {len(self.jobs)} uncollected batch jobs, pass --resume to collect them")
+        self.jobs = []
+        self.save()
+
+    def covering(self, batch_numbers):
+        # Jobs already submitted for any of these batches
+        return [job for job in self.jobs if set(job['batches']) & set(batch_numbers)]
+
+
+def custom_id(batch_number):
+    return f"batch-{batch_number}"
+
+
+def batch_number_of(request_id):
+    return int(request_id.rsplit('-', 1)[1])
+
+
+def write_requests(batches, prompt, work_dir, model=vision_common.MODEL,
+                   max_tokens=vision_common.MAX_TOKENS, max_requests=MAX_REQUESTS_PER_FILE,
+                   max_bytes=MAX_FILE_BYTES):
+    # Writes one JSONL line per batch, splitting across files at the API's
+    # limits. Each request body is streamed from the images, as for a live
+    # request. Returns (path, batch_numbers) for every file written.
+    files = []
+    jsonl_file = None
+    for batch_number, image_paths in batches:
+        payload = vision_common.StreamingPayload(image_paths, prompt, model, max_tokens)
+        head = (json.dumps({'custom_id': custom_id(batch_number), 'method': 'POST',
+                            'url': ENDPOINT})[:-1] + ', "body": ').encode('utf-8')
+        line_bytes = len(head) + len(payload) + 2
+        if jsonl_file is not None and (len(files[-1][1]) >= max_requests or
+                                       jsonl_file.tell() + line_bytes > max_bytes):
+            jsonl_file.close()
+            jsonl_file = None
+        if jsonl_file is None:
+            path = os.path.join(work_dir, f"requests_{batch_number}.jsonl")
+            jsonl_file = open(path, 'wb')
+            files.append((path, []))
+        jsonl_file.write(head)
+        for chunk in payload:
+            jsonl_file.write(chunk)
+        jsonl_file.write(b'}\n')
+        files[-1][1].append(batch_number)
+    if jsonl_file is not None:
+        jsonl_file.close()
+    return files
+
+
+def submit(client, job_list, batches, prompt, work_dir, mode, max_requests=MAX_REQUESTS_PER_FILE,
+           max_bytes=MAX_FILE_BYTES):
+    jobs = []
+    for path, batch_numbers in write_requests(batches, prompt, work_dir,
+                                              max_requests=max_requests, max_bytes=max_bytes):
+        file_id = client.upload(path)
+        batch = client.create(file_id, {'description': f"{mode} batches {batch_numbers[0]}-{batch_numbers[-1]}"})
+        job = {'id': batch['id'], 'input_file_id': file_id, 'requests_file': path,
+               'batches': batch_numbers, 'submitted_at': time.time()}
+        job_list.add(job)
+        jobs.append(job)
+        logging.info(f"Submitted batch job {batch['id']} with {len(batch_numbers)} requests")
+    return jobs
+
+
+def wait(client, job, poll_interval):
+    # Polls until the job reaches a final status, and returns the batch object
+    status = None
+    while True:
+        batch = client.retrieve(job['id'])
+        if batch['status'] != status:
+            status = batch['status']
+            logging.info(f"Batch job {job['id']} is {status}: {batch.get('request_counts')}")
+        if status in FINAL_STATUSES:
+            return batch
+        time.sleep(poll_interval)
+
+
+def collect(client, batch, work_dir):
+    # Returns {batch_number: chat completion} for every request that
+    # succeeded. An expired or cancelled job can still have partial output.
+    results = {}
+    for key in ('output_file_id', 'error_file_id'):
+        file_id = batch.get(key)
+        if not file_id:
+            continue
+        path = client.download(file_id, os.path.join(work_dir, f"{batch['id']}_{key[:-8]}.jsonl"))
+        with open(path, 'r') as result_file:
+            for line in result_file:
+                if not line.strip():
+                    continue
+                entry = json.loads(line)
+                batch_number = batch_number_of(entry['custom_id'])
+                response = entry.get('response') or {}
+                if response.get('status_code') == 200:
+                    results[batch_number] = response['body']
+                else:
+                    logging.error(
+                        f"Batch {batch_number} failed in job {batch['id']}: {entry.get('error') or response.get('body')}")
+    return results
+
+
+def run(folder_path, api_key, output_directory, mode='ndl', planner=None, manifest=None,
+        resume=False, retry_failed=False, poll_interval=30, max_requests=MAX_REQUESTS_PER_FILE,
+        max_bytes=MAX_FILE_BYTES, deduplicator=None, classifier=None):
+    # Submits every batch at once as Batch API jobs, waits for them, and
+    # writes each result as output_batch_N.json. Truncated batches are split
+    # by the planner and sent again in a further round.
+    logging.info(f"Searching for image files in {folder_path}...")
+    image_files = glob.glob(os.path.join(folder_path, '*.jpg'))
+    image_files.sort()
+    if classifier is not None:
+        image_files = classifier.filter(image_files, mode)
+        classifier.write_report(output_directory)
+    if deduplicator is not None:
+        image_files = deduplicator.filter(image_files)
+
+    if not image_files and not (resume or retry_failed):
+        logging.error("No JPG files found in the specified directory.")
+        return []
+
+    prompt = vision_common.PROMPTS[mode]
+    if planner is None:
+        planner = batch_planner.BatchPlanner(prompt)
+    work_dir = os.path.join(output_directory, WORK_DIR_NAME)
+    os.makedirs(work_dir, exist_ok=True)
+    client = BatchClient(api_key)
+    job_list = JobList(os.path.join(work_dir, JOBS_FILE_NAME))
+    if not resume:
+        job_list.clear()
+
+    queue = batch_planner.BatchQueue(planner, output_directory, image_files, manifest,
+                                     resume, retry_failed)
+    results = []
+    with tqdm(total=queue.total_pages, desc="Processing Pages") as progress:
+        while queue:
+            started = time.monotonic()
+            batches = {}
+            while queue:
+                batch_number, batch = queue.take()
+                batches[batch_number] = batch
+
+            # After an interrupted run, wait on the jobs it already submitted
+            jobs = job_list.covering(batches)
+            submitted = {batch_number for job in jobs for batch_number in job['batches']}
+            jobs += submit(client, job_list, [(n, b) for n, b in batches.items() if n not in submitted],
+                           prompt, work_dir, mode, max_requests, max_bytes)
+
+            responses = {}
+            for job in jobs:
+                responses.update(collect(client, wait(client, job, poll_interval), work_dir))
+                job_list.remove(job)
+
+            for batch_number, batch in batches.items():
+                data = responses.get(batch_number)
+                if data is not None:
+                    vision_common.write_batch_output(data, output_directory, batch_number, mode)
+                log_setup.log_batch(batch_number, batch, started, data)
+                progress.update(queue.finish(batch_number, batch, data))
+                results.append(data)
+
+    if deduplicator is not None:
+        deduplicator.fan_out(output_directory, manifest)
+    if manifest is not None:
+        logging.info(f"Manifest status: {manifest.counts()}")
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Send a whole survey through the Batch API and split the results into batch files")
+    parser.add_argument("folder_path")
+    parser.add_argument("output_directory")
+    parser.add_argument("--mode", choices=sorted(vision_common.PROMPTS), default="ndl")
+    parser.add_argument("--poll-interval", type=float, default=30,
+                        help="seconds between job status checks")
+    job_manifest.add_arguments(parser)
+    page_classifier.add_arguments(parser)
+    dedup.add_arguments(parser)
+    batch_planner.add_arguments(parser)
+    metrics.add_arguments(parser)
+    log_setup.add_arguments(parser, 'batch_api.log')
+    args = parser.parse_args()
+    log_setup.from_args(args)
+    metrics.from_args(args)
+
+    api_key = os.getenv('OPENAI_API_KEY')
+    if not api_key:
+        logging.error("OPENAI_API_KEY not set.")
+        sys.exit(1)
+
+    logging.info("Starting the batch submission...")
+    os.makedirs(args.output_directory, exist_ok=True)
+    manifest = job_manifest.from_args(args, args.output_directory)
+    run(args.folder_path, api_key, args.output_directory, args.mode,
+        batch_planner.from_args(args, vision_common.PROMPTS[args.mode]), manifest,
+        args.resume, args.retry_failed, args.poll_interval,
+        deduplicator=dedup.from_args(args), classifier=page_classifier.from_args(args))
+    metrics.write_summary(metrics.summary_path(args, args.output_directory), mode=args.mode,
+                          api='batch')
+    logging.info("Script finished")
+
+# To run this script, type 'python3 batch_api.py PATH/TO/INPUT/FOLDER PATH/TO/OUTPUT/FOLDER --mode ndl' in the terminal
@@ -0,0 +1,222 @@
+import os
+import asyncio
+import logging
+from collections import deque
+
+from PIL import Image
+from tqdm import tqdm
+
+import vision_common
+import manifest as job_manifest
+import metrics
+
+
+class BatchPlanner:
+    # Packs pages into requests by estimated cost instead of a fixed count.
+    # A batch stops growing when its image tokens would pass the per-request
+    # token budget, or when its expected output would no longer fit in
+    # max_tokens. The output estimate per page is learned from the usage and
+    # finish_reason of each response.
+
+    def __init__(self, prompt, token_budget=8000, max_tokens=vision_common.MAX_TOKENS,
+                 output_tokens_per_page=300, max_pages=10, output_headroom=0.8):
+        self.prompt_tokens = len(prompt) // 4
+        self.token_budget = token_budget
+        self.max_tokens = max_tokens
+        self.output_tokens_per_page = output_tokens_per_page
+        self.max_pages = max_pages
+        self.output_headroom = output_headroom
+        self.image_tokens = {}
+
+    def page_tokens(self, image_path):
+        if image_path not in self.image_tokens:
+            # Only the image header is read to get its size
+            with Image.open(image_path) as image:
+                self.image_tokens[image_path] = vision_common.estimate_image_tokens(*image.size)
+        return self.image_tokens[image_path]
+
+    def pages_for_output(self):
+        output_budget = self.max_tokens * self.output_headroom
+        return max(1, int(output_budget // self.output_tokens_per_page))
+
+    def next_batch(self, pending):
+        # Takes the next batch off the front of a deque of page paths
+        limit = min(self.max_pages, self.pages_for_output())
+        batch = [pending.popleft()]
+        tokens = self.prompt_tokens + self.page_tokens(batch[0])
+        while pending and len(batch) < limit:
+            cost = self.page_tokens(pending[0])
+            if tokens + cost > self.token_budget:
+                break
+            batch.append(pending.popleft())
+            tokens += cost
+        return batch
+
+    def plan(self, image_paths):
+        # Plans every batch up front from the current estimates
+        pending = deque(image_paths)
+        batches = []
+        while pending:
+            batches.append(self.next_batch(pending))
+        return batches
+
+    def record(self, batch, data):
+        # Feeds a response back into the estimates. Returns True when the
+        # response was cut off and the batch should be split and retried.
+        if not data:
+            return False
+        choices = data.get('choices') or [{}]
+        finish_reason = choices[0].get('finish_reason')
+        completion_tokens = (data.get('usage') or {}).get('completion_tokens')
+
+        if finish_reason == 'length':
+            if len(batch) == 1:
+                logging.warning(f"Response truncated for single page {batch[0]}")
+                return False
+            # Make sure a batch this size no longer passes the output budget
+            self.output_tokens_per_page = max(
+                self.output_tokens_per_page, self.max_tokens / len(batch)) * 1.25
+            logging.info(
+                f"Response truncated for {len(batch)} pages, now planning {self.pages_for_output()} pages per batch")
+            return True
+
+        if completion_tokens:
+            # Moving average, so batches grow again when responses leave headroom
+            observed = completion_tokens / len(batch)
+            self.output_tokens_per_page = 0.7 * self.output_tokens_per_page + 0.3 * observed
+        return False
+
+
+def discard_truncated_output(output_directory, batch_number):
+    # Keep the partial response for reference, renamed so it is no longer a batch file.
+    # A combined batch also has a copy in each layout's folder, which the
+    # split batches will write again.
+    for directory in [output_directory] + [os.path.join(output_directory, layout)
+                                           for layout in vision_common.LAYOUTS]:
+        output_path = vision_common.batch_output_path(directory, batch_number)
+        if os.path.exists(output_path):
+            os.replace(output_path, output_path + '.truncated')
+
+
+class BatchQueue:
+    # The work left in a run: recorded batches to replay first, then pages
+    # still to be planned into batches. Keeps the manifest up to date.
+
+    def __init__(self, planner, output_directory, image_files, manifest=None,
+                 resume=False, retry_failed=False):
+        self.planner = planner
+        self.output_directory = output_directory
+        self.manifest = manifest
+        batches, pages = job_manifest.start_run(manifest, image_files, resume, retry_failed)
+        self.recorded = deque(batches)
+        self.pending = deque(pages)
+        self.next_number = manifest.next_batch_number() if manifest is not None else 1
+        self.total_pages = sum(len(batch) for _, batch in batches) + len(pages)
+
+    def __bool__(self):
+        return bool(self.recorded or self.pending)
+
+    def take(self):
+        if self.recorded:
+            batch_number, batch = self.recorded.popleft()
+        else:
+            batch = self.planner.next_batch(self.pending)
+            batch_number = self.next_number
+            self.next_number += 1
+            if self.manifest is not None:
+                self.manifest.add_batch(batch_number, batch)
+        if self.manifest is not None:
+            self.manifest.mark_running(batch_number)
+        metrics.get_registry().add_gauge('vision_batches_in_flight', 1)
+        return batch_number, batch
+
+    def finish(self, batch_number, batch, data):
+        # Returns the number of pages this batch completed; a truncated batch
+        # completes none, its pages go back to the front of the queue
+        metrics.get_registry().add_gauge('vision_batches_in_flight', -1)
+        if self.planner.record(batch, data):
+            discard_truncated_output(self.output_directory, batch_number)
+            if self.manifest is not None:
+                self.manifest.mark_split(batch_number)
+            self.pending.extendleft(reversed(batch))
+            return 0
+
+        if self.manifest is not None:
+            if data is None:
+                self.manifest.mark_failed(batch_number, "request failed, see log")
+            else:
+                self.manifest.mark_done(batch_number, vision_common.batch_output_path(
+                    self.output_directory, batch_number))
+        return len(batch)
+
+
+def run_batches(process_batch, image_files, planner, output_directory, manifest=None,
+                resume=False, retry_failed=False):
+    # Sends batches one at a time, planning each from the latest estimates.
+    # process_batch(image_paths, batch_number) returns the response or None.
+    queue = BatchQueue(planner, output_directory, image_files, manifest, resume, retry_failed)
+    results = []
+    with tqdm(total=queue.total_pages, desc="Processing Pages") as progress:
+        while queue:
+            batch_number, batch = queue.take()
+            try:
+                data = process_batch(batch, batch_number)
+            except Exception as e:
+                data = batch_failed(batch_number, e)
+            progress.update(queue.finish(batch_number, batch, data))
+            results.append(data)
+    return results
+
+
+async def run_batches_async(process_batch, image_files, planner, output_directory, concurrency,
+                            manifest=None, resume=False, retry_failed=False):
+    # Keeps up to `concurrency` batches in flight. Each new batch is planned
+    # when a slot frees up, so it benefits from the responses seen so far.
+    queue = BatchQueue(planner, output_directory, image_files, manifest, resume, retry_failed)
+    running = {}
+    results = []
+    with tqdm(total=queue.total_pages, desc="Processing Pages") as progress:
+        while queue or running:
+            while queue and len(running) < concurrency:
+                batch_number, batch = queue.take()
+                task = asyncio.ensure_future(process_batch(batch, batch_number))
+                running[task] = (batch_number, batch)
+
+            done, _ = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                batch_number, batch = running.pop(task)
+                data = batch_result(task, batch_number)
+                progress.update(queue.finish(batch_number, batch, data))
+                results.append(data)
+    return results
+
+
+def batch_failed(batch_number, error):
+    # For a batch that raised before it could handle its own errors, e.g.
+    # while preprocessing or hashing its images. It is recorded as failed,
+    # for --retry-failed, and the rest of the run carries on.
+    logging.error(f"Batch {batch_number} failed: {error}")
+    return None
+
+
+def batch_result(task, batch_number):
+    # A finished batch task's response, or None if it raised
+    try:
+        return task.result()
+    except Exception as e:
+        return batch_failed(batch_number, e)
+
+
+def add_arguments(parser):
+    group = parser.add_argument_group("batch planning")
+    group.add_argument("--token-budget", type=int, default=8000,
+                       help="estimated prompt and image tokens allowed per request")
+    group.add_argument("--max-pages", type=int, default=10,
+                       help="upper limit on pages per request")
+    group.add_argument("--output-tokens-per-page", type=int, default=300,
+                       help="starting estimate of response tokens per page")
+
+
+def from_args(args, prompt):
+    return BatchPlanner(prompt, token_budget=args.token_budget, max_pages=args.max_pages,
+                        output_tokens_per_page=args.output_tokens_per_page)
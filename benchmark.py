@@ -0,0 +1,213 @@
+import os
+import sys
+import json
+import time
+import random
+import inspect
+import argparse
+import functools
+import tempfile
+import contextlib
+
+from PIL import Image, ImageDraw
+
+import vision_common
+import rate_limiter
+import batch_planner
+import metrics
+import mock_openai
+import vision_ndl
+import vision_transcript
+import threading_test
+import vision_async
+
+TARGETS = ('vision_ndl', 'vision_transcript', 'threading_test', 'vision_async')
+
+
+def make_pages(folder, count, size=(1240, 1754), seed=0):
+    # Synthetic scanned pages: off-white paper with lines of dark "text"
+    rng = random.Random(seed)
+    os.makedirs(folder, exist_ok=True)
+    for page in range(1, count + 1):
+        image = Image.new('RGB', size, (245, 242, 235))
+        draw = ImageDraw.Draw(image)
+        for y in range(120, size[1] - 120, 60):
+            width = rng.randint(size[0] // 3, size[0] - 240)
+            draw.rectangle((120, y, 120 + width, y + 18), fill=(40, 40, 40))
+        image.save(os.path.join(folder, f"page_{page:04d}.jpg"), 'JPEG', quality=80)
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(fraction * (len(ordered) - 1))))
+    return ordered[index]
+
+
+@contextlib.contextmanager
+def timed(owner, name, samples):
+    # Swaps owner.name for a wrapper that records how long each call takes
+    original = getattr(owner, name)
+    if inspect.iscoroutinefunction(original):
+        @functools.wraps(original)
+        async def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return await original(*args, **kwargs)
+            finally:
+                samples.append(time.perf_counter() - start)
+    else:
+        @functools.wraps(original)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return original(*args, **kwargs)
+            finally:
+                samples.append(time.perf_counter() - start)
+    setattr(owner, name, wrapper)
+    try:
+        yield
+    finally:
+        setattr(owner, name, original)
+
+
+def run_target(target, image_folder, output_directory, concurrency):
+    # Returns the (owner, name) of the per-batch function, and a callable
+    # that processes the whole folder
+    api_key = 'benchmark'
+    if target == 'vision_ndl':
+        return (vision_ndl, 'process_images'), lambda: vision_ndl.main(
+            image_folder, api_key, output_directory,
+            planner=batch_planner.BatchPlanner(vision_common.NDL_PROMPT))
+    if target == 'vision_transcript':
+        return (vision_transcript, 'process_images'), lambda: vision_transcript.main(
+            image_folder, api_key, output_directory,
+            planner=batch_planner.BatchPlanner(vision_common.TRANSCRIPT_PROMPT))
+    if target == 'threading_test':
+        return (threading_test, 'process_images'), lambda: threading_test.main(
+            image_folder, api_key, output_directory)
+    if target == 'vision_async':
+        return (vision_async.VisionClient, 'process_batch'), lambda: vision_async.main(
+            image_folder, api_key, output_directory, 'ndl', concurrency,
+            batch_planner.BatchPlanner(vision_common.NDL_PROMPT))
+    raise ValueError(f"Unknown target: {target}")
+
+
+def benchmark(target, image_folder, work_dir, server_options, concurrency=8):
+    # Runs one target against a fresh mock server and returns its figures
+    output_directory = os.path.join(work_dir, f"{target}_output")
+    os.makedirs(output_directory, exist_ok=True)
+    pages = len([f for f in os.listdir(image_folder) if f.endswith('.jpg')])
+    (owner, name), run = run_target(target, image_folder, output_directory, concurrency)
+    samples = []
+
+    # Every target starts from an uncalibrated limiter and empty metrics
+    rate_limiter.reset_limiter()
+    metrics.reset()
+    with mock_openai.MockOpenAI(**server_options) as server:
+        original_url = vision_common.API_URL
+        vision_common.API_URL = server.url
+        try:
+            with timed(owner, name, samples):
+                start = time.perf_counter()
+                run()
+                elapsed = time.perf_counter() - start
+        finally:
+            vision_common.API_URL = original_url
+        stats = dict(server.stats)
+
+    outputs = len([f for f in os.listdir(output_directory) if f.endswith('.json')])
+    tokens = stats['prompt_tokens'] + stats['completion_tokens']
+    return {
+        'target': target,
+        'pages': pages,
+        'batches': len(samples),
+        'outputs': outputs,
+        'seconds': elapsed,
+        'images_per_second': stats['images'] / elapsed,
+        'requests_per_second': stats['requests'] / elapsed,
+        'tokens_per_second': tokens / elapsed,
+        'p50_latency': percentile(samples, 0.5),
+        'p95_latency': percentile(samples, 0.95),
+        'rate_limited': stats['rate_limited'],
+        'retries': metrics.get_registry().counter_total('vision_retries_total'),
+        'malformed': stats['malformed'],
+    }
+
+
+def print_results(results):
+    print(f"{'target':<18}{'images/s':>10}{'req/s':>8}{'tokens/s':>11}"
+          f"{'p50 s':>8}{'p95 s':>8}{'429s':>6}{'batches':>9}")
+    for result in results:
+        print(f"{result['target']:<18}{result['images_per_second']:>10.2f}"
+              f"{result['requests_per_second']:>8.2f}{result['tokens_per_second']:>11.0f}"
+              f"{result['p50_latency'] or 0:>8.2f}{result['p95_latency'] or 0:>8.2f}"
+              f"{result['rate_limited']:>6}{result['batches']:>9}")
+
+
+def find_regressions(results, baseline, tolerance):
+    # Targets whose throughput fell more than `tolerance` below the baseline
+    previous = {result['target']: result for result in baseline}
+    regressions = []
+    for result in results:
+        before = previous.get(result['target'])
+        if before and result['images_per_second'] < before['images_per_second'] * (1 - tolerance):
+            regressions.append(
+                f"{result['target']}: {result['images_per_second']:.2f} images/s, "
+                f"baseline {before['images_per_second']:.2f}")
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Measure OCR throughput of the vision scripts against a mock API")
+    parser.add_argument("--targets", nargs='+', choices=TARGETS, default=list(TARGETS))
+    parser.add_argument("--pages", type=int, default=24)
+    parser.add_argument("--image-folder", default=None,
+                        help="pages to send, synthetic pages are generated if not given")
+    parser.add_argument("--concurrency", type=int, default=8,
+                        help="batches in flight for vision_async")
+    parser.add_argument("--latency", type=float, default=0.5)
+    parser.add_argument("--jitter", type=float, default=0.2)
+    parser.add_argument("--per-image-latency", type=float, default=0.1)
+    parser.add_argument("--limit-requests", type=int, default=500)
+    parser.add_argument("--limit-tokens", type=int, default=300000)
+    parser.add_argument("--burst-every", type=int, default=0)
+    parser.add_argument("--burst-length", type=int, default=0)
+    parser.add_argument("--malformed-rate", type=float, default=0.0)
+    parser.add_argument("--json", default=None, help="also write the results here")
+    parser.add_argument("--baseline", default=None,
+                        help="results from an earlier --json run to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.15,
+                        help="allowed fall in images/s before a run counts as a regression")
+    args = parser.parse_args()
+
+    server_options = {
+        'latency': args.latency, 'jitter': args.jitter,
+        'per_image_latency': args.per_image_latency,
+        'limit_requests': args.limit_requests, 'limit_tokens': args.limit_tokens,
+        'burst_every': args.burst_every, 'burst_length': args.burst_length,
+        'malformed_rate': args.malformed_rate,
+    }
+    results = []
+    with tempfile.TemporaryDirectory() as work_dir:
+        image_folder = args.image_folder
+        if image_folder is None:
+            image_folder = os.path.join(work_dir, 'pages')
+            make_pages(image_folder, args.pages)
+        for target in args.targets:
+            results.append(benchmark(target, image_folder, work_dir, server_options,
+                                     args.concurrency))
+    print_results(results)
+
+    if args.json:
+        with open(args.json, 'w') as json_file:
+            json.dump(results, json_file, indent=4)
+    if args.baseline:
+        with open(args.baseline, 'r') as baseline_file:
+            regressions = find_regressions(results, json.load(baseline_file), args.tolerance)
+        for regression in regressions:
+            print(f"Regression: {regression}")
+        if regressions:
+            sys.exit(1)
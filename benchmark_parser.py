@@ -0,0 +1,60 @@
+import json
+import time
+import random
+import argparse
+
+import response_parser
+
+
+def legacy_parse(content):
+    # The cleanup json2csv_trans used before response_parser, kept here
+    # only as the baseline to measure against
+    content = content.replace('```json\n', '').replace('\n```', '').strip()
+    content = (
+        content.replace('NULL', 'null')
+               .replace('\\n', '\\\\n')
+               .replace('\\"', '\\\\"')
+               .replace('\\\\', '\\\\\\\\')
+               .replace('\\t', '\\\\t')
+               .replace('\\r', '\\\\r')
+    )
+    return json.loads(content)
+
+
+def make_content(records, null_rate, seed=0):
+    # A fenced reply of transcript records, with NULL for some missing values
+    rng = random.Random(seed)
+    items = []
+    for number in range(1, records + 1):
+        inscription = ' '.join(rng.choice(('IN', 'LOVING', 'MEMORY', 'OF', 'JOHN', 'DOE',
+                                           'DIED', 'APRIL', '16th', '1923', 'R.I.P.'))
+                               for _ in range(rng.randint(8, 40)))
+        value = 'NULL' if rng.random() < null_rate else json.dumps(inscription)
+        items.append(f'{{"memorial_number": {number}, "inscription": {value}}}')
+    return '```json\n[\n' + ',\n'.join(items) + '\n]\n```'
+
+
+def best_time(function, content, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function(content)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Compare response_parser with the old chained replace cleanup")
+    parser.add_argument("--records", type=int, default=50000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    for label, null_rate in (("clean JSON", 0.0), ("with NULL", 0.05)):
+        content = make_content(args.records, null_rate)
+        assert legacy_parse(content) == response_parser.parse_content(content)
+        megabytes = len(content) / 1e6
+        legacy = best_time(legacy_parse, content, args.repeat)
+        current = best_time(response_parser.parse_content, content, args.repeat)
+        print(f"{label:<12} {megabytes:6.1f} MB  legacy {megabytes / legacy:7.1f} MB/s  "
+              f"parser {megabytes / current:7.1f} MB/s  ({legacy / current:.2f}x)")
@@ -0,0 +1,174 @@
+import os
+import logging
+from concurrent.futures import ProcessPoolExecutor
+
+from PIL import Image
+
+import manifest as job_manifest
+import metrics
+
+DUPLICATES_FILE_NAME = '.vision_duplicates.json'
+
+
+def page_hashes(image_path, hash_size=16):
+    # Returns (dhash, ahash) for a page. Rescans and re-encodes of a page land
+    # within a few bits of each other on both.
+    #  - dhash: one bit per horizontal neighbour pair on a hash_size x
+    #    (hash_size + 1) grey thumbnail, set where brightness falls.
+    #  - ahash: one bit per pixel of a hash_size square thumbnail, set where it
+    #    is lighter than the page's mean.
+    # Survey forms share a layout, and dhash alone can't tell apart two pages
+    # whose lines start in the same place and only end differently. ahash
+    # can, so a duplicate has to be close on both.
+    with Image.open(image_path) as image:
+        # Lets the JPEG decoder scale down as it decodes, which is most of the cost
+        image.draft('L', ((hash_size + 1) * 8, hash_size * 8))
+        grey = image.convert('L')
+    pixels = grey.resize((hash_size + 1, hash_size), Image.BILINEAR).tobytes()
+    dhash = 0
+    for row in range(hash_size):
+        offset = row * (hash_size + 1)
+        for col in range(hash_size):
+            dhash = (dhash << 1) | (pixels[offset + col] > pixels[offset + col + 1])
+    pixels = grey.resize((hash_size, hash_size), Image.BILINEAR).tobytes()
+    mean = sum(pixels) / len(pixels)
+    ahash = 0
+    for pixel in pixels:
+        ahash = (ahash << 1) | (pixel > mean)
+    return dhash, ahash
+
+
+def hamming(a, b):
+    return (a ^ b).bit_count()
+
+
+def hash_pages(image_paths, workers=None):
+    if workers == 1:
+        return [page_hashes(image_path) for image_path in image_paths]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        chunksize = max(1, len(image_paths) // (4 * executor._max_workers))
+        return list(executor.map(page_hashes, image_paths, chunksize=chunksize))
+
+
+class BKTree:
+    # Metric tree over Hamming distance. A search only descends into children
+    # whose edge distance is within max_distance of the query's distance to
+    # the node, so a lookup touches a small part of the tree.
+
+    def __init__(self):
+        self.root = None
+
+    def add(self, value, item):
+        # Nodes are [value, items, {distance: child}]
+        if self.root is None:
+            self.root = [value, [item], {}]
+            return
+        node = self.root
+        while True:
+            distance = hamming(value, node[0])
+            if distance == 0:
+                node[1].append(item)
+                return
+            child = node[2].get(distance)
+            if child is None:
+                node[2][distance] = [value, [item], {}]
+                return
+            node = child
+
+    def search(self, value, max_distance):
+        found = []
+        stack = [self.root] if self.root is not None else []
+        while stack:
+            node = stack.pop()
+            distance = hamming(value, node[0])
+            if distance <= max_distance:
+                found.extend(node[1])
+            for edge, child in node[2].items():
+                if distance - max_distance <= edge <= distance + max_distance:
+                    stack.append(child)
+        return found
+
+
+def find_clusters(image_paths, hashes, max_distance):
+    # Union-find over every pair within max_distance on both hashes. The
+    # BK-tree narrows the candidates by dhash; ahash is checked per pair.
+    # Returns {representative: [members]}, where the representative is the
+    # first page of the cluster in job order.
+    parent = list(range(len(image_paths)))
+
+    def root(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    tree = BKTree()
+    for i, (dhash, ahash) in enumerate(hashes):
+        for j in tree.search(dhash, max_distance):
+            if hamming(ahash, hashes[j][1]) > max_distance:
+                continue
+            a, b = root(i), root(j)
+            if a != b:
+                parent[max(a, b)] = min(a, b)
+        tree.add(dhash, i)
+
+    clusters = {}
+    for i, image_path in enumerate(image_paths):
+        clusters.setdefault(image_paths[root(i)], []).append(image_path)
+    return clusters
+
+
+class Deduplicator:
+    # Drops near-duplicate pages before they are batched, and afterwards maps
+    # every dropped page to the output its representative was written to
+
+    def __init__(self, max_distance=8, workers=None):
+        self.max_distance = max_distance
+        self.workers = workers
+        self.clusters = {}
+
+    def filter(self, image_files):
+        if not image_files:
+            return image_files
+        hashes = hash_pages(image_files, self.workers)
+        self.clusters = find_clusters(image_files, hashes, self.max_distance)
+        duplicates = len(image_files) - len(self.clusters)
+        metrics.get_registry().inc('vision_duplicate_pages_total', duplicates)
+        logging.info(f"Found {duplicates} near-duplicate pages in {len(image_files)}, "
+                     f"sending {len(self.clusters)}")
+        return [image_path for image_path in image_files if image_path in self.clusters]
+
+    def fan_out(self, output_directory, manifest=None):
+        # Writes the clusters and, where the manifest has them, the output
+        # file holding each page's records, duplicates included
+        outputs = {}
+        if manifest is not None:
+            for batch in manifest.batches.values():
+                if batch['status'] == job_manifest.DONE:
+                    outputs.update((image, batch['output_path']) for image in batch['images'])
+        pages = {}
+        for representative, members in self.clusters.items():
+            for member in members:
+                pages[member] = {'representative': representative,
+                                 'output_path': outputs.get(representative)}
+        data = {'max_distance': self.max_distance,
+                'clusters': {rep: members for rep, members in self.clusters.items()
+                             if len(members) > 1},
+                'pages': pages}
+        path = os.path.join(output_directory, DUPLICATES_FILE_NAME)
+        job_manifest.write_json_atomic(path, data)
+        return data
+
+
+def add_arguments(parser):
+    group = parser.add_argument_group("duplicate pages")
+    group.add_argument("--dedup", action="store_true",
+                       help="send one page per cluster of near-duplicate pages")
+    group.add_argument("--dedup-distance", type=int, default=8,
+                       help="largest Hamming distance between 256-bit page hashes counted as a duplicate")
+
+
+def from_args(args):
+    if not args.dedup:
+        return None
+    return Deduplicator(args.dedup_distance)
@@ -0,0 +1,205 @@
+import time
+import asyncio
+import logging
+import threading
+import collections
+from concurrent.futures import Future, FIRST_COMPLETED, wait
+
+import rate_limiter
+import metrics
+
+# Seconds to open the connection, and to wait for the next byte of the
+# response. A vision reply only starts once the model has finished, so the
+# read timeout is also the longest a batch can take.
+CONNECT_TIMEOUT = 10
+READ_TIMEOUT = 300
+
+
+class Hedger:
+    # Request deadlines, and an optional hedging policy. Once a request has
+    # taken longer than the given quantile of recent latencies, a duplicate
+    # is sent and whichever succeeds first is kept. Hedges are capped at
+    # max_fraction of requests, and only go out when the rate limiter can
+    # admit them at once, so they never hold up other batches or push the
+    # run over its quota.
+
+    def __init__(self, connect_timeout=CONNECT_TIMEOUT, read_timeout=READ_TIMEOUT,
+                 hedge=False, quantile=0.95, max_fraction=0.1, min_samples=20, window=200):
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.hedge = hedge
+        self.quantile = quantile
+        self.max_fraction = max_fraction
+        self.min_samples = min_samples
+        self.lock = threading.Lock()
+        self.latencies = collections.deque(maxlen=window)
+        self.requests = 0
+        self.hedges = 0
+
+    @property
+    def timeout(self):
+        # In the (connect, read) form requests takes
+        return (self.connect_timeout, self.read_timeout)
+
+    def observe(self, latency):
+        # Latencies of every request that got a response, the losers of a
+        # race included, so hedging doesn't shrink the quantile it is
+        # measured against
+        with self.lock:
+            self.latencies.append(latency)
+
+    def hedge_delay(self):
+        # Seconds to wait before hedging a request, or None not to hedge
+        if not self.hedge:
+            return None
+        with self.lock:
+            if len(self.latencies) < self.min_samples:
+                return None
+            ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(self.quantile * len(ordered)))]
+
+    def count_request(self):
+        with self.lock:
+            self.requests += 1
+
+    def try_hedge(self, tokens):
+        # Admits a hedge if it is within the cap and the rate limiter can
+        # take it now. The attempt releases the limiter like any other.
+        with self.lock:
+            if self.hedges >= self.max_fraction * self.requests:
+                return False
+            if rate_limiter.get_limiter().reserve(tokens) > 0:
+                return False
+            self.hedges += 1
+        metrics.get_registry().inc('vision_hedges_total')
+        return True
+
+    def timed(self, attempt, accept):
+        # Only successful responses count towards the quantile; a fast 429
+        # or server error would pull the hedge delay down
+        sent = time.monotonic()
+        result = attempt()
+        if accept(result):
+            self.observe(time.monotonic() - sent)
+        return result
+
+    def start(self, attempt, accept):
+        # Runs an attempt on a daemon thread. A pool's threads are joined at
+        # exit, so a losing request would hold the script open until it
+        # timed out; a daemon thread is dropped with it.
+        future = Future()
+
+        def target():
+            try:
+                future.set_result(self.timed(attempt, accept))
+            except BaseException as exc:
+                future.set_exception(exc)
+
+        threading.Thread(target=target, name='hedge', daemon=True).start()
+        return future
+
+    def run(self, attempt, tokens, accept=lambda result: True):
+        # Calls attempt(), a request that has already been admitted by the
+        # rate limiter, hedging it if it runs long. The first result that
+        # accept() passes wins; a rejected one, such as a 429, leaves the
+        # other attempt running. If neither passes, the primary's result is
+        # returned for the caller to handle. A thread can't be cancelled, so
+        # a losing request is left to finish, or time out, in the background
+        # and its response is dropped, or abandoned if the script exits first.
+        self.count_request()
+        delay = self.hedge_delay()
+        if delay is None:
+            return self.timed(attempt, accept)
+        primary = self.start(attempt, accept)
+        attempts = [primary]
+        done, _ = wait(attempts, timeout=delay)
+        if not done and self.try_hedge(tokens):
+            logging.debug("Hedging a request still running after %.2fs", delay)
+            attempts.append(self.start(attempt, accept))
+        pending = set(attempts)
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None and accept(future.result()):
+                    if future is not primary:
+                        metrics.get_registry().inc('vision_hedge_wins_total')
+                    return future.result()
+        return fallback(attempts)
+
+    async def timed_async(self, attempt, accept):
+        sent = time.monotonic()
+        result = await attempt()
+        if accept(result):
+            self.observe(time.monotonic() - sent)
+        return result
+
+    async def run_async(self, attempt, tokens, accept=lambda result: True):
+        # As run(), for a coroutine function. The losing request is cancelled.
+        self.count_request()
+        delay = self.hedge_delay()
+        if delay is None:
+            return await self.timed_async(attempt, accept)
+        primary = asyncio.ensure_future(self.timed_async(attempt, accept))
+        attempts = [primary]
+        pending = {primary}
+        try:
+            done, _ = await asyncio.wait(pending, timeout=delay)
+            if not done and self.try_hedge(tokens):
+                logging.debug("Hedging a request still running after %.2fs", delay)
+                attempts.append(asyncio.ensure_future(self.timed_async(attempt, accept)))
+                pending = set(attempts)
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None and accept(task.result()):
+                        if task is not primary:
+                            metrics.get_registry().inc('vision_hedge_wins_total')
+                        return task.result()
+            return fallback(attempts)
+        finally:
+            for task in pending:
+                task.cancel()
+
+
+def fallback(attempts):
+    # When no attempt was accepted: the first one that returned at all,
+    # primary first, or else the primary's exception
+    for attempt in attempts:
+        if attempt.exception() is None:
+            return attempt.result()
+    return attempts[0].result()
+
+
+# One policy per process, like the rate limiter, so every batch's latency
+# feeds the same quantile and the cap covers every request
+_hedger = Hedger()
+
+
+def get_hedger():
+    return _hedger
+
+
+def configure(connect_timeout=CONNECT_TIMEOUT, read_timeout=READ_TIMEOUT, hedge=False,
+              quantile=0.95, max_fraction=0.1):
+    global _hedger
+    _hedger = Hedger(connect_timeout, read_timeout, hedge, quantile, max_fraction)
+    return _hedger
+
+
+def add_arguments(parser):
+    group = parser.add_argument_group("deadlines and hedging")
+    group.add_argument("--connect-timeout", type=float, default=CONNECT_TIMEOUT,
+                       help="seconds allowed to connect to the API")
+    group.add_argument("--read-timeout", type=float, default=READ_TIMEOUT,
+                       help="seconds allowed between bytes of a response before giving up")
+    group.add_argument("--hedge", action="store_true",
+                       help="send a duplicate of a request that runs past the latency quantile")
+    group.add_argument("--hedge-quantile", type=float, default=0.95,
+                       help="latency quantile after which a request is hedged")
+    group.add_argument("--max-hedge-fraction", type=float, default=0.1,
+                       help="most hedges to send, as a fraction of requests")
+
+
+def from_args(args):
+    return configure(args.connect_timeout, args.read_timeout, args.hedge,
+                     args.hedge_quantile, args.max_hedge_fraction)
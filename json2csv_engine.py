@@ -0,0 +1,210 @@
+import os
+import csv
+import json
+import heapq
+import pickle
+import sqlite3
+import tempfile
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import response_cache
+
+
+def parallel_map(function, items, workers=None, window=None):
+    # Like executor.map, in order, but with at most `window` files parsed
+    # ahead of the consumer so results never pile up in memory
+    if workers == 1:
+        for item in items:
+            yield function(item)
+        return
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        window = window or 4 * executor._max_workers
+        pending = deque()
+        for item in items:
+            pending.append(executor.submit(function, item))
+            if len(pending) >= window:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+class ExternalSorter:
+    # Sorts any number of records in bounded memory: records are buffered up
+    # to run_size, each full buffer is sorted and spilled to a temporary file,
+    # and iterating merges the sorted runs back together
+
+    def __init__(self, key, run_size=50000, tmp_dir=None):
+        self.key = key
+        self.run_size = run_size
+        self.tmp_dir = tmp_dir
+        self.buffer = []
+        self.runs = []
+        self.count = 0
+
+    def add(self, record):
+        self.buffer.append(record)
+        self.count += 1
+        if len(self.buffer) >= self.run_size:
+            self.spill()
+
+    def spill(self):
+        self.buffer.sort(key=self.key)
+        run = tempfile.TemporaryFile(dir=self.tmp_dir)
+        for record in self.buffer:
+            pickle.dump(record, run, pickle.HIGHEST_PROTOCOL)
+        run.seek(0)
+        self.runs.append(run)
+        self.buffer = []
+
+    @staticmethod
+    def read_run(run):
+        while True:
+            try:
+                yield pickle.load(run)
+            except EOFError:
+                return
+
+    def __iter__(self):
+        if not self.runs:
+            # Everything fit in one buffer, no need to touch the disk
+            yield from sorted(self.buffer, key=self.key)
+            return
+        if self.buffer:
+            self.spill()
+        try:
+            yield from heapq.merge(*[self.read_run(run) for run in self.runs], key=self.key)
+        finally:
+            self.close()
+
+    def close(self):
+        for run in self.runs:
+            run.close()
+        self.runs = []
+
+
+def sort_records(records, key, run_size=50000):
+    sorter = ExternalSorter(key, run_size)
+    for record in records:
+        sorter.add(record)
+    return sorter
+
+
+def write_csv(records, csv_path, fieldnames):
+    # Rows are written as they come, so the CSV never has to be built in memory
+    count = 0
+    with open(csv_path, 'w', newline='') as csv_file:
+        writer = csv.DictWriter(csv_file, fieldnames=fieldnames)
+        writer.writeheader()
+        for record in records:
+            writer.writerow(record)
+            count += 1
+    return count
+
+
+def convert(json_files, parse_file, csv_path, fieldnames, sort_key, workers=None,
+            run_size=50000):
+    # parse_file(path) returns the valid records of one batch file. It runs
+    # on a process pool, so it has to be a module-level function.
+    sorter = ExternalSorter(sort_key, run_size,
+                            tmp_dir=os.path.dirname(os.path.abspath(csv_path)))
+    for records in parallel_map(parse_file, json_files, workers):
+        for record in records:
+            sorter.add(record)
+    return write_csv(sorter, csv_path, fieldnames)
+
+
+class BatchIndex:
+    # Remembers, per batch file, its size, mtime, hash and the records it
+    # produced. Records are stored with their sort key, so the sorted CSV can
+    # be written straight from an index scan without re-parsing or re-sorting.
+
+    def __init__(self, path, signature):
+        self.conn = sqlite3.connect(path)
+        self.conn.executescript('''
+            CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT);
+            CREATE TABLE IF NOT EXISTS files (
+                path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, sha256 TEXT);
+            CREATE TABLE IF NOT EXISTS records (
+                path TEXT, seq INTEGER, key0, key1, record TEXT);
+            CREATE INDEX IF NOT EXISTS records_path ON records (path);
+            CREATE INDEX IF NOT EXISTS records_order ON records (key0, key1, path, seq);
+        ''')
+        row = self.conn.execute("SELECT value FROM meta WHERE name = 'signature'").fetchone()
+        if row is None or row[0] != signature:
+            # A different parser or layout produced these records; start over
+            self.conn.execute('DELETE FROM files')
+            self.conn.execute('DELETE FROM records')
+            self.conn.execute("INSERT OR REPLACE INTO meta VALUES ('signature', ?)", (signature,))
+        self.conn.commit()
+
+    def changed_files(self, json_files):
+        # Returns the files that are new or whose contents changed. A file whose
+        # size and mtime match is trusted; otherwise its hash decides.
+        known = {path: (size, mtime_ns, sha256) for path, size, mtime_ns, sha256
+                 in self.conn.execute('SELECT path, size, mtime_ns, sha256 FROM files')}
+        changed = []
+        for json_file in json_files:
+            stat = os.stat(json_file)
+            entry = known.get(json_file)
+            if entry is not None and entry[:2] == (stat.st_size, stat.st_mtime_ns):
+                continue
+            sha256 = response_cache.hash_file(json_file)
+            if entry is not None and entry[2] == sha256:
+                # Touched but not modified
+                self.conn.execute('UPDATE files SET size = ?, mtime_ns = ? WHERE path = ?',
+                                  (stat.st_size, stat.st_mtime_ns, json_file))
+                continue
+            changed.append((json_file, stat.st_size, stat.st_mtime_ns, sha256))
+
+        # Forget files that have been removed from the folder
+        removed = set(known) - set(json_files)
+        for json_file in removed:
+            self.remove(json_file)
+        return changed, len(removed)
+
+    def remove(self, json_file):
+        self.conn.execute('DELETE FROM files WHERE path = ?', (json_file,))
+        self.conn.execute('DELETE FROM records WHERE path = ?', (json_file,))
+
+    def replace(self, json_file, size, mtime_ns, sha256, records, sort_key):
+        self.remove(json_file)
+        self.conn.execute('INSERT INTO files VALUES (?, ?, ?, ?)',
+                          (json_file, size, mtime_ns, sha256))
+        rows = []
+        for seq, record in enumerate(records):
+            key = sort_key(record)
+            key = key if isinstance(key, tuple) else (key,)
+            key0, key1 = (tuple(key) + (None, None))[:2]
+            rows.append((json_file, seq, key0, key1, json.dumps(record)))
+        self.conn.executemany('INSERT INTO records VALUES (?, ?, ?, ?, ?)', rows)
+
+    def commit(self):
+        self.conn.commit()
+
+    def sorted_records(self):
+        cursor = self.conn.execute(
+            'SELECT record FROM records ORDER BY key0, key1, path, seq')
+        for (record,) in cursor:
+            yield json.loads(record)
+
+    def close(self):
+        self.conn.close()
+
+
+def convert_incremental(json_files, parse_file, csv_path, fieldnames, sort_key, signature,
+                        workers=None, index_path=None):
+    # Re-parses only new or changed batch files, then writes the CSV from the
+    # index. Parsing work is proportional to the files that changed.
+    index = BatchIndex(index_path or csv_path + '.index.sqlite', signature)
+    try:
+        changed, removed = index.changed_files(json_files)
+        paths = [entry[0] for entry in changed]
+        for entry, records in zip(changed, parallel_map(parse_file, paths, workers)):
+            index.replace(*entry, records, sort_key)
+        index.commit()
+        count = write_csv(index.sorted_records(), csv_path, fieldnames)
+    finally:
+        index.close()
+    return count, len(changed), removed
@@ -1,7 +1,15 @@
 import os
 import json
 import csv
-import glob
+
+import json2csv_engine
+import response_cache
+import response_parser
+import vision_common
+
+FIELDNAMES = ['memorial_number', 'name', 'date', 'location']
+# Bump when parsing changes, so incremental indexes are rebuilt from scratch
+PARSER_VERSION = 2
 
 
 def collect_records(records):
@@ -10,7 +18,6 @@ def collect_records(records):
         if isinstance(record, dict):
             if 'error' not in record:
                 valid_records.append(record)
-                print(f"Record added successfully")
             else:
                 print(f"Skipping record with error: {record}")
         else:
@@ -18,72 +25,127 @@ def collect_records(records):
     return valid_records
 
 
-def process_json_files(folder_path):
-    all_records = []
-    print(f"Starting to process JSON files in folder: {folder_path}")
-    for json_file in glob.glob(os.path.join(folder_path, '*.json')):
-        print(f"Processing file: {json_file}")
-        try:
-            with open(json_file, 'r') as file:
-                try:
-                    data = json.load(file)
-                    print("JSON data successfully loaded")
-
-                    content = data['choices'][0]['message']['content']
-                    content = content.replace(
-                        '```json\n', '').replace('\n```', '').strip()
-                    print("Content extracted and cleaned")
-
-                    try:
-                        records = json.loads(content)
-                        print("Content converted to JSON")
-
-                        if isinstance(records, list):
-                            all_records.extend(collect_records(records))
-                            print(
-                                f"Records from {json_file} added to collection")
-                        elif isinstance(records, dict):
-                            all_records.extend(collect_records([records]))
-                            print(
-                                f"Single record from {json_file} added to collection")
-                        else:
-                            print(
-                                f"Invalid format in file {json_file}: Records is not a list or a dict")
-                    except json.JSONDecodeError as e:
-                        print(f"JSON decode error in file {json_file}: {e}")
-
-                except json.JSONDecodeError as e:
-                    print(f"JSON decode error in file {json_file}: {e}")
-
-        except FileNotFoundError:
-            print(f"File not found: {json_file}")
-        except Exception as e:
-            print(f"Unexpected error in file {json_file}: {e}")
+def process_content(content, source):
+    records = []
+    try:
+        parsed = response_parser.parse_content(content)
+
+        if isinstance(parsed, list):
+            records.extend(collect_records(parsed))
+        elif isinstance(parsed, dict):
+            records.extend(collect_records([parsed]))
+        else:
+            print(
+                f"Invalid format in file {source}: Records is not a list or a dict")
+    except json.JSONDecodeError as e:
+        print(f"JSON decode error in file {source}: {e}")
+    return records
 
+
+def record_sort_key(record):
+    # Records without a memorial number go last
+    return (record['memorial_number'] is None, record['memorial_number'])
+
+
+def sort_records(all_records):
     print(f"Total records collected: {len(all_records)}")
     # Sort all records by 'memorial_number'
-    sorted_records = sorted(all_records, key=lambda x: (
-        x['memorial_number'] is None, x['memorial_number']))
+    sorted_records = sorted(all_records, key=record_sort_key)
     print("Records sorted by memorial number")
     return sorted_records
 
 
+def parse_json_file(json_file):
+    # Runs in a worker process, so problems are reported rather than raised
+    try:
+        with open(json_file, 'r') as file:
+            try:
+                data = json.load(file)
+                return process_content(response_parser.extract_content(data), json_file)
+            except json.JSONDecodeError as e:
+                print(f"JSON decode error in file {json_file}: {e}")
+
+    except FileNotFoundError:
+        print(f"File not found: {json_file}")
+    except Exception as e:
+        print(f"Unexpected error in file {json_file}: {e}")
+    return []
+
+
+def process_json_files(folder_path):
+    all_records = []
+    print(f"Starting to process JSON files in folder: {folder_path}")
+    for json_file in vision_common.batch_files(folder_path):
+        all_records.extend(parse_json_file(json_file))
+
+    return sort_records(all_records)
+
+
+def convert_json_files(folder_path, csv_path, workers=None, incremental=False):
+    # Parses batch files on a process pool and streams the records through
+    # an external sort into the CSV, so memory stays flat however many
+    # batches the survey produced. In incremental mode only batch files that
+    # changed since the last run are parsed again.
+    print(f"Starting to process JSON files in folder: {folder_path}")
+    json_files = vision_common.batch_files(folder_path)
+    if incremental:
+        count, changed, removed = json2csv_engine.convert_incremental(
+            json_files, parse_json_file, csv_path, FIELDNAMES, record_sort_key,
+            f"ndl-{PARSER_VERSION}", workers)
+        print(f"Re-parsed {changed} changed files, dropped {removed} removed files")
+    else:
+        count = json2csv_engine.convert(json_files, parse_json_file, csv_path,
+                                        FIELDNAMES, record_sort_key, workers)
+    print(f"Wrote {count} records from {len(json_files)} files to {csv_path}")
+    return count
+
+
+def process_cached_responses(cache_path):
+    # Reads NDL responses straight from the vision response cache, so the
+    # CSV can be rebuilt without the output_batch_*.json files
+    all_records = []
+    print(f"Starting to process cached responses in: {cache_path}")
+    cache = response_cache.ResponseCache(cache_path)
+    try:
+        for key, data in cache.iter_responses(vision_common.NDL_PROMPT):
+            try:
+                all_records.extend(process_content(
+                    response_parser.extract_content(data), f"cache:{key[:12]}"))
+            except Exception as e:
+                print(f"Unexpected error in cached response {key}: {e}")
+    finally:
+        cache.close()
+    return sort_records(all_records)
+
+
 def write_to_csv(records, csv_path):
     print(f"Writing records to CSV file: {csv_path}")
     with open(csv_path, 'w', newline='') as csv_file:
-        writer = csv.DictWriter(csv_file, fieldnames=[
-                                'memorial_number', 'name', 'date', 'location'])
+        writer = csv.DictWriter(csv_file, fieldnames=FIELDNAMES)
         writer.writeheader()
         writer.writerows(records)
     print("CSV file writing complete")
 
 
-# Replace with actual folder path
-json_folder_path = 'PATH_TO_JSON_FOLDER'
-# Replace with actual file path
-csv_file_path = 'PATH_TO_OUTPUT_CSV'
+def main(json_folder_path, csv_file_path, cache_path=None, incremental=False):
+    print("Script started")
+    if cache_path:
+        sorted_records = process_cached_responses(cache_path)
+        write_to_csv(sorted_records, csv_file_path)
+    else:
+        convert_json_files(json_folder_path, csv_file_path, incremental=incremental)
+    print("Script finished")
+
+
+if __name__ == "__main__":
+    # Replace with actual folder path
+    json_folder_path = 'PATH_TO_JSON_FOLDER'
+    # Replace with actual file path
+    csv_file_path = 'PATH_TO_OUTPUT_CSV'
+    # Set to the vision response cache (e.g. 'vision_cache.sqlite') to read
+    # from it instead of the JSON folder
+    cache_path = None
+    # Keep an index next to the CSV and only re-parse batch files that changed
+    incremental = True
 
-print("Script started")
-sorted_records = process_json_files(json_folder_path)
-write_to_csv(sorted_records, csv_file_path)
-print("Script finished")
+    main(json_folder_path, csv_file_path, cache_path, incremental)
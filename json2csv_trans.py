@@ -1,7 +1,15 @@
 import os
 import json
 import csv
-import glob
+
+import json2csv_engine
+import response_cache
+import response_parser
+import vision_common
+
+FIELDNAMES = ['memorial_number', 'inscription']
+# Bump when parsing changes, so incremental indexes are rebuilt from scratch
+PARSER_VERSION = 2
 
 
 def validate_record(record):
@@ -27,17 +35,10 @@ def collect_records(records):
 
 
 def process_json_content(content):
-    # Replace 'NULL' with 'null' and handle escape sequences
-    content = (
-        content.replace('NULL', 'null')
-               .replace('\\n', '\\\\n')  # Correctly escape newlines
-               .replace('\\"', '\\\\"')  # Escape double quotes
-               .replace('\\\\', '\\\\\\\\')  # Escape backslashes
-               .replace('\\t', '\\\\t')  # Escape tabs
-               .replace('\\r', '\\\\r')  # Escape carriage returns
-    )
+    # One pass over the reply; copes with fences, NULL and unquoted keys.
+    # Raises json.JSONDecodeError when there is no JSON to be found.
     try:
-        records = json.loads(content)
+        records = response_parser.parse_content(content)
         if isinstance(records, list):
             return collect_records(records)
         elif isinstance(records, dict):
@@ -51,10 +52,7 @@ def process_json_file(file_path):
     try:
         with open(file_path, 'r') as file:
             data = json.load(file)
-            content = data['choices'][0]['message']['content']
-            content = content.replace(
-                '```json\n', '').replace('\n```', '').strip()
-            return process_json_content(content)
+            return process_json_content(response_parser.extract_content(data))
     except json.JSONDecodeError:
         print(f"JSON decode error in file: {file_path}")
         raise
@@ -66,33 +64,76 @@ def process_json_file(file_path):
         raise
 
 
+def normalise_memorial_numbers(records):
+    # Replace non-integer values in 'memorial_number' with a default value (e.g., 0)
+    for record in records:
+        try:
+            record['memorial_number'] = int(record['memorial_number'])
+        except ValueError:
+            record['memorial_number'] = 0  # Replace with the default value
+    return records
+
+
+def parse_json_file(file_path):
+    # One batch file's records, ready to sort; runs in a worker process
+    return normalise_memorial_numbers(process_json_file(file_path))
+
+
+def record_sort_key(record):
+    return record['memorial_number']
+
+
 def process_json_files(folder_path):
     all_records = []
-    for json_file in glob.glob(os.path.join(folder_path, '*.json')):
-        records = process_json_file(json_file)
-        # Replace non-integer values in 'memorial_number' with a default value (e.g., 0)
-        for record in records:
-            try:
-                record['memorial_number'] = int(record['memorial_number'])
-            except ValueError:
-                record['memorial_number'] = 0  # Replace with the default value
-        all_records.extend(records)
+    for json_file in vision_common.batch_files(folder_path):
+        all_records.extend(parse_json_file(json_file))
     # Sort the records by 'memorial_number' after the replacement
-    return sorted(all_records, key=lambda x: x['memorial_number'])
+    return sorted(all_records, key=record_sort_key)
+
+
+def convert_json_files(folder_path, csv_path, workers=None, incremental=False):
+    # Parses batch files on a process pool and streams the records through
+    # an external sort into the CSV, so memory stays flat however many
+    # batches the survey produced. In incremental mode only batch files that
+    # changed since the last run are parsed again.
+    json_files = vision_common.batch_files(folder_path)
+    if incremental:
+        count, _, _ = json2csv_engine.convert_incremental(
+            json_files, parse_json_file, csv_path, FIELDNAMES, record_sort_key,
+            f"transcript-{PARSER_VERSION}", workers)
+        return count
+    return json2csv_engine.convert(json_files, parse_json_file, csv_path,
+                                   FIELDNAMES, record_sort_key, workers)
+
+
+def process_cached_responses(cache_path):
+    # Reads transcript responses straight from the vision response cache, so
+    # the CSV can be rebuilt without the output_batch_*.json files
+    all_records = []
+    cache = response_cache.ResponseCache(cache_path)
+    try:
+        for key, data in cache.iter_responses(vision_common.TRANSCRIPT_PROMPT):
+            all_records.extend(normalise_memorial_numbers(
+                process_json_content(response_parser.extract_content(data))))
+    finally:
+        cache.close()
+    return sorted(all_records, key=record_sort_key)
 
 
 def write_to_csv(records, csv_path):
     with open(csv_path, 'w', newline='') as csv_file:
-        writer = csv.DictWriter(csv_file, fieldnames=[
-                                'memorial_number', 'inscription'])
+        writer = csv.DictWriter(csv_file, fieldnames=FIELDNAMES)
         writer.writeheader()
         writer.writerows(records)
 
 
-def main(json_folder_path, csv_file_path):
+def main(json_folder_path, csv_file_path, cache_path=None, incremental=False):
     try:
-        sorted_records = process_json_files(json_folder_path)
-        write_to_csv(sorted_records, csv_file_path)
+        if cache_path:
+            sorted_records = process_cached_responses(cache_path)
+            write_to_csv(sorted_records, csv_file_path)
+        else:
+            convert_json_files(json_folder_path, csv_file_path, incremental=incremental)
     except Exception as e:
         print(f"An error occurred: {e}")
 
@@ -100,4 +141,9 @@ def main(json_folder_path, csv_file_path):
 if __name__ == "__main__":
     json_folder_path = '/Users/danieltierney/Desktop/HistoricGraves/Kiltullagh_Roscommon/kil_output_jsons'
     csv_file_path = '/Users/danieltierney/Desktop/Dev/openai-playground/HG_TextHarvest_v1/test_folder/output.csv'
-    main(json_folder_path, csv_file_path)
+    # Set to the vision response cache (e.g. 'vision_cache.sqlite') to read
+    # from it instead of the JSON folder
+    cache_path = None
+    # Keep an index next to the CSV and only re-parse batch files that changed
+    incremental = True
+    main(json_folder_path, csv_file_path, cache_path, incremental)
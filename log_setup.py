@@ -0,0 +1,117 @@
+import os
+import json
+import time
+import queue
+import atexit
+import logging
+import logging.handlers
+
+import metrics
+
+TEXT_FORMAT = '%(asctime)s %(levelname)s:%(message)s'
+
+
+class TextFormatter(logging.Formatter):
+    # The scripts' usual layout, with any structured fields appended as key=value
+
+    def __init__(self):
+        super().__init__(TEXT_FORMAT)
+
+    def format(self, record):
+        line = super().format(record)
+        fields = getattr(record, 'fields', None)
+        if fields:
+            line += ' ' + ' '.join(f"{key}={value}" for key, value in fields.items())
+        return line
+
+
+class JsonFormatter(logging.Formatter):
+    # One compact JSON object per line, structured fields at the top level
+
+    def format(self, record):
+        entry = {'t': round(record.created, 3), 'level': record.levelname,
+                 'msg': record.getMessage()}
+        fields = getattr(record, 'fields', None)
+        if fields:
+            entry.update(fields)
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, separators=(',', ':'), default=str)
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    # The stock QueueHandler formats each message before queueing it, on the
+    # caller's thread. Here the record goes onto the queue untouched, so all
+    # formatting and writing happens on the listener thread. Log arguments
+    # must not be changed after the call, which holds for this code.
+
+    def prepare(self, record):
+        return record
+
+
+_listener = None
+
+
+def configure(log_file, level='INFO', log_format='text'):
+    # Routes the root logger through a queue to a background thread that
+    # formats and writes log_file. Safe to call again; the last call wins.
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+
+    handler = logging.FileHandler(log_file)
+    handler.setFormatter(JsonFormatter() if log_format == 'json' else TextFormatter())
+    log_queue = queue.SimpleQueue()
+    _listener = logging.handlers.QueueListener(log_queue, handler)
+    _listener.start()
+
+    root = logging.getLogger()
+    for existing in list(root.handlers):
+        root.removeHandler(existing)
+    root.addHandler(DeferredQueueHandler(log_queue))
+    root.setLevel(level.upper() if isinstance(level, str) else level)
+    return _listener
+
+
+def shutdown():
+    # Drains the queue, so nothing logged before exit is lost
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+atexit.register(shutdown)
+
+
+def add_arguments(parser, default_file):
+    group = parser.add_argument_group("logging")
+    group.add_argument("--log-file", default=default_file)
+    group.add_argument("--log-level", default=os.getenv('LOG_LEVEL', 'INFO'),
+                       choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'])
+    group.add_argument("--log-format", default='text', choices=['text', 'json'],
+                       help="json writes one compact object per line")
+
+
+def from_args(args):
+    return configure(args.log_file, args.log_level, args.log_format)
+
+
+def log_batch(batch_number, image_paths, started, data=None, retries=0, cached=False):
+    # One summary line per batch, carrying what used to be spread over
+    # several lines: status, images, bytes, latency, tokens and retries
+    usage = (data or {}).get('usage') or {}
+    fields = {
+        'batch': batch_number,
+        'status': 'ok' if data is not None else 'failed',
+        'images': len(image_paths),
+        'bytes': sum(os.path.getsize(path) for path in image_paths if os.path.exists(path)),
+        'latency': round(time.monotonic() - started, 3),
+        'tokens': usage.get('total_tokens'),
+        'retries': retries,
+        'cached': cached,
+    }
+    # Every batch summary also feeds the run metrics
+    metrics.record_batch(fields, usage)
+    level = logging.INFO if data is not None else logging.WARNING
+    logging.log(level, "Batch %s %s", batch_number, fields['status'], extra={'fields': fields})
@@ -0,0 +1,152 @@
+import os
+import json
+import time
+import logging
+import tempfile
+import threading
+
+MANIFEST_FILE_NAME = '.vision_manifest.json'
+
+PENDING = 'pending'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+# The response was truncated and the batch's pages were re-queued in smaller batches
+SPLIT = 'split'
+
+
+def write_json_atomic(path, data):
+    # Write to a temporary file in the same folder and rename it over the
+    # target, so a crash mid-write never leaves a truncated manifest
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.manifest-', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as tmp_file:
+            json.dump(data, tmp_file, indent=4)
+            tmp_file.flush()
+            os.fsync(tmp_file.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+class JobManifest:
+    # Durable record of a vision run: every page in the job, and every batch
+    # with its images, status, attempt count and output path. Batches are
+    # added as they are planned. Saved after every change.
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.pages = []
+        self.batches = {}
+        if os.path.exists(path):
+            with open(path, 'r') as manifest_file:
+                data = json.load(manifest_file)
+            self.pages = data.get('pages', [])
+            self.batches = {int(n): batch for n, batch in data['batches'].items()}
+
+    def save(self):
+        data = {'updated_at': time.time(),
+                'pages': self.pages,
+                'batches': {str(n): batch for n, batch in sorted(self.batches.items())}}
+        write_json_atomic(self.path, data)
+
+    def reset(self, pages):
+        # Starts a fresh job over the given pages
+        with self.lock:
+            self.pages = list(pages)
+            self.batches = {}
+            self.save()
+
+    def add_batch(self, batch_number, image_paths):
+        with self.lock:
+            self.batches[batch_number] = {
+                'images': list(image_paths), 'status': PENDING,
+                'attempts': 0, 'output_path': None, 'error': None}
+            self.save()
+
+    def next_batch_number(self):
+        with self.lock:
+            return max(self.batches, default=0) + 1
+
+    def unbatched_pages(self):
+        # Pages that no live batch covers yet, in job order
+        with self.lock:
+            batched = {image for batch in self.batches.values()
+                       if batch['status'] != SPLIT for image in batch['images']}
+        return [page for page in self.pages if page not in batched]
+
+    def incomplete(self, resume=True, retry_failed=False):
+        # Resuming picks up batches that never finished, including any that
+        # were in flight when the last run died; failed ones only on request
+        statuses = set()
+        if resume:
+            statuses.update((PENDING, RUNNING))
+        if retry_failed:
+            statuses.add(FAILED)
+        return [(batch_number, batch['images'])
+                for batch_number, batch in sorted(self.batches.items())
+                if batch['status'] in statuses]
+
+    def _update(self, batch_number, **fields):
+        with self.lock:
+            self.batches[batch_number].update(fields)
+            self.save()
+
+    def mark_running(self, batch_number):
+        with self.lock:
+            batch = self.batches[batch_number]
+            batch['status'] = RUNNING
+            batch['attempts'] += 1
+            self.save()
+
+    def mark_done(self, batch_number, output_path):
+        self._update(batch_number, status=DONE, output_path=output_path, error=None)
+
+    def mark_failed(self, batch_number, error):
+        self._update(batch_number, status=FAILED, error=str(error))
+
+    def mark_split(self, batch_number):
+        self._update(batch_number, status=SPLIT, output_path=None)
+
+    def counts(self):
+        with self.lock:
+            counts = {}
+            for batch in self.batches.values():
+                counts[batch['status']] = counts.get(batch['status'], 0) + 1
+        return counts
+
+
+def start_run(manifest, image_files, resume=False, retry_failed=False):
+    # Returns (batches, pages): recorded (batch_number, image_paths) pairs to
+    # run again as they are, so batch numbers and output files match the
+    # interrupted run, and the pages still waiting to be batched
+    if manifest is None:
+        return [], list(image_files)
+
+    if (resume or retry_failed) and manifest.pages:
+        batches = manifest.incomplete(resume, retry_failed)
+        pages = manifest.unbatched_pages() if resume else []
+        logging.info(
+            f"Resuming from manifest {manifest.path}: {len(batches)} batches and {len(pages)} unbatched pages to process")
+        return batches, pages
+
+    manifest.reset(image_files)
+    return [], list(image_files)
+
+
+def add_arguments(parser, path=True):
+    group = parser.add_argument_group("job manifest")
+    if path:
+        group.add_argument("--manifest", default=None,
+                           help=f"job manifest, defaults to {MANIFEST_FILE_NAME} in the output folder")
+    group.add_argument("--resume", action="store_true",
+                       help="only process batches the last run didn't finish")
+    group.add_argument("--retry-failed", action="store_true",
+                       help="only process batches that failed last time")
+
+
+def from_args(args, output_directory):
+    return JobManifest(args.manifest or os.path.join(output_directory, MANIFEST_FILE_NAME))
@@ -0,0 +1,220 @@
+import os
+import time
+import threading
+import contextlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import manifest as job_manifest
+
+SUMMARY_FILE_NAME = '.vision_metrics.json'
+
+LATENCY_BUCKETS = (0.5, 1, 2, 5, 10, 20, 30, 60, 120)
+BYTES_BUCKETS = (64e3, 256e3, 1e6, 4e6, 16e6, 64e6)
+
+
+class Histogram:
+    # Cumulative buckets the way Prometheus exposes them, plus sum and count
+
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        else:
+            self.counts[-1] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, fraction):
+        # Interpolated within the bucket the quantile falls in
+        if not self.count:
+            return None
+        rank = fraction * self.count
+        seen = 0
+        lower = 0.0
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            if count and seen + count >= rank:
+                if bound == float('inf'):
+                    return lower
+                return lower + (bound - lower) * (rank - seen) / count
+            seen += count
+            lower = bound
+        return lower
+
+
+class Registry:
+    # Process-wide counters, gauges and histograms, safe to update from any
+    # thread or event loop
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started_at = time.time()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def add_gauge(self, name, value):
+        with self.lock:
+            self.gauges[name] = self.gauges.get(name, 0) + value
+
+    def observe(self, name, value, buckets=LATENCY_BUCKETS):
+        with self.lock:
+            if name not in self.histograms:
+                self.histograms[name] = Histogram(buckets)
+            self.histograms[name].observe(value)
+
+    def counter_total(self, name):
+        with self.lock:
+            return sum(value for (counter, _), value in self.counters.items() if counter == name)
+
+    def render(self):
+        # Prometheus text exposition format
+        lines = []
+        with self.lock:
+            for (name, labels), value in sorted(self.counters.items()):
+                lines.append(f"{name}{format_labels(labels)} {value}")
+            for name, value in sorted(self.gauges.items()):
+                lines.append(f"{name} {value}")
+            for name, histogram in sorted(self.histograms.items()):
+                cumulative = 0
+                for bound, count in zip(histogram.buckets, histogram.counts):
+                    cumulative += count
+                    lines.append(f'{name}_bucket{{le="{bound:g}"}} {cumulative}')
+                lines.append(f'{name}_bucket{{le="+Inf"}} {histogram.count}')
+                lines.append(f"{name}_sum {histogram.sum}")
+                lines.append(f"{name}_count {histogram.count}")
+        return '\n'.join(lines) + '\n'
+
+    def summary(self):
+        elapsed = time.time() - self.started_at
+        with self.lock:
+            counters = {f"{name}{format_labels(labels)}": value
+                        for (name, labels), value in sorted(self.counters.items())}
+            histograms = {name: {'count': h.count, 'sum': h.sum,
+                                 'mean': h.sum / h.count if h.count else None,
+                                 'p50': h.quantile(0.5), 'p95': h.quantile(0.95)}
+                          for name, h in sorted(self.histograms.items())}
+        tokens = (self.counter_total('vision_prompt_tokens_total') +
+                  self.counter_total('vision_completion_tokens_total'))
+        return {
+            'started_at': self.started_at,
+            'elapsed_seconds': elapsed,
+            'images_per_second': self.counter_total('vision_images_total') / elapsed,
+            'tokens_per_second': tokens / elapsed,
+            'counters': counters,
+            'histograms': histograms,
+        }
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{value}"' for key, value in labels) + '}'
+
+
+# One registry per process, like the rate limiter
+_registry = Registry()
+
+
+def get_registry():
+    return _registry
+
+
+def reset():
+    global _registry
+    _registry = Registry()
+
+
+def record_request(status, latency, upload_bytes):
+    # One HTTP attempt; status is None when no response came back
+    registry = get_registry()
+    # Always a string, so 'error' and the HTTP codes sort together
+    registry.inc('vision_requests_total', status=str(status) if status is not None else 'error')
+    if status == 429:
+        registry.inc('vision_rate_limited_total')
+    registry.observe('vision_request_seconds', latency)
+    registry.observe('vision_upload_bytes', upload_bytes, BYTES_BUCKETS)
+
+
+def record_batch(fields, usage):
+    # One finished batch, from the fields of its log summary line
+    registry = get_registry()
+    registry.inc('vision_batches_total', status=fields['status'])
+    registry.inc('vision_images_total', fields['images'])
+    registry.inc('vision_retries_total', fields['retries'])
+    registry.observe('vision_batch_seconds', fields['latency'])
+    if fields['cached']:
+        registry.inc('vision_cache_hits_total')
+    else:
+        # Cached responses cost nothing, so only count tokens actually used
+        registry.inc('vision_prompt_tokens_total', usage.get('prompt_tokens') or 0)
+        registry.inc('vision_completion_tokens_total', usage.get('completion_tokens') or 0)
+
+
+@contextlib.contextmanager
+def in_flight():
+    # Counts a batch as in flight for the duration of the block
+    get_registry().add_gauge('vision_batches_in_flight', 1)
+    try:
+        yield
+    finally:
+        get_registry().add_gauge('vision_batches_in_flight', -1)
+
+
+def start_server(port, host='127.0.0.1'):
+    # Serves /metrics from a daemon thread for the life of the process
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != '/metrics':
+                self.send_error(404)
+                return
+            body = get_registry().render().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def write_summary(path, **extra):
+    summary = get_registry().summary()
+    summary.update(extra)
+    job_manifest.write_json_atomic(path, summary)
+    return summary
+
+
+def add_arguments(parser):
+    group = parser.add_argument_group("metrics")
+    group.add_argument("--metrics-port", type=int, default=None,
+                       help="serve Prometheus metrics on this local port while running")
+    group.add_argument("--metrics-summary", default=None,
+                       help=f"end-of-run summary, defaults to {SUMMARY_FILE_NAME} in the output folder")
+
+
+def from_args(args):
+    if args.metrics_port:
+        return start_server(args.metrics_port)
+    return None
+
+
+def summary_path(args, output_directory):
+    return args.metrics_summary or os.path.join(output_directory, SUMMARY_FILE_NAME)
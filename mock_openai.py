@@ -0,0 +1,473 @@
+import io
+import json
+import time
+import email
+import email.policy
+import random
+import base64
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from PIL import Image
+
+import vision_common
+
+# Ways a response can come back broken, as seen from the real API
+MALFORMED_STYLES = ('unquoted', 'truncated', 'prose')
+
+
+class MockOpenAI:
+    # Local stand-in for /v1/chat/completions. Replies with plausible NDL or
+    # transcript records for each image, after a configurable delay, with
+    # x-ratelimit-* headers from a fixed window. Can also send bursts of 429s,
+    # a share of malformed responses and stragglers, so the vision scripts
+    # can be run and benchmarked without a paid API. Requests with
+    # "stream": true get server-sent events, token_latency seconds apart.
+    # Also stands in for the /v1/files and /v1/batches endpoints the Batch
+    # API uses; batch jobs skip the rate limit and complete batch_delay
+    # seconds after they are created.
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0, jitter=0.0, per_image_latency=0.0,
+                 limit_requests=500, limit_tokens=300000, window=60.0,
+                 burst_every=0, burst_length=0, burst_reset=0.2,
+                 malformed_rate=0.0, seed=0, batch_delay=0.0, stall_every=0, stall_latency=0.0,
+                 token_latency=0.0):
+        self.latency = latency
+        self.jitter = jitter
+        self.per_image_latency = per_image_latency
+        self.limit_requests = limit_requests
+        self.limit_tokens = limit_tokens
+        self.window = window
+        # Every burst_every requests, the next burst_length get a 429
+        self.burst_every = burst_every
+        self.burst_length = burst_length
+        self.burst_reset = burst_reset
+        self.malformed_rate = malformed_rate
+        self.batch_delay = batch_delay
+        # Every stall_every-th request is a straggler, stall_latency seconds
+        # slower. A repeat of a request, such as a hedge, is never held up,
+        # as if it had reached a different replica.
+        self.stall_every = stall_every
+        self.stall_latency = stall_latency
+        self.seen_requests = set()
+        self.token_latency = token_latency
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.window_start = time.monotonic()
+        self.window_requests = 0
+        self.window_tokens = 0
+        self.next_memorial_number = 1
+        self.stats = {'requests': 0, 'rate_limited': 0, 'malformed': 0,
+                      'images': 0, 'prompt_tokens': 0, 'completion_tokens': 0,
+                      'batch_jobs': 0, 'batch_requests': 0, 'streams_closed_early': 0}
+        self.files = {}
+        self.batches = {}
+        self.server = ThreadingHTTPServer((host, port), self.handler_class())
+        self.server.daemon_threads = True
+        self.thread = None
+
+    @property
+    def base_url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    @property
+    def url(self):
+        return self.base_url + "/chat/completions"
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        if self.thread is not None:
+            self.thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def handler_class(self):
+        mock = self
+
+        class Handler(BaseHTTPRequestHandler):
+            # HTTP/1.1 so clients can keep connections alive
+            protocol_version = 'HTTP/1.1'
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                path = self.path.rstrip('/')
+                if path == '/v1/files':
+                    fields = read_multipart(self.headers.get('Content-Type', ''), body)
+                    self.reply(*mock.create_file(fields))
+                    return
+                if path not in ('/v1/chat/completions', '/v1/batches'):
+                    self.reply(404, {'error': {'message': f"Unknown path {self.path}"}}, {})
+                    return
+                try:
+                    payload = json.loads(body)
+                except json.JSONDecodeError as e:
+                    self.reply(400, {'error': {'message': f"Invalid JSON body: {e}"}}, {})
+                    return
+                if path == '/v1/batches':
+                    self.reply(*mock.create_batch(payload))
+                elif payload.get('stream'):
+                    self.reply_stream(*mock.complete(payload), payload)
+                else:
+                    self.reply(*mock.complete(payload))
+
+            def do_GET(self):
+                parts = self.path.strip('/').split('/')
+                if parts[:2] == ['v1', 'batches'] and len(parts) == 3:
+                    self.reply(*mock.retrieve_batch(parts[2]))
+                elif parts[:2] == ['v1', 'files'] and parts[3:] == ['content']:
+                    self.reply(*mock.file_content(parts[2]))
+                else:
+                    self.reply(404, {'error': {'message': f"Unknown path {self.path}"}}, {})
+
+            def reply(self, status, data, headers):
+                if isinstance(data, bytes):
+                    encoded, content_type = data, 'application/octet-stream'
+                else:
+                    encoded, content_type = json.dumps(data).encode('utf-8'), 'application/json'
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(encoded)))
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(encoded)
+
+            def reply_stream(self, status, data, headers, payload):
+                if status != 200:
+                    self.reply(status, data, headers)
+                    return
+                self.send_response(status)
+                self.send_header('Content-Type', 'text/event-stream')
+                self.send_header('Transfer-Encoding', 'chunked')
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.end_headers()
+                include_usage = (payload.get('stream_options') or {}).get('include_usage')
+                try:
+                    for event in stream_events(data, include_usage):
+                        encoded = f"data: {event}\n\n".encode('utf-8')
+                        self.wfile.write(b'%x\r\n%s\r\n' % (len(encoded), encoded))
+                        self.wfile.flush()
+                        time.sleep(mock.token_latency)
+                    self.wfile.write(b'0\r\n\r\n')
+                except (BrokenPipeError, ConnectionResetError):
+                    # The client stopped reading, e.g. to split a batch early
+                    with mock.lock:
+                        mock.stats['streams_closed_early'] += 1
+                    self.close_connection = True
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def rate_limit_headers(self, now, remaining_requests=None, remaining_tokens=None, reset=None):
+        if reset is None:
+            reset = self.window - (now - self.window_start)
+        if remaining_requests is None:
+            remaining_requests = max(0, self.limit_requests - self.window_requests)
+        if remaining_tokens is None:
+            remaining_tokens = max(0, self.limit_tokens - self.window_tokens)
+        return {
+            'x-ratelimit-limit-requests': str(self.limit_requests),
+            'x-ratelimit-remaining-requests': str(remaining_requests),
+            'x-ratelimit-reset-requests': f"{reset:.3f}s",
+            'x-ratelimit-limit-tokens': str(self.limit_tokens),
+            'x-ratelimit-remaining-tokens': str(remaining_tokens),
+            'x-ratelimit-reset-tokens': f"{reset:.3f}s",
+        }
+
+    def complete(self, payload):
+        # Returns (status, body, headers) for one chat completion request
+        prompt, images = read_request(payload)
+        prompt_tokens = len(prompt) // 4 + sum(
+            vision_common.estimate_image_tokens(*size) for size in images)
+        max_tokens = payload.get('max_tokens') or vision_common.MAX_TOKENS
+
+        with self.lock:
+            now = time.monotonic()
+            if now - self.window_start >= self.window:
+                self.window_start = now
+                self.window_requests = 0
+                self.window_tokens = 0
+            self.stats['requests'] += 1
+            in_burst = (self.burst_every and
+                        (self.stats['requests'] - 1) % self.burst_every >= self.burst_every - self.burst_length)
+            over_limit = (self.window_requests >= self.limit_requests or
+                          self.window_tokens + prompt_tokens + max_tokens > self.limit_tokens)
+            if in_burst or over_limit:
+                self.stats['rate_limited'] += 1
+                if in_burst:
+                    headers = self.rate_limit_headers(now, 0, 0, self.burst_reset)
+                else:
+                    headers = self.rate_limit_headers(now)
+                return 429, {'error': {'message': 'Rate limit reached', 'type': 'requests'}}, headers
+
+            self.window_requests += 1
+            self.window_tokens += prompt_tokens + max_tokens
+            headers = self.rate_limit_headers(now)
+            first_number = self.next_memorial_number
+            self.next_memorial_number += len(images)
+            malformed = self.random.random() < self.malformed_rate
+            style = self.random.choice(MALFORMED_STYLES) if malformed else None
+            delay = (self.latency + self.per_image_latency * len(images) +
+                     self.random.uniform(0, self.jitter))
+            if self.stall_every:
+                key = hash(json.dumps(payload.get('messages')))
+                if key not in self.seen_requests and self.stats['requests'] % self.stall_every == 0:
+                    delay += self.stall_latency
+                self.seen_requests.add(key)
+
+        time.sleep(delay)
+        return 200, self.completion(payload, prompt, len(images), prompt_tokens,
+                                    first_number, style), headers
+
+    def completion(self, payload, prompt, image_count, prompt_tokens, first_number, style):
+        # The chat.completion body for one request, records numbered from first_number
+        max_tokens = payload.get('max_tokens') or vision_common.MAX_TOKENS
+        records = [make_record(prompt, number)
+                   for number in range(first_number, first_number + image_count)]
+        content, finish_reason = render_content(records, style)
+        if len(content) // 4 > max_tokens:
+            # Cut off where the tokens run out, like the real API
+            content, finish_reason = content[:max_tokens * 4], 'length'
+        completion_tokens = min(max_tokens, max(1, len(content) // 4))
+
+        with self.lock:
+            self.stats['images'] += image_count
+            self.stats['prompt_tokens'] += prompt_tokens
+            self.stats['completion_tokens'] += completion_tokens
+            if style is not None:
+                self.stats['malformed'] += 1
+
+        return {
+            'id': f"chatcmpl-mock-{first_number}",
+            'object': 'chat.completion',
+            'created': int(time.time()),
+            'model': payload.get('model', vision_common.MODEL),
+            'choices': [{'index': 0, 'finish_reason': finish_reason,
+                         'message': {'role': 'assistant', 'content': content}}],
+            'usage': {'prompt_tokens': prompt_tokens, 'completion_tokens': completion_tokens,
+                      'total_tokens': prompt_tokens + completion_tokens},
+        }
+
+    def add_file(self, content, purpose, filename):
+        with self.lock:
+            file_id = f"file-mock-{len(self.files) + 1}"
+            self.files[file_id] = {'id': file_id, 'object': 'file', 'bytes': len(content),
+                                   'created_at': int(time.time()), 'filename': filename,
+                                   'purpose': purpose, 'content': content}
+        return file_id
+
+    def create_file(self, fields):
+        if 'file' not in fields:
+            return 400, {'error': {'message': "Missing file"}}, {}
+        content, filename = fields['file']
+        purpose = fields.get('purpose', (b'', None))[0].decode('utf-8')
+        file_id = self.add_file(content, purpose, filename)
+        info = {key: value for key, value in self.files[file_id].items() if key != 'content'}
+        return 200, info, {}
+
+    def file_content(self, file_id):
+        if file_id not in self.files:
+            return 404, {'error': {'message': f"No such file: {file_id}"}}, {}
+        return 200, self.files[file_id]['content'], {}
+
+    def create_batch(self, payload):
+        if payload.get('input_file_id') not in self.files:
+            return 400, {'error': {'message': "Unknown input_file_id"}}, {}
+        with self.lock:
+            self.stats['batch_jobs'] += 1
+            batch_id = f"batch_mock_{self.stats['batch_jobs']}"
+            self.batches[batch_id] = {
+                'id': batch_id, 'object': 'batch', 'endpoint': payload.get('endpoint'),
+                'input_file_id': payload['input_file_id'],
+                'completion_window': payload.get('completion_window'),
+                'status': 'validating', 'output_file_id': None, 'error_file_id': None,
+                'created_at': int(time.time()), 'completed_at': None,
+                'request_counts': {'total': 0, 'completed': 0, 'failed': 0},
+                'metadata': payload.get('metadata')}
+            batch = dict(self.batches[batch_id])
+        threading.Thread(target=self.run_batch, args=(batch_id,), daemon=True).start()
+        return 200, batch, {}
+
+    def retrieve_batch(self, batch_id):
+        with self.lock:
+            if batch_id not in self.batches:
+                return 404, {'error': {'message': f"No such batch: {batch_id}"}}, {}
+            return 200, dict(self.batches[batch_id]), {}
+
+    def run_batch(self, batch_id):
+        # Answers every request in the input file, without rate limits or
+        # latency, then publishes the results as the batch's output file
+        with self.lock:
+            batch = self.batches[batch_id]
+            lines = self.files[batch['input_file_id']]['content'].decode('utf-8').splitlines()
+            batch['status'] = 'in_progress'
+        output = []
+        counts = {'total': 0, 'completed': 0, 'failed': 0}
+        for line in lines:
+            if not line.strip():
+                continue
+            request = json.loads(line)
+            payload = request['body']
+            prompt, images = read_request(payload)
+            prompt_tokens = len(prompt) // 4 + sum(
+                vision_common.estimate_image_tokens(*size) for size in images)
+            with self.lock:
+                self.stats['batch_requests'] += 1
+                first_number = self.next_memorial_number
+                self.next_memorial_number += len(images)
+                malformed = self.random.random() < self.malformed_rate
+                style = self.random.choice(MALFORMED_STYLES) if malformed else None
+            data = self.completion(payload, prompt, len(images), prompt_tokens, first_number, style)
+            counts['total'] += 1
+            counts['completed'] += 1
+            output.append(json.dumps({
+                'id': f"batch_req_mock_{first_number}", 'custom_id': request['custom_id'],
+                'response': {'status_code': 200, 'request_id': f"req_mock_{first_number}",
+                             'body': data},
+                'error': None}))
+
+        time.sleep(self.batch_delay)
+        content = ''.join(line + '\n' for line in output).encode('utf-8')
+        output_file_id = self.add_file(content, 'batch_output', f"{batch_id}_output.jsonl")
+        with self.lock:
+            batch.update(status='completed', output_file_id=output_file_id,
+                         completed_at=int(time.time()), request_counts=counts)
+
+
+def read_request(payload):
+    # Returns the prompt text and the (width, height) of every attached image
+    prompt = ''
+    images = []
+    for message in payload.get('messages', []):
+        content = message.get('content')
+        if isinstance(content, str):
+            prompt += content
+            continue
+        for part in content or []:
+            if part.get('type') == 'text':
+                prompt += part['text']
+            elif part.get('type') == 'image_url':
+                url = part['image_url']['url']
+                encoded = url.split(',', 1)[1] if url.startswith('data:') else ''
+                try:
+                    with Image.open(io.BytesIO(base64.b64decode(encoded))) as image:
+                        images.append(image.size)
+                except Exception:
+                    # Unreadable or remote images are costed as a single tile
+                    images.append((512, 512))
+    return prompt, images
+
+
+def read_multipart(content_type, body):
+    # Returns {field name: (bytes, filename)} from a multipart/form-data body
+    message = email.message_from_bytes(
+        f"Content-Type: {content_type}\r\n\r\n".encode('utf-8') + body,
+        policy=email.policy.HTTP)
+    fields = {}
+    for part in message.iter_parts():
+        name = part.get_param('name', header='content-disposition')
+        fields[name] = (part.get_payload(decode=True), part.get_filename())
+    return fields
+
+
+def make_record(prompt, memorial_number):
+    if 'inscription' in prompt and 'location' in prompt:
+        return {'memorial_number': memorial_number, 'name': f"John Doe {memorial_number}",
+                'date': 'Jan 1, 1900', 'location': 'Springfield',
+                'inscription': f"IN LOVING MEMORY OF JOHN DOE {memorial_number} R.I.P."}
+    if 'inscription' in prompt:
+        return {'memorial_number': memorial_number,
+                'inscription': f"IN LOVING MEMORY OF JOHN DOE {memorial_number} R.I.P."}
+    return {'memorial_number': memorial_number, 'name': f"John Doe {memorial_number}",
+            'date': 'Jan 1, 1900', 'location': 'Springfield'}
+
+
+def stream_events(data, include_usage=False, piece=16):
+    # The data: lines of a streamed reply, a few tokens of content in each
+    chunk = {'id': data['id'], 'object': 'chat.completion.chunk',
+             'created': data['created'], 'model': data['model']}
+    choice = data['choices'][0]
+    content = choice['message']['content']
+    yield json.dumps(dict(chunk, choices=[
+        {'index': 0, 'delta': {'role': 'assistant', 'content': ''}, 'finish_reason': None}]))
+    for start in range(0, len(content), piece):
+        yield json.dumps(dict(chunk, choices=[
+            {'index': 0, 'delta': {'content': content[start:start + piece]}, 'finish_reason': None}]))
+    yield json.dumps(dict(chunk, choices=[
+        {'index': 0, 'delta': {}, 'finish_reason': choice['finish_reason']}]))
+    if include_usage:
+        yield json.dumps(dict(chunk, choices=[], usage=data['usage']))
+    yield '[DONE]'
+
+
+def render_content(records, style=None):
+    # Returns (content, finish_reason) the way the model tends to reply
+    content = json.dumps(records, indent=2)
+    if style == 'unquoted':
+        # The prompt's own example teaches the model this layout
+        content = ', '.join('{' + ', '.join(f"{k}: {v}" for k, v in record.items()) + '}'
+                            for record in records)
+    elif style == 'truncated':
+        return '```json\n' + content[:len(content) // 2], 'length'
+    elif style == 'prose':
+        return "I'm sorry, but I can't read the text in these images.", 'stop'
+    return '```json\n' + content + '\n```', 'stop'
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Serve a mock /v1/chat/completions for offline runs")
+    parser.add_argument("--host", default='127.0.0.1')
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--latency", type=float, default=0.5,
+                        help="seconds before each response")
+    parser.add_argument("--jitter", type=float, default=0.0,
+                        help="up to this many extra random seconds per response")
+    parser.add_argument("--per-image-latency", type=float, default=0.0)
+    parser.add_argument("--limit-requests", type=int, default=500)
+    parser.add_argument("--limit-tokens", type=int, default=300000)
+    parser.add_argument("--window", type=float, default=60.0,
+                        help="seconds before the rate limit counters reset")
+    parser.add_argument("--burst-every", type=int, default=0)
+    parser.add_argument("--burst-length", type=int, default=0)
+    parser.add_argument("--malformed-rate", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--batch-delay", type=float, default=5.0,
+                        help="seconds before a Batch API job completes")
+    parser.add_argument("--stall-every", type=int, default=0,
+                        help="make every Nth request a straggler")
+    parser.add_argument("--stall-latency", type=float, default=10.0,
+                        help="extra seconds a straggler takes")
+    parser.add_argument("--token-latency", type=float, default=0.0,
+                        help="seconds between the events of a streamed reply")
+    args = parser.parse_args()
+
+    mock = MockOpenAI(args.host, args.port, args.latency, args.jitter, args.per_image_latency,
+                      args.limit_requests, args.limit_tokens, args.window,
+                      args.burst_every, args.burst_length,
+                      malformed_rate=args.malformed_rate, seed=args.seed,
+                      batch_delay=args.batch_delay, stall_every=args.stall_every,
+                      stall_latency=args.stall_latency, token_latency=args.token_latency)
+    print(f"Serving mock API at {mock.base_url} (set OPENAI_BASE_URL to use it)")
+    try:
+        mock.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        mock.server.server_close()
+        print(f"Served: {mock.stats}")
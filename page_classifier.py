@@ -0,0 +1,171 @@
+import os
+import logging
+from concurrent.futures import ProcessPoolExecutor
+
+from PIL import Image, ImageStat
+
+import manifest as job_manifest
+import metrics
+
+REPORT_FILE_NAME = '.vision_pages.json'
+
+SKIP = 'skip'
+
+
+def page_features(image_path, size=512, ink_drop=64, rule_fraction=0.4):
+    # Measures a page on a downsampled grey copy, with PIL's C operations
+    # doing the per-pixel work:
+    #  - ink: share of pixels at least ink_drop darker than the paper, the
+    #    page's median level, so bleed-through and tinted stock don't count
+    #  - stddev: spread of grey levels; a plain sheet of any colour is flat
+    #  - h_rules, v_rules: ruled lines, found as thin runs of rows or
+    #    columns where more than rule_fraction of the pixels are ink.
+    #    Handwriting and print rarely fill that much of a row, and a thick
+    #    run is a block of print or a photo, not a rule.
+    with Image.open(image_path) as image:
+        # Lets the JPEG decoder scale down as it decodes; thin rules still
+        # survive at this size, where a thumbnail would blur them away
+        image.draft('L', (size, size))
+        grey = image.convert('L')
+    histogram = grey.histogram()
+    total = grey.width * grey.height
+    seen = 0
+    for paper, count in enumerate(histogram):
+        seen += count
+        if seen * 2 >= total:
+            break
+    cutoff = max(0, paper - ink_drop)
+    ink = sum(histogram[:cutoff]) / total
+    mask = grey.point([255 if level < cutoff else 0 for level in range(256)])
+    # Averaging the mask down to one pixel per row or column gives the share
+    # of ink along each of them
+    rows = mask.resize((1, mask.height), Image.BOX).tobytes()
+    columns = mask.resize((mask.width, 1), Image.BOX).tobytes()
+    return {
+        'ink': ink,
+        'stddev': ImageStat.Stat(grey).stddev[0],
+        'h_rules': count_runs(rows, rule_fraction * 255, max(2, mask.height // 100)),
+        'v_rules': count_runs(columns, rule_fraction * 255, max(2, mask.width // 100)),
+    }
+
+
+def count_runs(profile, threshold, max_length):
+    # A rule a few pixels thick is one run of adjacent dark rows; runs
+    # longer than max_length aren't counted
+    runs = 0
+    length = 0
+    for value in profile + b'\0':
+        if value > threshold:
+            length += 1
+            continue
+        if 0 < length <= max_length:
+            runs += 1
+        length = 0
+    return runs
+
+
+def classify(features, min_ink=0.002, min_stddev=4.0, max_cover_ink=0.02, ndl_columns=3):
+    # Returns (page_class, reason). page_class is 'skip', 'ndl', 'transcript'
+    # or None when the page has content but no recognisable form layout.
+    #  - blank: next to no ink, or a flat sheet such as a coloured separator
+    #  - cover: no ruled lines and little ink, like a title or divider page
+    #  - ndl: a ruled table, with columns for number, name, date and location
+    #  - transcript: ruled writing lines without the columns
+    if features['ink'] < min_ink or features['stddev'] < min_stddev:
+        return SKIP, 'blank'
+    if not features['h_rules'] and not features['v_rules'] and features['ink'] < max_cover_ink:
+        return SKIP, 'cover'
+    if features['v_rules'] >= ndl_columns:
+        return 'ndl', 'table'
+    if features['h_rules']:
+        return 'transcript', 'ruled lines'
+    return None, 'no form layout'
+
+
+def measure_pages(image_paths, workers=None):
+    if workers == 1:
+        return [page_features(image_path) for image_path in image_paths]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        chunksize = max(1, len(image_paths) // (4 * executor._max_workers))
+        return list(executor.map(page_features, image_paths, chunksize=chunksize))
+
+
+class PageClassifier:
+    # Drops blank and cover pages before they are batched. With route=True it
+    # also leaves out pages recognised as the other form, so running the NDL
+    # and transcript extractions over one folder sends each page to the mode
+    # it belongs to. Pages it can't place go to every mode.
+
+    def __init__(self, route=False, workers=None, min_ink=0.002, max_cover_ink=0.02,
+                 ndl_columns=3):
+        self.route = route
+        self.workers = workers
+        self.thresholds = {'min_ink': min_ink, 'max_cover_ink': max_cover_ink,
+                           'ndl_columns': ndl_columns}
+        self.pages = {}
+
+    def classify_page(self, image_path, features=None):
+        if features is None:
+            features = page_features(image_path)
+        page_class, reason = classify(features, **self.thresholds)
+        self.pages[image_path] = dict(features, page_class=page_class, reason=reason)
+        return page_class
+
+    def wanted(self, page_class, mode):
+        if page_class == SKIP:
+            return False
+        if not self.route or page_class is None or mode == 'combined':
+            return True
+        return page_class == mode
+
+    def keep(self, image_path, mode):
+        # One page, e.g. straight after it has been rendered
+        keep = self.wanted(self.classify_page(image_path), mode)
+        self.count(1, int(not keep))
+        return keep
+
+    def filter(self, image_files, mode):
+        if not image_files:
+            return image_files
+        for image_path, features in zip(image_files, measure_pages(image_files, self.workers)):
+            self.classify_page(image_path, features)
+        kept = [image_path for image_path in image_files
+                if self.wanted(self.pages[image_path]['page_class'], mode)]
+        self.count(len(image_files), len(image_files) - len(kept))
+        classes = [self.pages[image_path]['page_class'] for image_path in image_files]
+        logging.info(f"Classified {len(image_files)} pages: {classes.count(SKIP)} to skip, "
+                     f"{classes.count('ndl')} NDL forms, {classes.count('transcript')} transcript "
+                     f"forms; sending {len(kept)} for {mode}")
+        return kept
+
+    def count(self, pages, left_out):
+        registry = metrics.get_registry()
+        registry.inc('vision_pages_classified_total', pages)
+        registry.inc('vision_pages_left_out_total', left_out)
+
+    def write_report(self, output_directory):
+        # Every page's class, the reason for it and the measurements behind
+        # it, for checking and tuning the thresholds on a new survey
+        os.makedirs(output_directory, exist_ok=True)
+        data = {'route': self.route, 'thresholds': self.thresholds, 'pages': self.pages}
+        job_manifest.write_json_atomic(os.path.join(output_directory, REPORT_FILE_NAME), data)
+        return data
+
+
+def add_arguments(parser):
+    group = parser.add_argument_group("page classification")
+    group.add_argument("--skip-blank", action="store_true",
+                       help="leave out blank pages, cover sheets and separators")
+    group.add_argument("--route-forms", action="store_true",
+                       help="also leave out pages recognised as the other mode's form")
+    group.add_argument("--min-ink", type=float, default=0.002,
+                       help="share of the page in ink below which it counts as blank")
+    group.add_argument("--max-cover-ink", type=float, default=0.02,
+                       help="share of ink below which an unruled page counts as a cover sheet")
+
+
+def from_args(args):
+    if not (args.skip_blank or args.route_forms):
+        return None
+    return PageClassifier(route=args.route_forms, min_ink=args.min_ink,
+                          max_cover_ink=args.max_cover_ink)
@@ -1,22 +1,68 @@
-from PyPDF2 import PdfReader
-from pdf2image import convert_from_path
+from pdf2image import convert_from_path, pdfinfo_from_path
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
 import os
+import time
 
 
-def convert_pdf_to_jpg(pdf_path, output_folder):
-    # Create a folder to store the images
+def split_page_ranges(num_pages, workers, chunk_size=None):
+    # Contiguous (first_page, last_page) ranges, one poppler call per range
+    if chunk_size is None:
+        chunk_size = -(-num_pages // max(1, workers))
+    chunk_size = max(1, chunk_size)
+    return [(first, min(first + chunk_size - 1, num_pages))
+            for first in range(1, num_pages + 1, chunk_size)]
+
+
+def render_page_range(pdf_path, output_folder, first_page, last_page, dpi=200):
+    # A single poppler process parses the PDF once and writes the whole
+    # range straight to disk, so no PIL images are held in memory
+    prefix = f'render_{first_page}_'
+    paths = convert_from_path(pdf_path, dpi=dpi, output_folder=output_folder,
+                              first_page=first_page, last_page=last_page,
+                              fmt='jpeg', output_file=prefix, paths_only=True)
+    img_paths = []
+    for page_number, path in enumerate(sorted(paths), start=first_page):
+        img_path = f'{output_folder}/page_{page_number}.jpg'
+        os.replace(path, img_path)
+        img_paths.append(img_path)
+    return img_paths
+
+
+def iter_pdf_pages(pdf_path, output_folder, workers=None, chunk_size=None, dpi=200):
+    # Yields rendered page paths in page order. At most `workers` ranges are
+    # in flight, and a new range is only started once the caller has taken
+    # the oldest one, so a slow consumer holds back rendering
     os.makedirs(output_folder, exist_ok=True)
 
-    # Read the PDF
-    reader = PdfReader(pdf_path)
-    num_pages = len(reader.pages)
+    # pdfinfo only reads the trailer, so counting pages doesn't parse the document
+    num_pages = pdfinfo_from_path(pdf_path)['Pages']
+    workers = workers or os.cpu_count() or 1
+    ranges = split_page_ranges(num_pages, workers, chunk_size)
+
+    # Each worker drives its own poppler subprocess over a page range
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        for first, last in ranges:
+            pending.append(executor.submit(
+                render_page_range, pdf_path, output_folder, first, last, dpi))
+            if len(pending) >= workers:
+                yield from pending.popleft().result()
+        while pending:
+            yield from pending.popleft().result()
+
+
+def convert_pdf_to_jpg(pdf_path, output_folder, workers=None, chunk_size=None, dpi=200):
+    start = time.perf_counter()
+    img_paths = []
+    for img_path in iter_pdf_pages(pdf_path, output_folder, workers, chunk_size, dpi):
+        print(f'Saved {img_path}')
+        img_paths.append(img_path)
 
-    # Convert each page to an image (JPEG)
-    for i in range(num_pages):
-        images = convert_from_path(pdf_path, first_page=i+1, last_page=i+1)
-        img_path = f'{output_folder}/page_{i+1}.jpg'
-        images[0].save(img_path, 'JPEG')
-        print(f'Page {i+1} saved as {img_path}')
+    elapsed = time.perf_counter() - start
+    rate = len(img_paths) / elapsed if elapsed > 0 else float('inf')
+    print(f'Rendered {len(img_paths)} pages in {elapsed:.1f}s ({rate:.2f} pages/sec)')
+    return img_paths
 
 
 if __name__ == '__main__':
@@ -25,4 +71,5 @@ if __name__ == '__main__':
     # Output folder path
     output_folder = 'PATH_TO_OUTPUT_FOLDER'
 
+    # Rendering workers default to the number of cores
     convert_pdf_to_jpg(pdf_path, output_folder)
@@ -0,0 +1,157 @@
+import os
+import sys
+import queue
+import logging
+import argparse
+import threading
+import time
+
+import pdf2jpg
+import page_classifier
+import log_setup
+import metrics
+import hedging
+import vision_ndl
+import vision_transcript
+
+# Extraction modes and the batch function that handles each of them
+MODES = {
+    'ndl': vision_ndl.process_images,
+    'transcript': vision_transcript.process_images,
+}
+
+# Sentinel the renderer puts on the queue once every page has been rendered
+_DONE = object()
+
+
+def render_pages(pdf_path, image_folder, page_queue, errors, workers, chunk_size, dpi,
+                 classifier=None, mode='ndl', keep_images=True):
+    try:
+        for img_path in pdf2jpg.iter_pdf_pages(pdf_path, image_folder, workers, chunk_size, dpi):
+            # Classified here, while the vision stage waits on the network, so
+            # skipped pages never take a place in the queue or a batch
+            if classifier is not None and not classifier.keep(img_path, mode):
+                logging.debug("Leaving out %s", img_path)
+                if not keep_images:
+                    os.remove(img_path)
+                continue
+            # Blocks while the queue is full, which pauses rendering
+            page_queue.put(img_path)
+            logging.debug("Rendered %s", img_path)
+    except Exception as e:
+        logging.error(f"Error rendering {pdf_path}: {e}")
+        errors.append(e)
+    finally:
+        page_queue.put(_DONE)
+
+
+def send_batch(process_images, batch, api_key, output_directory, batch_number, keep_images):
+    logging.debug("Processing batch %s...", batch_number)
+    with metrics.in_flight():
+        result = process_images(batch, api_key, output_directory, batch_number)
+    if not keep_images:
+        if result is None:
+            # Kept so the failed batch can be sent again
+            logging.warning(f"Batch {batch_number} failed, keeping its pages")
+        else:
+            for image_path in batch:
+                os.remove(image_path)
+    return result
+
+
+def run_pipeline(pdf_path, image_folder, api_key, output_directory, mode='ndl',
+                 batch_size=3, queue_depth=6, workers=None, chunk_size=2, dpi=200,
+                 keep_images=True, classifier=None):
+    process_images = MODES[mode]
+    os.makedirs(output_directory, exist_ok=True)
+
+    # Rendered pages wait here for the vision stage; the depth bounds how far
+    # rendering can run ahead. The renderer can also hold up to
+    # workers * chunk_size finished pages it hasn't handed over yet, so with
+    # --delete-images the pages on disk are bounded by the queue, the batch
+    # being sent and those.
+    page_queue = queue.Queue(maxsize=queue_depth)
+    errors = []
+    renderer = threading.Thread(target=render_pages, daemon=True, args=(
+        pdf_path, image_folder, page_queue, errors, workers, chunk_size, dpi, classifier, mode,
+        keep_images))
+
+    start = time.perf_counter()
+    renderer.start()
+
+    batch = []
+    batch_number = 0
+    pages = 0
+    while True:
+        img_path = page_queue.get()
+        if img_path is _DONE:
+            break
+        pages += 1
+        batch.append(img_path)
+        if len(batch) == batch_size:
+            batch_number += 1
+            send_batch(process_images, batch, api_key,
+                       output_directory, batch_number, keep_images)
+            batch = []
+
+    # Send whatever is left over as a final short batch
+    if batch:
+        batch_number += 1
+        send_batch(process_images, batch, api_key,
+                   output_directory, batch_number, keep_images)
+
+    renderer.join()
+    if classifier is not None:
+        classifier.write_report(output_directory)
+    if errors:
+        raise errors[0]
+
+    elapsed = time.perf_counter() - start
+    logging.info(
+        f"Pipeline finished: {pages} pages in {batch_number} batches in {elapsed:.1f}s")
+    return batch_number
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Render a PDF and send its pages for OCR as they are rendered")
+    parser.add_argument("pdf_path")
+    parser.add_argument("image_folder")
+    parser.add_argument("output_directory")
+    parser.add_argument("--mode", choices=sorted(MODES), default="ndl")
+    parser.add_argument("--batch-size", type=int, default=3)
+    parser.add_argument("--queue-depth", type=int, default=6,
+                        help="rendered pages allowed to wait for the vision stage")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="rendering workers, defaults to the number of cores")
+    parser.add_argument("--chunk-size", type=int, default=2,
+                        help="pages rendered per poppler call")
+    parser.add_argument("--dpi", type=int, default=200)
+    parser.add_argument("--delete-images", action="store_true",
+                        help="remove each page once its batch has been sent successfully")
+    page_classifier.add_arguments(parser)
+    metrics.add_arguments(parser)
+    hedging.add_arguments(parser)
+    log_setup.add_arguments(parser, 'pipeline.log')
+    args = parser.parse_args()
+    log_setup.from_args(args)
+    metrics.from_args(args)
+    hedging.from_args(args)
+
+    api_key = os.getenv('OPENAI_API_KEY')
+    if not api_key:
+        logging.error("OPENAI_API_KEY not set.")
+        sys.exit(1)
+
+    logging.info("Starting the streaming pipeline...")
+    run_pipeline(args.pdf_path, args.image_folder, api_key, args.output_directory,
+                 mode=args.mode, batch_size=args.batch_size,
+                 queue_depth=args.queue_depth, workers=args.workers,
+                 chunk_size=args.chunk_size, dpi=args.dpi,
+                 keep_images=not args.delete_images,
+                 classifier=page_classifier.from_args(args))
+    metrics.write_summary(metrics.summary_path(args, args.output_directory),
+                          mode=args.mode, batch_size=args.batch_size)
+    logging.info("Script finished")
+
+# To run this script, type 'python3 pipeline.py PATH/TO/PDF PATH/TO/IMAGE/FOLDER PATH/TO/OUTPUT/FOLDER' in the terminal
@@ -0,0 +1,106 @@
+import os
+import logging
+import tempfile
+from itertools import repeat
+from concurrent.futures import ProcessPoolExecutor
+
+from PIL import Image, ImageOps
+
+import response_cache
+import vision_common
+
+DEFAULT_CACHE_DIR = '.preprocess_cache'
+
+
+def crop_to_content(image, threshold=200, padding=16):
+    # Scan margins are close to white; keep the bounding box of anything darker
+    mask = image.convert('L').point(lambda p: 255 if p < threshold else 0)
+    bbox = mask.getbbox()
+    if bbox is None:
+        return image
+    left, top, right, bottom = bbox
+    return image.crop((max(0, left - padding), max(0, top - padding),
+                       min(image.width, right + padding), min(image.height, bottom + padding)))
+
+
+def preprocess_image(source_path, cache_dir=DEFAULT_CACHE_DIR, max_edge=None,
+                     grayscale=False, crop_margins=False, quality=85):
+    # Returns (output_path, stats). Results are cached by the source hash and
+    # the settings, so re-running a folder only pays for hashing.
+    source_hash = response_cache.hash_file(source_path)
+    settings = f"e{max_edge or 0}-g{int(grayscale)}-c{int(crop_margins)}-q{quality}"
+    output_dir = os.path.join(cache_dir, source_hash[:2])
+    output_path = os.path.join(output_dir, f"{source_hash}-{settings}.jpg")
+
+    with Image.open(source_path) as source:
+        source_size = source.size
+        if not os.path.exists(output_path):
+            image = ImageOps.exif_transpose(source)
+            image = image.convert('L' if grayscale else 'RGB')
+            if crop_margins:
+                image = crop_to_content(image)
+            if max_edge and max(image.size) > max_edge:
+                image.thumbnail((max_edge, max_edge), Image.LANCZOS)
+
+            # Written under a temporary name so other workers never read half a file
+            os.makedirs(output_dir, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=output_dir, suffix='.tmp')
+            with os.fdopen(fd, 'wb') as tmp_file:
+                image.save(tmp_file, 'JPEG', quality=quality, optimize=True)
+            os.replace(tmp_path, output_path)
+
+    with Image.open(output_path) as output:
+        output_size = output.size
+
+    stats = {
+        'bytes_before': os.path.getsize(source_path),
+        'bytes_after': os.path.getsize(output_path),
+        'tokens_before': vision_common.estimate_image_tokens(*source_size),
+        'tokens_after': vision_common.estimate_image_tokens(*output_size),
+    }
+    return output_path, stats
+
+
+class Preprocessor:
+    # Shrinks batches of page images on a process pool before they are encoded
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, max_edge=None, grayscale=False,
+                 crop_margins=False, quality=85, workers=None):
+        self.cache_dir = cache_dir
+        self.settings = (max_edge, grayscale, crop_margins, quality)
+        self.executor = ProcessPoolExecutor(max_workers=workers)
+
+    def prepare(self, image_paths, batch_number=None):
+        max_edge, grayscale, crop_margins, quality = self.settings
+        results = list(self.executor.map(
+            preprocess_image, image_paths, repeat(self.cache_dir), repeat(max_edge),
+            repeat(grayscale), repeat(crop_margins), repeat(quality)))
+
+        bytes_saved = sum(s['bytes_before'] - s['bytes_after'] for _, s in results)
+        tokens_saved = sum(s['tokens_before'] - s['tokens_after'] for _, s in results)
+        logging.info(
+            f"Preprocessed batch {batch_number}: {len(results)} images, "
+            f"{bytes_saved} bytes saved, {tokens_saved} image tokens saved")
+        return [output_path for output_path, _ in results]
+
+    def close(self):
+        self.executor.shutdown()
+
+
+def add_arguments(parser):
+    group = parser.add_argument_group("image preprocessing")
+    group.add_argument("--preprocess", action="store_true",
+                       help="shrink images before they are uploaded")
+    group.add_argument("--max-edge", type=int, default=2048,
+                       help="downscale so the long edge is at most this many pixels")
+    group.add_argument("--grayscale", action="store_true")
+    group.add_argument("--crop-margins", action="store_true")
+    group.add_argument("--jpeg-quality", type=int, default=85)
+    group.add_argument("--preprocess-cache", default=DEFAULT_CACHE_DIR)
+
+
+def from_args(args):
+    if not args.preprocess:
+        return None
+    return Preprocessor(args.preprocess_cache, args.max_edge, args.grayscale,
+                        args.crop_margins, args.jpeg_quality)
@@ -0,0 +1,196 @@
+import re
+import time
+import asyncio
+import logging
+import threading
+
+# OpenAI reset durations look like "2h2m37.12s", "6m0s", "19.355s" or "120ms"
+_DURATION_PART = re.compile(r'(\d+(?:\.\d+)?)(ms|h|m|s)')
+_DURATION_UNITS = {'h': 3600, 'm': 60, 's': 1, 'ms': 0.001}
+
+
+def parse_duration(value):
+    # Returns the duration in seconds, or None when the header is missing
+    if value is None or value == '':
+        return None
+    value = value.strip()
+    seconds = 0.0
+    position = 0
+    for match in _DURATION_PART.finditer(value):
+        if match.start() != position:
+            break
+        seconds += float(match.group(1)) * _DURATION_UNITS[match.group(2)]
+        position = match.end()
+    if position != len(value) or position == 0:
+        raise ValueError(f"Invalid duration: {value!r}")
+    return seconds
+
+
+class TokenBucket:
+    # A bucket with unknown capacity never makes anyone wait
+
+    def __init__(self, capacity=None, refill_per_second=None):
+        self.capacity = capacity
+        self.level = capacity
+        self.refill_per_second = refill_per_second or (capacity / 60 if capacity else None)
+        self.updated_at = time.monotonic()
+        # Set while the server reports a limit of 0
+        self.closed_until = None
+
+    def refill(self, now):
+        if self.capacity is not None:
+            elapsed = now - self.updated_at
+            self.level = min(self.capacity, self.level + elapsed * self.refill_per_second)
+        self.updated_at = now
+
+    def wait_time(self, cost, now):
+        if self.closed_until is not None and now < self.closed_until:
+            return self.closed_until - now
+        if self.capacity is None:
+            return 0
+        self.refill(now)
+        # A single request bigger than the bucket only has to wait for a full one
+        cost = min(cost, self.capacity)
+        if self.level >= cost:
+            return 0
+        return (cost - self.level) / self.refill_per_second
+
+    def take(self, cost):
+        if self.capacity is not None:
+            self.level -= min(cost, self.capacity)
+
+    def update(self, limit, remaining, reset_seconds, outstanding, now):
+        self.updated_at = now
+        if limit <= 0:
+            # Nothing is admitted until the reset, and a limit of 0 says
+            # nothing about the rate after it, so the bucket goes back to
+            # unknown until the next response
+            self.capacity = self.level = self.refill_per_second = None
+            self.closed_until = now + (reset_seconds or 60)
+            return
+        self.closed_until = None
+        # The server's view of remaining capacity doesn't yet include
+        # requests we have sent but not heard back from
+        self.capacity = limit
+        self.level = remaining - outstanding
+        if reset_seconds and limit > remaining:
+            # The reset header is the time until the bucket is full again
+            self.refill_per_second = (limit - remaining) / reset_seconds
+        else:
+            self.refill_per_second = limit / 60
+
+
+class RateLimiter:
+    # Holds requests back until both the request and token buckets can cover
+    # them. Buckets start from the configured per-minute limits, if any, and
+    # are corrected from the x-ratelimit-* headers of every response.
+
+    def __init__(self, requests_per_minute=None, tokens_per_minute=None):
+        self.lock = threading.Lock()
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+        self.outstanding_requests = 0
+        self.outstanding_tokens = 0
+        self.calibrated = False
+
+    def configure(self, requests_per_minute=None, tokens_per_minute=None):
+        # Seed limits that are still unknown; header values always win
+        with self.lock:
+            if requests_per_minute and self.requests.capacity is None:
+                self.requests = TokenBucket(requests_per_minute)
+            if tokens_per_minute and self.tokens.capacity is None:
+                self.tokens = TokenBucket(tokens_per_minute)
+
+    def reserve(self, tokens):
+        # Returns 0 once the request has been admitted, otherwise the number
+        # of seconds to wait before asking again
+        with self.lock:
+            now = time.monotonic()
+            if not self.calibrated and self.tokens.capacity is None and self.outstanding_requests:
+                # Until the first response tells us the limits, probe with
+                # one request at a time rather than stampeding the API
+                return 0.1
+            wait = max(self.requests.wait_time(1, now),
+                       self.tokens.wait_time(tokens, now))
+            if wait > 0:
+                return wait
+            self.requests.take(1)
+            self.tokens.take(tokens)
+            self.outstanding_requests += 1
+            self.outstanding_tokens += tokens
+            return 0
+
+    def acquire(self, tokens):
+        # Callers wait here, rather than for a 429, until the buckets can
+        # cover the request
+        while True:
+            wait = self.reserve(tokens)
+            if wait <= 0:
+                return
+            logging.debug(f"Rate limiter holding request for {wait:.2f}s")
+            time.sleep(wait)
+
+    async def acquire_async(self, tokens):
+        while True:
+            wait = self.reserve(tokens)
+            if wait <= 0:
+                return
+            logging.debug(f"Rate limiter holding request for {wait:.2f}s")
+            await asyncio.sleep(wait)
+
+    def release(self, tokens, headers=None):
+        # Called once per admitted request, with the response headers if any
+        with self.lock:
+            self.outstanding_requests = max(0, self.outstanding_requests - 1)
+            self.outstanding_tokens = max(0, self.outstanding_tokens - tokens)
+            if headers is not None:
+                self.calibrated = True
+                self.update_from_headers(headers)
+
+    def update_from_headers(self, headers):
+        now = time.monotonic()
+        for bucket, kind, outstanding in ((self.requests, 'requests', self.outstanding_requests),
+                                          (self.tokens, 'tokens', self.outstanding_tokens)):
+            limit = headers.get(f'x-ratelimit-limit-{kind}')
+            remaining = headers.get(f'x-ratelimit-remaining-{kind}')
+            if limit is None or remaining is None:
+                continue
+            try:
+                reset_seconds = parse_duration(headers.get(f'x-ratelimit-reset-{kind}'))
+                bucket.update(int(limit), int(remaining), reset_seconds, outstanding, now)
+            except ValueError as e:
+                logging.warning(f"Ignoring rate limit headers for {kind}: {e}")
+
+
+def is_exhausted(headers, tokens):
+    # True when the headers show a bucket that can't cover the request, so the
+    # limiter already knows how long to hold it. A 429 without such headers
+    # still needs a backoff.
+    try:
+        remaining_requests = headers.get('x-ratelimit-remaining-requests')
+        remaining_tokens = headers.get('x-ratelimit-remaining-tokens')
+        return ((remaining_requests is not None and int(remaining_requests) < 1) or
+                (remaining_tokens is not None and int(remaining_tokens) < tokens))
+    except ValueError:
+        return False
+
+
+# One limiter per process, shared by every thread and event loop sending requests
+_limiter = None
+_limiter_lock = threading.Lock()
+
+
+def get_limiter():
+    global _limiter
+    with _limiter_lock:
+        if _limiter is None:
+            _limiter = RateLimiter()
+        return _limiter
+
+
+def reset_limiter():
+    # Forgets everything the shared limiter has learned, e.g. between runs
+    # against different servers
+    global _limiter
+    with _limiter_lock:
+        _limiter = None
@@ -0,0 +1,322 @@
+import os
+import re
+import sqlite3
+import argparse
+
+try:
+    import pyarrow
+    import pyarrow.parquet as parquet
+except ImportError:
+    pyarrow = None
+
+import json2csv_engine
+import json2csv_ndl
+import json2csv_trans
+import vision_common
+
+DEFAULT_STORE_PATH = 'records.sqlite'
+FIELDS = ['survey', 'memorial_number', 'name', 'surname', 'date', 'location', 'inscription']
+# Batch file parsers for each output layout; a combined response keeps every field.
+# The transcript CSV's parser turns numbers like "12A" into 0, which would
+# fold those memorials into one row here, so the raw records are read instead.
+PARSERS = {
+    'ndl': json2csv_ndl.parse_json_file,
+    'transcript': json2csv_trans.process_json_file,
+    'combined': json2csv_ndl.parse_json_file,
+}
+_WORD = re.compile(r"[^\W\d_][\w'-]*")
+_INTEGER = re.compile(r'\s*[-+]?\d+\s*')
+_DIGIT = re.compile(r'\d')
+# A quoted phrase, or a single word with an optional trailing * for prefix search
+_QUERY_TERM = re.compile(r'"([^"]*)"|(\S+?)(\*?)(?=\s|$)')
+
+
+def surname_of(name):
+    # The last word of the name, upper-cased, so lookups by surname can use
+    # an index instead of a LIKE over every name
+    if not isinstance(name, str):
+        return None
+    words = _WORD.findall(name)
+    return words[-1].upper() if words else None
+
+
+def memorial_number_of(value):
+    # The value the INTEGER column will hold: a quoted number such as "69"
+    # becomes 69, so it merges with an unquoted 69 in the same load. Other
+    # numbers, like "12A", are kept as text; a value without any digits,
+    # such as "unknown" or "", is no number at all and stored as NULL, so
+    # those records never merge.
+    if not isinstance(value, str):
+        return value
+    if _INTEGER.fullmatch(value):
+        return int(value)
+    value = value.strip()
+    return value if _DIGIT.search(value) else None
+
+
+def fts_query(text):
+    # Turns what someone types into an FTS5 query: every word or "quoted
+    # phrase" must match, and word* matches by prefix. Each term is quoted,
+    # so punctuation in an inscription search can't be read as FTS syntax.
+    terms = []
+    for phrase, word, star in _QUERY_TERM.findall(text):
+        term = (phrase or word).replace('"', '').strip()
+        if term:
+            terms.append(f'"{term}"' + star)
+    return ' '.join(terms)
+
+
+def parse_batch_file(task):
+    # Runs in a worker process; a file that fails to parse adds no records
+    layout, json_file = task
+    try:
+        return json_file, PARSERS[layout](json_file)
+    except Exception as e:
+        print(f"Skipping {json_file}: {e}")
+        return json_file, []
+
+
+class RecordStore:
+    # Memorial records from every survey in one SQLite file, indexed for
+    # lookups by memorial number, surname and survey. NDL and transcript
+    # records for the same memorial are merged into one row. An FTS5 index
+    # over inscriptions, names and locations is updated with every load.
+
+    def __init__(self, path=DEFAULT_STORE_PATH):
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        # A crash can lose the last transactions but not corrupt the file,
+        # and the records can always be loaded again from the batch files
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.executescript('''
+            CREATE TABLE IF NOT EXISTS memorials (
+                id INTEGER PRIMARY KEY,
+                survey TEXT NOT NULL,
+                memorial_number INTEGER,
+                name TEXT,
+                surname TEXT,
+                date TEXT,
+                location TEXT,
+                inscription TEXT,
+                source TEXT);
+            -- NULLs are distinct here, so unnumbered records never merge
+            CREATE UNIQUE INDEX IF NOT EXISTS memorials_survey_number
+                ON memorials (survey, memorial_number);
+            CREATE INDEX IF NOT EXISTS memorials_number ON memorials (memorial_number);
+            CREATE INDEX IF NOT EXISTS memorials_surname ON memorials (surname, survey);
+            CREATE INDEX IF NOT EXISTS memorials_source ON memorials (source);
+        ''')
+        has_index = self.conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE name = 'memorials_fts'").fetchone()
+        self.conn.executescript('''
+            -- External content: the text lives only in memorials
+            CREATE VIRTUAL TABLE IF NOT EXISTS memorials_fts USING fts5(
+                inscription, name, location,
+                content='memorials', content_rowid='id',
+                tokenize='unicode61 remove_diacritics 2');
+            -- New rows are indexed a batch at a time by write(), which is
+            -- several times faster than a per-row insert trigger
+            CREATE TRIGGER IF NOT EXISTS memorials_fts_delete AFTER DELETE ON memorials BEGIN
+                INSERT INTO memorials_fts (memorials_fts, rowid, inscription, name, location)
+                VALUES ('delete', old.id, old.inscription, old.name, old.location);
+            END;
+            CREATE TRIGGER IF NOT EXISTS memorials_fts_update
+                AFTER UPDATE OF inscription, name, location ON memorials BEGIN
+                INSERT INTO memorials_fts (memorials_fts, rowid, inscription, name, location)
+                VALUES ('delete', old.id, old.inscription, old.name, old.location);
+                INSERT INTO memorials_fts (rowid, inscription, name, location)
+                VALUES (new.id, new.inscription, new.name, new.location);
+            END;
+        ''')
+        self.conn.commit()
+        if not has_index:
+            # A store from before the search index, or a new one
+            self.rebuild_index()
+
+    def load(self, records, survey, source=None, batch_size=10000):
+        # Upserts records in transactions of batch_size rows. Returns the
+        # number of records loaded.
+        sql = '''INSERT INTO memorials
+                     (survey, memorial_number, name, surname, date, location, inscription, source)
+                 VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                 ON CONFLICT (survey, memorial_number) DO UPDATE SET
+                     name = coalesce(excluded.name, name),
+                     surname = coalesce(excluded.surname, surname),
+                     date = coalesce(excluded.date, date),
+                     location = coalesce(excluded.location, location),
+                     inscription = coalesce(excluded.inscription, inscription),
+                     source = excluded.source'''
+        count = 0
+        rows = []
+        # Where each memorial number is in rows. write() indexes a chunk's
+        # new rows after the upsert, so a number repeated within a chunk
+        # would fire the update trigger for a row not yet indexed; repeats
+        # are merged here instead, the same way the upsert would merge them.
+        positions = {}
+        for record in records:
+            name = record.get('name')
+            number = memorial_number_of(record.get('memorial_number'))
+            row = (survey, number, name, surname_of(name), record.get('date'),
+                   record.get('location'), record.get('inscription'),
+                   record.get('_source', source))
+            count += 1
+            if number is not None and number in positions:
+                position = positions[number]
+                old = rows[position]
+                rows[position] = old[:2] + tuple(
+                    new if new is not None else previous
+                    for new, previous in zip(row[2:7], old[2:7])) + row[7:]
+                continue
+            if number is not None:
+                positions[number] = len(rows)
+            rows.append(row)
+            if len(rows) >= batch_size:
+                self.write(sql, rows)
+                rows = []
+                positions = {}
+        if rows:
+            self.write(sql, rows)
+        return count
+
+    def write(self, sql, rows):
+        with self.conn:
+            # Rows the upsert inserts get ids above the current largest
+            last_id = self.conn.execute('SELECT coalesce(max(id), 0) FROM memorials').fetchone()[0]
+            self.conn.executemany(sql, rows)
+            self.conn.execute('''INSERT INTO memorials_fts (rowid, inscription, name, location)
+                                 SELECT id, inscription, name, location FROM memorials
+                                 WHERE id > ?''', (last_id,))
+        return len(rows)
+
+    def load_folder(self, folder_path, layout, survey=None, workers=None, batch_size=10000):
+        # Parses every batch file in the folder on a process pool and loads
+        # the records as they arrive
+        survey = survey or os.path.basename(os.path.normpath(folder_path))
+        json_files = vision_common.batch_files(folder_path)
+        # Numbered records are replaced by the upsert; unnumbered ones from
+        # these files would pile up on every reload, so clear them first
+        with self.conn:
+            self.conn.executemany(
+                'DELETE FROM memorials WHERE survey = ? AND memorial_number IS NULL AND source = ?',
+                [(survey, json_file) for json_file in json_files])
+
+        def records():
+            for json_file, file_records in json2csv_engine.parallel_map(
+                    parse_batch_file, [(layout, json_file) for json_file in json_files], workers):
+                for record in file_records:
+                    yield dict(record, _source=json_file)
+
+        return self.load(records(), survey, batch_size=batch_size)
+
+    def find(self, memorial_number=None, surname=None, survey=None):
+        clauses, params = [], []
+        for column, value in (('memorial_number', memorial_number_of(memorial_number)),
+                              ('surname', surname_of(surname) if surname else None),
+                              ('survey', survey)):
+            if value is not None:
+                clauses.append(f"{column} = ?")
+                params.append(value)
+        where = ' WHERE ' + ' AND '.join(clauses) if clauses else ''
+        cursor = self.conn.execute(
+            f"SELECT {', '.join(FIELDS)} FROM memorials{where} ORDER BY survey, memorial_number",
+            params)
+        return [dict(zip(FIELDS, row)) for row in cursor]
+
+    def rebuild_index(self):
+        with self.conn:
+            self.conn.execute("INSERT INTO memorials_fts (memorials_fts) VALUES ('rebuild')")
+            self.conn.execute("INSERT INTO memorials_fts (memorials_fts) VALUES ('optimize')")
+
+    def search(self, text, survey=None, limit=20):
+        # Best matches first by BM25, inscription matches weighted above
+        # name and location. Each result carries a snippet around the match.
+        query = fts_query(text)
+        if not query:
+            return []
+        sql = '''SELECT m.survey, m.memorial_number, m.name,
+                        snippet(memorials_fts, 0, '[', ']', '...', 12),
+                        bm25(memorials_fts, 10.0, 2.0, 2.0) AS rank
+                 FROM memorials_fts JOIN memorials m ON m.id = memorials_fts.rowid
+                 WHERE memorials_fts MATCH ?'''
+        params = [query]
+        if survey is not None:
+            sql += ' AND m.survey = ?'
+            params.append(survey)
+        sql += ' ORDER BY rank LIMIT ?'
+        params.append(limit)
+        return [{'survey': survey, 'memorial_number': number, 'name': name,
+                 'snippet': snippet, 'rank': rank}
+                for survey, number, name, snippet, rank in self.conn.execute(sql, params)]
+
+    def export_parquet(self, parquet_path, batch_size=50000):
+        # Streams the table into a Parquet file a batch of rows at a time
+        if pyarrow is None:
+            raise RuntimeError("Parquet output needs pyarrow: pip install pyarrow")
+        # Every column is a string; memorial numbers include ones like "12A"
+        schema = pyarrow.schema([(field, pyarrow.string()) for field in FIELDS])
+        cursor = self.conn.execute(
+            f"SELECT {', '.join(FIELDS)} FROM memorials ORDER BY survey, memorial_number")
+        count = 0
+        with parquet.ParquetWriter(parquet_path, schema) as writer:
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                columns = list(zip(*rows))
+                writer.write_table(pyarrow.table(
+                    {field: pyarrow.array([None if value is None else str(value) for value in column],
+                                          pyarrow.string())
+                     for field, column in zip(FIELDS, columns)}, schema=schema))
+                count += len(rows)
+        return count
+
+    def close(self):
+        self.conn.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Load batch files into an indexed SQLite record store and look records up")
+    parser.add_argument("store", nargs='?', default=DEFAULT_STORE_PATH)
+    parser.add_argument("--load", metavar="JSON_FOLDER",
+                        help="folder of output_batch_*.json files to load")
+    parser.add_argument("--layout", choices=sorted(PARSERS), default="ndl")
+    parser.add_argument("--survey", default=None,
+                        help="survey (graveyard) name, defaults to the folder name")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--parquet", default=None,
+                        help="also export the whole store to this Parquet file")
+    parser.add_argument("--memorial", default=None,
+                        help="print the records with this memorial number")
+    parser.add_argument("--surname", default=None,
+                        help="print the records with this surname")
+    parser.add_argument("--search", default=None,
+                        help='full-text search of inscriptions, e.g. "loving memory" Lisnagroobe')
+    parser.add_argument("--limit", type=int, default=20)
+    parser.add_argument("--reindex", action="store_true",
+                        help="rebuild the full-text index from the stored records")
+    args = parser.parse_args()
+
+    store = RecordStore(args.store)
+    try:
+        if args.load:
+            count = store.load_folder(args.load, args.layout, args.survey, args.workers)
+            print(f"Loaded {count} records from {args.load} into {args.store}")
+        if args.parquet:
+            count = store.export_parquet(args.parquet)
+            print(f"Wrote {count} records to {args.parquet}")
+        if args.reindex:
+            store.rebuild_index()
+            print(f"Rebuilt the search index in {args.store}")
+        if args.memorial is not None or args.surname:
+            for record in store.find(args.memorial, args.surname, args.survey):
+                print(record)
+        if args.search:
+            for result in store.search(args.search, args.survey, args.limit):
+                print(f"{result['survey']} #{result['memorial_number']} {result['name'] or ''}: "
+                      f"{result['snippet']}")
+    finally:
+        store.close()
+
+# To run this script, type 'python3 record_store.py records.sqlite --load PATH/TO/JSON/FOLDER --layout ndl' in the terminal
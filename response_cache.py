@@ -0,0 +1,194 @@
+import os
+import sys
+import json
+import time
+import sqlite3
+import hashlib
+import logging
+import argparse
+import threading
+
+DEFAULT_CACHE_PATH = 'vision_cache.sqlite'
+
+
+def hash_file(path, chunk_size=1 << 20):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def hash_text(text):
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+def cache_key(image_hashes, prompt, model, max_tokens):
+    # Anything that changes the request changes the key. Image paths are left
+    # out on purpose, so a renamed or moved folder still hits.
+    digest = hashlib.sha256()
+    for part in [model, str(max_tokens), hash_text(prompt)] + list(image_hashes):
+        digest.update(part.encode('utf-8'))
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+
+class ResponseCache:
+    # Chat completion responses keyed by the hash of the image bytes, prompt,
+    # model and max_tokens. Safe to share between threads.
+
+    def __init__(self, path=DEFAULT_CACHE_PATH, max_bytes=None, max_age=None):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS responses (
+            key TEXT PRIMARY KEY,
+            prompt_hash TEXT NOT NULL,
+            model TEXT NOT NULL,
+            max_tokens INTEGER NOT NULL,
+            image_hashes TEXT NOT NULL,
+            response TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            created_at REAL NOT NULL,
+            accessed_at REAL NOT NULL)''')
+        self.conn.execute(
+            'CREATE INDEX IF NOT EXISTS responses_prompt ON responses (prompt_hash, created_at)')
+        self.conn.commit()
+
+    def key_for(self, image_paths, prompt, model, max_tokens):
+        image_hashes = [hash_file(image_path) for image_path in image_paths]
+        return cache_key(image_hashes, prompt, model, max_tokens), image_hashes
+
+    def get(self, key):
+        with self.lock:
+            row = self.conn.execute(
+                'SELECT response FROM responses WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                return None
+            self.conn.execute(
+                'UPDATE responses SET accessed_at = ? WHERE key = ?', (time.time(), key))
+            self.conn.commit()
+        return json.loads(row[0])
+
+    def put(self, key, image_hashes, prompt, model, max_tokens, response):
+        text = json.dumps(response)
+        now = time.time()
+        with self.lock:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (key, hash_text(prompt), model, max_tokens, json.dumps(image_hashes),
+                 text, len(text), now, now))
+            self.conn.commit()
+
+    def evict(self, max_bytes=None, max_age=None):
+        # Drops entries older than max_age seconds, then the least recently
+        # used ones until the cache fits in max_bytes
+        max_bytes = max_bytes if max_bytes is not None else self.max_bytes
+        max_age = max_age if max_age is not None else self.max_age
+        removed = 0
+        with self.lock:
+            if max_age is not None:
+                removed += self.conn.execute(
+                    'DELETE FROM responses WHERE created_at < ?',
+                    (time.time() - max_age,)).rowcount
+            if max_bytes is not None:
+                total = self.conn.execute(
+                    'SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+                if total > max_bytes:
+                    rows = self.conn.execute(
+                        'SELECT key, size FROM responses ORDER BY accessed_at').fetchall()
+                    doomed = []
+                    for key, size in rows:
+                        if total <= max_bytes:
+                            break
+                        doomed.append((key,))
+                        total -= size
+                    self.conn.executemany('DELETE FROM responses WHERE key = ?', doomed)
+                    removed += len(doomed)
+            self.conn.commit()
+        if removed:
+            logging.info(f"Evicted {removed} cached responses")
+        return removed
+
+    def iter_responses(self, prompt=None):
+        # Cached responses, oldest first, optionally only those for one prompt
+        query = 'SELECT key, response FROM responses'
+        params = ()
+        if prompt is not None:
+            query += ' WHERE prompt_hash = ?'
+            params = (hash_text(prompt),)
+        with self.lock:
+            rows = self.conn.execute(query + ' ORDER BY created_at', params).fetchall()
+        for key, text in rows:
+            yield key, json.loads(text)
+
+    def stats(self):
+        with self.lock:
+            count, size = self.conn.execute(
+                'SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses').fetchone()
+        return {'entries': count, 'bytes': size}
+
+    def close(self):
+        self.conn.close()
+
+
+def export_responses(cache, output_directory, prompt=None):
+    # Writes cached responses in the output_batch_N.json layout json2csv_* read
+    os.makedirs(output_directory, exist_ok=True)
+    count = 0
+    for count, (key, response) in enumerate(cache.iter_responses(prompt), start=1):
+        output_path = os.path.join(output_directory, f"output_batch_{count}.json")
+        with open(output_path, "w") as json_file:
+            json.dump(response, json_file, indent=4)
+    return count
+
+
+def add_arguments(parser):
+    group = parser.add_argument_group("response cache")
+    group.add_argument("--cache", default=DEFAULT_CACHE_PATH,
+                       help="response cache file, reused across runs")
+    group.add_argument("--no-cache", action="store_true")
+    group.add_argument("--cache-max-mb", type=float, default=1024)
+    group.add_argument("--cache-max-age-days", type=float, default=90)
+
+
+def from_args(args):
+    if args.no_cache:
+        return None
+    return ResponseCache(args.cache, max_bytes=int(args.cache_max_mb * 1024 * 1024),
+                         max_age=args.cache_max_age_days * 86400)
+
+
+if __name__ == "__main__":
+    import vision_common
+
+    parser = argparse.ArgumentParser(description="Inspect or trim the OCR response cache")
+    parser.add_argument("--cache", default=DEFAULT_CACHE_PATH)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("stats")
+    evict_parser = subparsers.add_parser("evict")
+    evict_parser.add_argument("--max-mb", type=float, default=None)
+    evict_parser.add_argument("--max-age-days", type=float, default=None)
+    export_parser = subparsers.add_parser("export")
+    export_parser.add_argument("output_directory")
+    export_parser.add_argument("--mode", choices=sorted(vision_common.PROMPTS), default=None)
+    args = parser.parse_args()
+
+    if not os.path.exists(args.cache):
+        print(f"Cache not found: {args.cache}")
+        sys.exit(1)
+
+    cache = ResponseCache(args.cache)
+    if args.command == "stats":
+        print(json.dumps(cache.stats()))
+    elif args.command == "evict":
+        max_bytes = int(args.max_mb * 1024 * 1024) if args.max_mb is not None else None
+        max_age = args.max_age_days * 86400 if args.max_age_days is not None else None
+        print(f"Evicted {cache.evict(max_bytes, max_age)} entries")
+    elif args.command == "export":
+        prompt = vision_common.PROMPTS[args.mode] if args.mode else None
+        print(f"Exported {export_responses(cache, args.output_directory, prompt)} responses")
+    cache.close()
@@ -0,0 +1,229 @@
+import re
+import json
+from json.decoder import scanstring
+
+# strict=False lets raw newlines and tabs through inside strings, which the
+# model often leaves in long inscriptions
+_decoder = json.JSONDecoder(strict=False)
+_scan_once = _decoder.scan_once
+
+_WHITESPACE = re.compile(r'\s*')
+_NUMBER = re.compile(r'-?(?:0|[1-9]\d*)(?:\.\d+)?(?:[eE][-+]?\d+)?')
+_BARE_KEY = re.compile(r'[A-Za-z_][\w-]*')
+# A comma that starts the next "key:" pair, so "date: Jan 1, 1800, location: x"
+# splits after 1800 and not inside the date
+_NEXT_KEY = re.compile(r',\s*(?:"[^"\\]*"|[A-Za-z_][\w-]*)\s*:')
+_BARE_END = re.compile(r'[,}\]]')
+# Inside an object a bare value only ends at a comma or the closing brace, so
+# "IN MEMORY OF [illegible] DOE" stays text
+_BARE_VALUE_END = re.compile(r'[,}]')
+_START = re.compile(r'[\[{]')
+# After an array element: a comma (maybe trailing) or the closing bracket
+_ARRAY_NEXT = re.compile(r'\s*(?:,\s*(\])?|(\]))\s*')
+_LITERALS = {'null': None, 'none': None, 'true': True, 'false': False}
+# The only fields a bare number is read as a number for; in the rest, such as
+# a date of 1900, it stays a string as the schemas expect
+_NUMBER_KEYS = {'memorial_number'}
+
+
+class ParseError(json.JSONDecodeError):
+    # Subclasses JSONDecodeError so existing error handling keeps working
+    pass
+
+
+def extract_content(data):
+    # The model's reply from a chat completion response
+    return data['choices'][0]['message']['content']
+
+
+def parse_content(content):
+    # Returns the JSON value in a model reply, skipping any markdown fence or
+    # prose around it. Well-formed JSON is decoded in place by the C decoder;
+    # anything else (NULL, unquoted keys and values, trailing commas) goes
+    # through the tolerant parser below. Several top-level objects in a row
+    # come back as a list. A bracket in the prose before the records, as in
+    # "memorial 12 [page 1]: {...}", is passed over: each opening bracket is
+    # tried in turn until one holds records. After one that fails to parse,
+    # the search carries on from where it failed, so a reply cut off part
+    # way still raises.
+    match = _START.search(content)
+    if match is None:
+        raise ParseError("No JSON object or array found", content, 0)
+    fallback = error = None
+    while match is not None:
+        try:
+            value, end = _parse_values(content, match.start())
+        except json.JSONDecodeError as e:
+            error = error or e
+            match = _START.search(content, max(e.pos, match.start() + 1))
+            continue
+        if _holds_records(value):
+            return value
+        if fallback is None:
+            fallback = (value,)
+        match = _START.search(content, end)
+    if fallback is not None:
+        return fallback[0]
+    raise error
+
+
+def _holds_records(value):
+    if isinstance(value, dict):
+        return True
+    return isinstance(value, list) and (not value or any(isinstance(item, dict) for item in value))
+
+
+def _parse_values(content, pos):
+    # The value starting at pos, and any more objects straight after it
+    values = []
+    while True:
+        try:
+            value, pos = _decoder.raw_decode(content, pos)
+        except json.JSONDecodeError:
+            value, pos = _TolerantParser(content).container(pos)
+        values.append(value)
+        # Another object after this one, e.g. "{...},\n{...}" without brackets
+        pos = _WHITESPACE.match(content, pos).end()
+        if content.startswith(',', pos):
+            pos = _WHITESPACE.match(content, pos + 1).end()
+        if not content.startswith(('{', '['), pos):
+            break
+
+    if len(values) == 1:
+        return values[0], pos
+    flattened = []
+    for value in values:
+        flattened.extend(value if isinstance(value, list) else [value])
+    return flattened, pos
+
+
+def parse_response(data):
+    return parse_content(extract_content(data))
+
+
+class _TolerantParser:
+    # Recursive descent over the original string by index, so no cleaned-up
+    # copies of the reply are ever made
+
+    def __init__(self, text):
+        self.text = text
+
+    def error(self, message, pos):
+        return ParseError(message, self.text, pos)
+
+    def skip(self, pos):
+        return _WHITESPACE.match(self.text, pos).end()
+
+    def value(self, pos, key=None):
+        # key is the property name when this is a value inside an object
+        pos = self.skip(pos)
+        if pos >= len(self.text):
+            raise self.error("Expecting value", pos)
+        char = self.text[pos]
+        if char in '{[' and key is not None:
+            # Could also be bare text that starts with a bracket, such as
+            # "[illegible] DOE", which runs on past the closing bracket
+            try:
+                result = self.value(pos)
+            except json.JSONDecodeError:
+                return self.bare(pos, key)
+            if self.text.startswith((',', '}'), self.skip(result[1])):
+                return result
+            return self.bare(pos, key)
+        if char in '{[':
+            # Most elements of a broken reply are fine on their own, so let
+            # the C decoder have them and only walk the broken ones here
+            try:
+                # scan_once reports most failures with a cheap StopIteration;
+                # a JSONDecodeError counts lines up to pos, which adds up over
+                # a long reply
+                return _scan_once(self.text, pos)
+            except (StopIteration, json.JSONDecodeError):
+                pass
+        if char == '{':
+            return self.object(pos + 1)
+        if char == '[':
+            return self.array(pos + 1)
+        if char == '"':
+            return scanstring(self.text, pos + 1, False)
+        return self.bare(pos, key)
+
+    def container(self, pos):
+        # Walks an object or array the C decoder has already rejected
+        if self.text.startswith('{', pos):
+            return self.object(pos + 1)
+        return self.array(pos + 1)
+
+    def object(self, pos):
+        result = {}
+        pos = self.skip(pos)
+        while not self.text.startswith('}', pos):
+            if self.text.startswith('"', pos):
+                key, pos = scanstring(self.text, pos + 1, False)
+            else:
+                match = _BARE_KEY.match(self.text, pos)
+                if match is None:
+                    raise self.error("Expecting property name", pos)
+                key, pos = match.group(), match.end()
+            pos = self.skip(pos)
+            if not self.text.startswith(':', pos):
+                raise self.error("Expecting ':' delimiter", pos)
+            result[key], pos = self.value(pos + 1, key)
+            pos = self.skip(pos)
+            if self.text.startswith(',', pos):
+                pos = self.skip(pos + 1)
+            elif not self.text.startswith('}', pos):
+                raise self.error("Expecting ',' delimiter", pos)
+        return result, pos + 1
+
+    def array(self, pos):
+        # Survey replies are long arrays of small records, so this loop is
+        # kept tight: one C decode and one regex match per good element
+        text = self.text
+        result = []
+        pos = self.skip(pos)
+        if text.startswith(']', pos):
+            return result, pos + 1
+        while True:
+            if text.startswith('{', pos):
+                # Records, the usual element, skip the general value() dispatch
+                try:
+                    item, pos = _scan_once(text, pos)
+                except (StopIteration, json.JSONDecodeError):
+                    item, pos = self.object(pos + 1)
+            else:
+                item, pos = self.value(pos)
+            result.append(item)
+            match = _ARRAY_NEXT.match(text, pos)
+            if match is None:
+                raise self.error("Expecting ',' delimiter", pos)
+            pos = match.end()
+            if match.lastindex:
+                return result, pos
+
+    def bare(self, pos, key):
+        # An unquoted value runs to the closing bracket, or to the comma that
+        # starts the next element
+        in_object = key is not None
+        bare_end = _BARE_VALUE_END if in_object else _BARE_END
+        end = pos
+        while True:
+            match = bare_end.search(self.text, end)
+            if match is None:
+                end = len(self.text)
+                break
+            end = match.start()
+            if (self.text[end] != ',' or not in_object or _NEXT_KEY.match(self.text, end)
+                    or self.text.startswith('}', self.skip(end + 1))):
+                break
+            end += 1
+
+        token = self.text[pos:end].strip()
+        if not token:
+            raise self.error("Expecting value", pos)
+        if token.lower() in _LITERALS:
+            return _LITERALS[token.lower()], end
+        if _NUMBER.fullmatch(token) and (not in_object or key in _NUMBER_KEYS):
+            number = float(token) if any(c in token for c in '.eE') else int(token)
+            return number, end
+        return token, end
@@ -0,0 +1,290 @@
+import os
+import sys
+import glob
+import json
+import time
+import asyncio
+import logging
+import argparse
+import contextlib
+
+from tqdm import tqdm
+
+import vision_common
+import vision_async
+import rate_limiter
+import batch_planner
+import manifest as job_manifest
+import response_cache
+import metrics
+import hedging
+import log_setup
+import page_classifier
+import dedup
+import streaming
+
+
+class Job:
+    # One input folder, its output folder and extraction mode. While jobs
+    # compete for the quota, each gets a share in proportion to its weight.
+
+    def __init__(self, name, folder_path, output_directory, mode='ndl', weight=1.0):
+        if mode not in vision_common.PROMPTS:
+            raise ValueError(f"Unknown mode {mode!r} for job {name}")
+        if weight <= 0:
+            raise ValueError(f"Weight for job {name} must be positive")
+        self.name = name
+        self.folder_path = folder_path
+        self.output_directory = output_directory
+        self.mode = mode
+        self.weight = weight
+        self.planner = None
+        self.manifest = None
+        self.queue = None
+        self.deduplicator = None
+        self.sink = None
+        self.virtual_time = 0.0
+        self.pages_done = 0
+        self.batches_done = 0
+        self.batches_failed = 0
+        self.started = None
+        self.finished = None
+
+    def start(self, planner, resume=False, retry_failed=False, deduplicator=None,
+              classifier=None):
+        image_files = glob.glob(os.path.join(self.folder_path, '*.jpg'))
+        image_files.sort()
+        if not image_files and not (resume or retry_failed):
+            logging.warning(f"No JPG files found for job {self.name} in {self.folder_path}")
+        if classifier is not None:
+            image_files = classifier.filter(image_files, self.mode)
+            classifier.write_report(self.output_directory)
+        if deduplicator is not None:
+            image_files = deduplicator.filter(image_files)
+        os.makedirs(self.output_directory, exist_ok=True)
+        self.planner = planner
+        self.deduplicator = deduplicator
+        self.manifest = job_manifest.JobManifest(os.path.join(
+            self.output_directory, job_manifest.MANIFEST_FILE_NAME))
+        self.queue = batch_planner.BatchQueue(planner, self.output_directory, image_files,
+                                              self.manifest, resume, retry_failed)
+        self.started = time.monotonic()
+
+    def cost(self, batch):
+        # Estimated tokens the batch takes from the shared token limit
+        return (self.planner.prompt_tokens + self.planner.max_tokens +
+                sum(self.planner.page_tokens(image_path) for image_path in batch))
+
+    def progress(self, now=None):
+        now = self.finished or now or time.monotonic()
+        elapsed = now - self.started
+        total = self.queue.total_pages
+        rate = self.pages_done / elapsed if elapsed > 0 else 0.0
+        remaining = total - self.pages_done
+        if not remaining:
+            eta = 0.0
+        else:
+            eta = remaining / rate if rate else None
+        return {
+            'job': self.name, 'mode': self.mode, 'weight': self.weight,
+            'pages_done': self.pages_done, 'pages_total': total,
+            'batches_done': self.batches_done, 'batches_failed': self.batches_failed,
+            'pages_per_second': rate,
+            'eta_seconds': eta,
+            'finished': self.finished is not None,
+        }
+
+
+class FairShare:
+    # Start-time fair queueing. Each dispatch charges the job its batch's
+    # estimated tokens divided by its weight, and the ready job with the
+    # least charged goes next. A job that was idle, or joins late, starts
+    # from the current virtual time rather than from zero, so it can't
+    # claim the whole quota to catch up.
+
+    def __init__(self):
+        self.clock = 0.0
+
+    def pick(self, jobs):
+        ready = [job for job in jobs if job.queue]
+        if not ready:
+            return None
+        return min(ready, key=lambda job: max(job.virtual_time, self.clock))
+
+    def charge(self, job, cost):
+        start = max(job.virtual_time, self.clock)
+        job.virtual_time = start + cost / job.weight
+        self.clock = start
+
+
+def format_eta(seconds):
+    if seconds is None:
+        return '?'
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}h{minutes:02d}m" if hours else f"{minutes}m{seconds:02d}s"
+
+
+def report(jobs, status_path=None):
+    now = time.monotonic()
+    progress = [job.progress(now) for job in jobs]
+    for entry in progress:
+        logging.info("Job %s: %s/%s pages, %.2f pages/s, ETA %s", entry['job'],
+                     entry['pages_done'], entry['pages_total'], entry['pages_per_second'],
+                     format_eta(entry['eta_seconds']))
+    if status_path:
+        job_manifest.write_json_atomic(status_path, {'updated_at': time.time(), 'jobs': progress})
+    return progress
+
+
+async def run_jobs(jobs, api_key, concurrency=8, make_planner=None, cache=None, resume=False,
+                   retry_failed=False, make_deduplicator=None, report_interval=30,
+                   status_path=None, stream=False, make_classifier=None):
+    # Keeps up to `concurrency` batches in flight across every job. Requests
+    # share the process-wide rate limiter; the free slots go to jobs by
+    # weighted fair share of estimated tokens.
+    if make_planner is None:
+        make_planner = batch_planner.BatchPlanner
+    for job in jobs:
+        deduplicator = make_deduplicator() if make_deduplicator is not None else None
+        classifier = make_classifier() if make_classifier is not None else None
+        job.start(make_planner(vision_common.PROMPTS[job.mode]), resume, retry_failed,
+                  deduplicator, classifier)
+        if stream:
+            job.sink = streaming.RecordSink(
+                os.path.join(job.output_directory, streaming.SINK_FILE_NAME),
+                append=resume or retry_failed)
+
+    share = FairShare()
+    running = {}
+    last_report = time.monotonic()
+    async with contextlib.AsyncExitStack() as stack:
+        for job in jobs:
+            if job.sink is not None:
+                stack.callback(job.sink.close)
+        clients = {}
+        for mode in sorted({job.mode for job in jobs}):
+            clients[mode] = await stack.enter_async_context(
+                vision_async.VisionClient(api_key, mode, concurrency, cache=cache, stream=stream))
+
+        bars = [stack.enter_context(tqdm(total=job.queue.total_pages, desc=job.name, position=i))
+                for i, job in enumerate(jobs)]
+        while running or any(job.queue for job in jobs):
+            while len(running) < concurrency:
+                job = share.pick(jobs)
+                if job is None:
+                    break
+                batch_number, batch = job.queue.take()
+                share.charge(job, job.cost(batch))
+                task = asyncio.ensure_future(clients[job.mode].process_batch(
+                    batch, job.output_directory, batch_number, job.sink))
+                running[task] = (job, batch_number, batch)
+
+            done, _ = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                job, batch_number, batch = running.pop(task)
+                data = batch_planner.batch_result(task, batch_number)
+                pages = job.queue.finish(batch_number, batch, data)
+                job.pages_done += pages
+                job.batches_done += 1
+                job.batches_failed += data is None
+                bars[jobs.index(job)].update(pages)
+                if not job.queue and not any(entry[0] is job for entry in running.values()):
+                    job.finished = time.monotonic()
+                    logging.info(f"Job {job.name} finished: {job.manifest.counts()}")
+
+            if time.monotonic() - last_report >= report_interval:
+                report(jobs, status_path)
+                last_report = time.monotonic()
+
+    for job in jobs:
+        if job.finished is None:
+            job.finished = time.monotonic()
+        if job.deduplicator is not None:
+            job.deduplicator.fan_out(job.output_directory, job.manifest)
+    if cache is not None:
+        cache.evict()
+    return report(jobs, status_path)
+
+
+def load_jobs(path):
+    # A JSON list of {"name", "folder", "output", "mode", "weight"}; name,
+    # mode and weight are optional
+    with open(path, 'r') as jobs_file:
+        definitions = json.load(jobs_file)
+    jobs = []
+    for i, definition in enumerate(definitions, 1):
+        jobs.append(Job(definition.get('name') or os.path.basename(os.path.normpath(definition['folder'])) or f"job{i}",
+                        definition['folder'], definition['output'],
+                        definition.get('mode', 'ndl'), float(definition.get('weight', 1))))
+    names = [job.name for job in jobs]
+    if len(set(names)) != len(names):
+        raise ValueError("Job names must be unique")
+    # Jobs sharing an output folder would share a manifest and batch numbers,
+    # and overwrite each other's batch files
+    outputs = [os.path.realpath(job.output_directory) for job in jobs]
+    if len(set(outputs)) != len(outputs):
+        raise ValueError("Job output folders must be different")
+    return jobs
+
+
+def main(jobs, api_key, concurrency=8, make_planner=None, cache=None, resume=False,
+         retry_failed=False, make_deduplicator=None, report_interval=30, status_path=None,
+         stream=False, make_classifier=None):
+    return asyncio.run(run_jobs(jobs, api_key, concurrency, make_planner, cache, resume,
+                                retry_failed, make_deduplicator, report_interval, status_path,
+                                stream, make_classifier))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Run several folders' OCR jobs at once under one shared API quota")
+    parser.add_argument("jobs_file",
+                        help='JSON list of {"name", "folder", "output", "mode", "weight"}')
+    parser.add_argument("--concurrency", type=int, default=8,
+                        help="batches allowed in flight at once, across all jobs")
+    parser.add_argument("--requests-per-minute", type=int, default=None,
+                        help="starting request limit, until the API's headers say otherwise")
+    parser.add_argument("--tokens-per-minute", type=int, default=None,
+                        help="starting token limit, until the API's headers say otherwise")
+    parser.add_argument("--report-interval", type=float, default=30,
+                        help="seconds between progress and ETA log lines")
+    parser.add_argument("--status-file", default=None,
+                        help="also write per-job progress to this JSON file")
+    parser.add_argument("--stream", action="store_true",
+                        help=f"stream replies, appending records to {streaming.SINK_FILE_NAME} "
+                             "in each job's output folder as they are read")
+    # Each job keeps its own manifest in its output folder
+    job_manifest.add_arguments(parser, path=False)
+    response_cache.add_arguments(parser)
+    page_classifier.add_arguments(parser)
+    dedup.add_arguments(parser)
+    batch_planner.add_arguments(parser)
+    metrics.add_arguments(parser)
+    hedging.add_arguments(parser)
+    log_setup.add_arguments(parser, 'scheduler.log')
+    args = parser.parse_args()
+    log_setup.from_args(args)
+    metrics.from_args(args)
+    hedging.from_args(args)
+
+    api_key = os.getenv('OPENAI_API_KEY')
+    if not api_key:
+        logging.error("OPENAI_API_KEY not set.")
+        sys.exit(1)
+
+    jobs = load_jobs(args.jobs_file)
+    logging.info(f"Scheduling {len(jobs)} jobs: " +
+                 ', '.join(f"{job.name} ({job.mode}, weight {job.weight:g})" for job in jobs))
+    rate_limiter.get_limiter().configure(args.requests_per_minute, args.tokens_per_minute)
+    cache = response_cache.from_args(args)
+    progress = main(jobs, api_key, args.concurrency,
+                    lambda prompt: batch_planner.from_args(args, prompt), cache,
+                    args.resume, args.retry_failed, lambda: dedup.from_args(args),
+                    args.report_interval, args.status_file, args.stream,
+                    lambda: page_classifier.from_args(args))
+    metrics.write_summary(args.metrics_summary or 'scheduler_metrics.json',
+                          concurrency=args.concurrency, jobs=progress)
+    logging.info("Script finished")
+
+# To run this script, type 'python3 scheduler.py PATH/TO/jobs.json' in the terminal
@@ -0,0 +1,198 @@
+import json
+
+import response_parser
+
+# Written next to the batch files
+SINK_FILE_NAME = 'records.jsonl'
+
+
+class RecordStream:
+    # Pulls records out of a model reply while it is still arriving. Text is
+    # scanned once, tracking braces outside strings; each top-level object
+    # is parsed as soon as it closes, so a record is usable as soon as the
+    # model has finished writing it.
+
+    def __init__(self):
+        self.text = ''
+        self.pos = 0
+        self.depth = 0
+        self.start = None
+        self.in_string = False
+        self.escaped = False
+        self.count = 0
+
+    def feed(self, delta):
+        # Returns the records completed by this piece of text
+        self.text += delta
+        records = []
+        text = self.text
+        for pos in range(self.pos, len(text)):
+            char = text[pos]
+            if self.in_string:
+                if self.escaped:
+                    self.escaped = False
+                elif char == '\\':
+                    self.escaped = True
+                elif char == '"':
+                    self.in_string = False
+            elif char == '"':
+                self.in_string = True
+            elif char == '{':
+                if self.depth == 0:
+                    self.start = pos
+                self.depth += 1
+            elif char == '}' and self.depth:
+                self.depth -= 1
+                if self.depth == 0:
+                    record = self.parse(text[self.start:pos + 1])
+                    if record is not None:
+                        records.append(record)
+        self.pos = len(text)
+        self.count += len(records)
+        return records
+
+    def parse(self, text):
+        # The final reply is parsed again as a whole, so an object that
+        # can't be read here is only left out of the stream
+        try:
+            record = response_parser.parse_content(text)
+        except json.JSONDecodeError:
+            return None
+        return record if isinstance(record, dict) else None
+
+
+class CompletionStream:
+    # Reads the server-sent events of a streamed chat completion and puts
+    # the response back together in the shape a non-streamed request
+    # returns, so the batch files, the cache and the planner see no
+    # difference. Tokens are estimated at four characters each as they
+    # arrive. Once the records so far show that a batch of `pages` can't
+    # fit in max_tokens, the stream is marked truncated without waiting for
+    # the model to run out of tokens.
+
+    def __init__(self, max_tokens, pages, headroom=1.0):
+        self.max_tokens = max_tokens
+        self.pages = pages
+        self.headroom = headroom
+        self.records = RecordStream()
+        self.data = {}
+        self.finish_reason = None
+        self.usage = None
+        self.done = False
+        self.cut = False
+
+    @property
+    def content(self):
+        return self.records.text
+
+    def feed_line(self, line):
+        # One line of the event stream; returns the records it completed
+        if isinstance(line, bytes):
+            line = line.decode('utf-8')
+        line = line.strip()
+        if not line.startswith('data:'):
+            return []
+        event = line[len('data:'):].strip()
+        if event == '[DONE]':
+            self.done = True
+            return []
+        chunk = json.loads(event)
+        if 'error' in chunk:
+            raise RuntimeError(f"Error in response stream: {chunk['error'].get('message')}")
+        if not self.data:
+            self.data = {key: chunk.get(key) for key in ('id', 'created', 'model')}
+        if chunk.get('usage'):
+            self.usage = chunk['usage']
+        records = []
+        for choice in chunk.get('choices') or []:
+            if choice.get('index', 0) != 0:
+                continue
+            delta = (choice.get('delta') or {}).get('content')
+            if delta:
+                records = self.records.feed(delta)
+            if choice.get('finish_reason'):
+                self.finish_reason = choice['finish_reason']
+        if records and self.finish_reason is None and self.overflowing():
+            self.cut = True
+            self.finish_reason = 'length'
+        return records
+
+    def overflowing(self):
+        # Projects the tokens the batch will need from the records so far
+        tokens = len(self.content) / 4
+        remaining = self.pages - self.records.count
+        if remaining <= 0:
+            return False
+        projected = tokens + remaining * tokens / self.records.count
+        return projected > self.max_tokens * self.headroom
+
+    @property
+    def finished(self):
+        return self.done or self.cut
+
+    def result(self):
+        data = dict(self.data, object='chat.completion', choices=[{
+            'index': 0, 'finish_reason': self.finish_reason,
+            'message': {'role': 'assistant', 'content': self.content}}])
+        if self.usage is not None:
+            data['usage'] = self.usage
+        return data
+
+
+class RecordSink:
+    # Appends each record to a JSONL file as soon as it is parsed, tagged
+    # with its batch number. Records from a batch that is later split or
+    # fails are withdrawn by a "discarded" line; read_records() leaves them
+    # out. A fresh run numbers its batches from 1 again, so it starts a new
+    # file; append=True carries on from the last run, for --resume and
+    # --retry-failed. Each run marks where a batch's lines start, so the
+    # records a run wrote before dying part way through a batch are dropped
+    # once the batch is sent again.
+
+    def __init__(self, path, append=False):
+        self.path = path
+        self.file = open(path, 'a' if append else 'w', encoding='utf-8')
+        self.started = set()
+
+    def line(self, entry):
+        if entry['batch'] not in self.started:
+            self.started.add(entry['batch'])
+            self.file.write(json.dumps({'batch': entry['batch'], 'started': True}) + '\n')
+        self.file.write(json.dumps(entry) + '\n')
+        self.file.flush()
+
+    def write(self, batch_number, record):
+        self.line({'batch': batch_number, 'record': record})
+
+    def write_response(self, batch_number, data):
+        # The records of a whole reply, e.g. one served from the cache
+        try:
+            records = response_parser.parse_response(data)
+        except (json.JSONDecodeError, KeyError, IndexError, TypeError):
+            return
+        for record in records if isinstance(records, list) else [records]:
+            if isinstance(record, dict):
+                self.write(batch_number, record)
+
+    def discard(self, batch_number, reason):
+        self.line({'batch': batch_number, 'discarded': reason})
+
+    def close(self):
+        self.file.close()
+
+
+def read_records(path):
+    # The records in a sink, without those withdrawn since. A batch that is
+    # retried keeps its number, so a discard or a later start only drops the
+    # lines before it.
+    batches = {}
+    with open(path, 'r', encoding='utf-8') as sink_file:
+        for line in sink_file:
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            if 'discarded' in entry or 'started' in entry:
+                batches[entry['batch']] = []
+            else:
+                batches.setdefault(entry['batch'], []).append(entry['record'])
+    return [record for records in batches.values() for record in records]
@@ -0,0 +1,54 @@
+import os
+import json
+
+import pytest
+
+import batch_api
+import json2csv_ndl
+import vision_common
+import manifest as job_manifest
+from batch_planner import BatchPlanner
+
+
+@pytest.fixture
+def page_count():
+    return 5
+
+
+def test_batch_results_land_in_batch_files(pages, tmp_path, mock_api):
+    server = mock_api(batch_delay=0.05)
+    output_directory = str(tmp_path / 'outputs')
+    os.makedirs(output_directory)
+    manifest = job_manifest.JobManifest(os.path.join(output_directory, job_manifest.MANIFEST_FILE_NAME))
+    # Two requests per input file, so the three batches go in two jobs
+    batch_api.run(pages, 'key', output_directory,
+                  planner=BatchPlanner(vision_common.NDL_PROMPT, max_pages=2),
+                  manifest=manifest, poll_interval=0.01, max_requests=2)
+
+    assert server.stats['batch_jobs'] == 2
+    assert server.stats['batch_requests'] == 3
+    # None of it went through the rate-limited endpoint
+    assert server.stats['requests'] == 0
+    assert manifest.counts() == {job_manifest.DONE: 3}
+
+    records = []
+    for batch_number in (1, 2, 3):
+        records.extend(json2csv_ndl.parse_json_file(
+            vision_common.batch_output_path(output_directory, batch_number)))
+    assert sorted(r['memorial_number'] for r in records) == [1, 2, 3, 4, 5]
+    # Every job was collected, so there is nothing left to resume
+    with open(os.path.join(output_directory, batch_api.WORK_DIR_NAME, batch_api.JOBS_FILE_NAME)) as f:
+        assert json.load(f)['jobs'] == []
+
+
+def test_requests_file_lines_are_chat_requests(pages, tmp_path):
+    image_paths = sorted(os.path.join(pages, name) for name in os.listdir(pages))
+    files = batch_api.write_requests([(7, image_paths[:2]), (8, image_paths[2:])],
+                                     vision_common.NDL_PROMPT, str(tmp_path))
+
+    assert [numbers for _, numbers in files] == [[7, 8]]
+    with open(files[0][0]) as jsonl_file:
+        lines = [json.loads(line) for line in jsonl_file]
+    assert [line['custom_id'] for line in lines] == ['batch-7', 'batch-8']
+    assert lines[0]['url'] == batch_api.ENDPOINT
+    assert len(lines[1]['body']['messages'][0]['content']) == 1 + 3
@@ -0,0 +1,97 @@
+import asyncio
+from collections import deque
+
+import pytest
+from PIL import Image
+
+import batch_planner
+import manifest as job_manifest
+import vision_common
+
+
+@pytest.fixture
+def pages(tmp_path):
+    # 1024x1024 pages cost 765 image tokens each
+    paths = []
+    for i in range(1, 9):
+        path = tmp_path / f'page_{i}.jpg'
+        Image.new('RGB', (1024, 1024), 'white').save(path)
+        paths.append(str(path))
+    return paths
+
+
+def test_packs_to_token_budget(pages):
+    planner = batch_planner.BatchPlanner('', token_budget=2400, output_tokens_per_page=100)
+    assert [len(batch) for batch in planner.plan(pages)] == [3, 3, 2]
+
+
+def test_packs_to_output_budget(pages):
+    # 1500 * 0.8 / 400 leaves room for three pages of output
+    planner = batch_planner.BatchPlanner('', token_budget=100000, max_tokens=1500,
+                                         output_tokens_per_page=400)
+    assert planner.next_batch(deque(pages)) == pages[:3]
+
+
+def test_shrinks_on_truncation_and_grows_with_headroom(pages):
+    planner = batch_planner.BatchPlanner('', token_budget=100000, max_tokens=1500,
+                                         output_tokens_per_page=200)
+    batch = planner.next_batch(deque(pages))
+    assert len(batch) == 6
+
+    truncated = {'choices': [{'finish_reason': 'length'}], 'usage': {'completion_tokens': 1500}}
+    assert planner.record(batch, truncated) is True
+    assert planner.pages_for_output() < 6
+
+    smaller = planner.pages_for_output()
+    short = {'choices': [{'finish_reason': 'stop'}], 'usage': {'completion_tokens': 60}}
+    for _ in range(10):
+        assert planner.record(pages[:smaller], short) is False
+    assert planner.pages_for_output() > smaller
+
+
+def test_run_batches_requeues_truncated_batch(pages, tmp_path):
+    planner = batch_planner.BatchPlanner('', token_budget=100000, max_tokens=1500,
+                                         output_tokens_per_page=300)
+    sent = []
+
+    def process_batch(batch, batch_number):
+        sent.append(list(batch))
+        (tmp_path / f'output_batch_{batch_number}.json').write_text('{}')
+        finish_reason = 'length' if len(batch) > 2 else 'stop'
+        return {'choices': [{'finish_reason': finish_reason}]}
+
+    batch_planner.run_batches(process_batch, pages, planner, str(tmp_path))
+    # The first batch of four is cut off and its pages are sent again in
+    # smaller batches; every page is covered exactly once by a kept batch
+    assert len(sent[0]) == 4
+    kept = [page for batch in sent[1:] for page in batch]
+    assert kept == pages
+    assert (tmp_path / 'output_batch_1.json.truncated').exists()
+    assert not (tmp_path / 'output_batch_1.json').exists()
+
+
+def test_truncated_combined_batch_is_discarded_from_every_layout(tmp_path):
+    content = '[{"memorial_number": 1, "name": "John Doe", "inscription": "R.I.P."}]'
+    data = {'choices': [{'finish_reason': 'length', 'message': {'content': content}}]}
+    vision_common.write_batch_output(data, str(tmp_path), 3, 'combined')
+    batch_planner.discard_truncated_output(str(tmp_path), 3)
+    for folder in (tmp_path, tmp_path / 'ndl', tmp_path / 'transcript'):
+        assert not (folder / 'output_batch_3.json').exists()
+        assert (folder / 'output_batch_3.json.truncated').exists()
+
+
+def test_batch_that_raises_is_recorded_as_failed(pages, tmp_path):
+    planner = batch_planner.BatchPlanner('', token_budget=100000, max_pages=2)
+    manifest = job_manifest.JobManifest(str(tmp_path / 'manifest.json'))
+
+    async def process_batch(batch, batch_number):
+        if batch_number == 2:
+            # As if preprocessing the batch's images failed
+            raise OSError("cannot identify image file")
+        await asyncio.sleep(0.01)
+        return {'choices': [{'finish_reason': 'stop'}]}
+
+    results = asyncio.run(batch_planner.run_batches_async(
+        process_batch, pages, planner, str(tmp_path), 2, manifest))
+    assert len(results) == 4 and results.count(None) == 1
+    assert manifest.counts() == {'done': 3, 'failed': 1}
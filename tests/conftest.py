@@ -0,0 +1,39 @@
+import pytest
+
+import benchmark
+import metrics
+import mock_openai
+import rate_limiter
+import vision_common
+
+
+@pytest.fixture
+def page_count():
+    # Override in a test module for a different number of pages
+    return 4
+
+
+@pytest.fixture
+def pages(tmp_path, page_count):
+    folder = tmp_path / 'pages'
+    benchmark.make_pages(str(folder), page_count, size=(600, 800))
+    return str(folder)
+
+
+@pytest.fixture
+def mock_api(monkeypatch):
+    servers = []
+
+    def start(**options):
+        server = mock_openai.MockOpenAI(**options).start()
+        servers.append(server)
+        monkeypatch.setattr(vision_common, 'API_URL', server.url)
+        monkeypatch.setattr(vision_common, 'API_BASE_URL', server.base_url)
+        return server
+
+    rate_limiter.reset_limiter()
+    metrics.reset()
+    yield start
+    for server in servers:
+        server.stop()
+    rate_limiter.reset_limiter()
@@ -0,0 +1,67 @@
+import os
+import json
+import random
+
+from PIL import Image, ImageDraw
+
+import benchmark
+import dedup
+import manifest as job_manifest
+
+
+def make_page(path, seed, size=(600, 800), quality=80):
+    rng = random.Random(seed)
+    image = Image.new('RGB', size, (245, 242, 235))
+    draw = ImageDraw.Draw(image)
+    for _ in range(12):
+        x, y = rng.randrange(size[0] - 200), rng.randrange(size[1] - 100)
+        draw.rectangle((x, y, x + rng.randint(40, 200), y + rng.randint(20, 100)), fill=(40, 40, 40))
+    image.save(path, 'JPEG', quality=quality)
+
+
+def test_bk_tree_finds_everything_within_distance():
+    rng = random.Random(1)
+    values = [rng.getrandbits(64) for _ in range(300)]
+    tree = dedup.BKTree()
+    for i, value in enumerate(values):
+        tree.add(value, i)
+    query = values[0] ^ 0b101
+    expected = sorted(i for i, value in enumerate(values) if dedup.hamming(query, value) <= 10)
+    assert sorted(tree.search(query, 10)) == expected
+    assert 0 in expected
+
+
+def test_rescans_are_clustered_and_fanned_out(tmp_path):
+    pages = []
+    for name, seed, options in (('page_1.jpg', 1, {}),
+                                ('page_2.jpg', 2, {}),
+                                # A re-encode and a slightly smaller rescan of page 1
+                                ('page_3.jpg', 1, {'quality': 40}),
+                                ('page_4.jpg', 1, {'size': (590, 787)})):
+        path = str(tmp_path / name)
+        make_page(path, seed, **options)
+        pages.append(path)
+
+    deduplicator = dedup.Deduplicator(workers=1)
+    assert deduplicator.filter(pages) == pages[:2]
+    assert deduplicator.clusters[pages[0]] == [pages[0], pages[2], pages[3]]
+
+    manifest = job_manifest.JobManifest(str(tmp_path / 'manifest.json'))
+    manifest.reset(pages[:2])
+    manifest.add_batch(1, pages[:2])
+    manifest.mark_done(1, 'output_batch_1.json')
+    deduplicator.fan_out(str(tmp_path), manifest)
+
+    with open(tmp_path / dedup.DUPLICATES_FILE_NAME) as f:
+        data = json.load(f)
+    assert list(data['clusters']) == [pages[0]]
+    assert data['pages'][pages[3]] == {'representative': pages[0],
+                                       'output_path': 'output_batch_1.json'}
+    assert os.path.basename(data['pages'][pages[1]]['representative']) == 'page_2.jpg'
+
+
+def test_pages_sharing_a_layout_are_kept(tmp_path):
+    # Same line starts, different line lengths: dhash alone can't tell them apart
+    benchmark.make_pages(str(tmp_path), 6, size=(600, 800))
+    pages = sorted(str(path) for path in tmp_path.glob('*.jpg'))
+    assert dedup.Deduplicator(workers=1).filter(pages) == pages
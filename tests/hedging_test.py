@@ -0,0 +1,180 @@
+import os
+import sys
+import time
+import asyncio
+import subprocess
+
+import pytest
+
+import benchmark
+import hedging
+import metrics
+import mock_openai
+import rate_limiter
+import vision_async
+import vision_common
+import vision_ndl
+from batch_planner import BatchPlanner
+
+
+@pytest.fixture
+def hedger():
+    rate_limiter.reset_limiter()
+    metrics.reset()
+    hedger = hedging.configure(hedge=True, max_fraction=0.5)
+    # Enough history that a request taking over 10ms is a straggler
+    for _ in range(hedger.min_samples):
+        hedger.observe(0.01)
+    yield hedger
+    hedging.configure()
+    rate_limiter.reset_limiter()
+
+
+def test_hedge_wins_over_a_straggler(hedger):
+    calls = []
+
+    def attempt():
+        calls.append(1)
+        if len(calls) == 1:
+            time.sleep(1)
+            return 'straggler'
+        return 'hedge'
+
+    started = time.monotonic()
+    assert hedger.run(attempt, 100) == 'hedge'
+    assert time.monotonic() - started < 0.5
+    assert metrics.get_registry().counter_total('vision_hedge_wins_total') == 1
+
+
+SCRIPT = """
+import time
+import hedging
+
+hedger = hedging.configure(hedge=True, max_fraction=1.0)
+for _ in range(hedger.min_samples):
+    hedger.observe(0.01)
+calls = []
+
+def attempt():
+    calls.append(1)
+    if len(calls) == 1:
+        time.sleep(60)
+    return len(calls)
+
+print(hedger.run(attempt, 100))
+"""
+
+
+def test_losing_request_does_not_hold_the_script_open():
+    started = time.monotonic()
+    result = subprocess.run([sys.executable, '-c', SCRIPT], capture_output=True, text=True,
+                            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                            timeout=30)
+    assert result.stdout.strip() == '2'
+    assert time.monotonic() - started < 20
+
+
+def test_hedges_are_capped_and_only_use_spare_quota(hedger):
+    hedger.max_fraction = 0.1
+    for _ in range(10):
+        hedger.run(lambda: time.sleep(0.05), 100)
+    assert metrics.get_registry().counter_total('vision_hedges_total') == 1
+
+    hedger.max_fraction = 1.0
+    rate_limiter.get_limiter().release(0, {'x-ratelimit-limit-requests': '60',
+                                           'x-ratelimit-remaining-requests': '0',
+                                           'x-ratelimit-reset-requests': '60s'})
+    hedger.run(lambda: time.sleep(0.05), 100)
+    assert metrics.get_registry().counter_total('vision_hedges_total') == 1
+
+
+def test_async_hedge_cancels_the_loser(hedger):
+    delays = iter([1, 0])
+    cancelled = []
+
+    async def attempt():
+        delay = next(delays)
+        try:
+            await asyncio.sleep(delay)
+        except asyncio.CancelledError:
+            cancelled.append(delay)
+            raise
+        return delay
+
+    async def run():
+        result = await hedger.run_async(attempt, 100)
+        await asyncio.sleep(0)
+        return result
+
+    assert asyncio.run(run()) == 0
+    assert cancelled == [1]
+
+
+def test_rate_limited_hedge_does_not_beat_the_primary(hedger):
+    # The hedge gets a fast 429; the primary's slower success is kept
+    delays = iter([0.3, 0])
+
+    def attempt():
+        delay = next(delays)
+        time.sleep(delay)
+        return (200 if delay else 429), delay
+
+    def ok(result):
+        return result[0] == 200
+
+    observed = len(hedger.latencies)
+    assert hedger.run(attempt, 100, accept=ok) == (200, 0.3)
+    assert metrics.get_registry().counter_total('vision_hedges_total') == 1
+    assert metrics.get_registry().counter_total('vision_hedge_wins_total') == 0
+    # Only the success was measured
+    assert len(hedger.latencies) == observed + 1
+
+    async_delays = iter([0.3, 0])
+
+    async def attempt_async():
+        delay = next(async_delays)
+        await asyncio.sleep(delay)
+        return (200 if delay else 429), delay
+
+    assert asyncio.run(hedger.run_async(attempt_async, 100, accept=ok)) == (200, 0.3)
+    assert metrics.get_registry().counter_total('vision_hedge_wins_total') == 0
+
+
+def test_stragglers_are_hedged_end_to_end(tmp_path, hedger, monkeypatch):
+    pages = str(tmp_path / 'pages')
+    benchmark.make_pages(pages, 12, size=(600, 800))
+    # History well above the mock's normal latency, so only the stalled
+    # requests are hedged and the cap isn't spent on the rest
+    for _ in range(hedger.min_samples):
+        hedger.observe(0.3)
+    # Every fourth request stalls for far longer than the rest take
+    with mock_openai.MockOpenAI(latency=0.02, stall_every=4, stall_latency=5) as server:
+        monkeypatch.setattr(vision_common, 'API_URL', server.url)
+        started = time.monotonic()
+        results = vision_async.main(pages, 'key', str(tmp_path / 'outputs'), concurrency=2,
+                                    planner=BatchPlanner(vision_common.NDL_PROMPT, max_pages=1))
+        elapsed = time.monotonic() - started
+    assert len(results) == 12 and None not in results
+    # Each of the three stalls would cost 5s on its own
+    assert elapsed < 4
+    assert metrics.get_registry().counter_total('vision_hedge_wins_total') >= 1
+    # Cancelled losers are counted as errors next to the HTTP codes
+    counters = metrics.get_registry().summary()['counters']
+    assert counters['vision_requests_total{status="200"}'] == 12
+
+
+def test_read_timeout_fails_a_stalled_batch(tmp_path, monkeypatch):
+    rate_limiter.reset_limiter()
+    hedging.configure(read_timeout=0.2)
+    benchmark.make_pages(str(tmp_path), 1, size=(600, 800))
+    [page] = [str(path) for path in tmp_path.glob('*.jpg')]
+    try:
+        with mock_openai.MockOpenAI(latency=2) as server:
+            monkeypatch.setattr(vision_common, 'API_URL', server.url)
+            started = time.monotonic()
+            assert vision_ndl.process_images([page], 'key', str(tmp_path), 1) is None
+            assert time.monotonic() - started < 1.5
+        assert not os.path.exists(vision_common.batch_output_path(str(tmp_path), 1))
+    finally:
+        hedging.configure()
+        rate_limiter.reset_limiter()
@@ -0,0 +1,48 @@
+import json
+import logging
+
+import pytest
+
+import log_setup
+
+
+@pytest.fixture
+def restore_logging():
+    root = logging.getLogger()
+    handlers, level = list(root.handlers), root.level
+    yield
+    log_setup.shutdown()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    for handler in handlers:
+        root.addHandler(handler)
+    root.setLevel(level)
+
+
+def test_json_lines_with_batch_fields(tmp_path, restore_logging):
+    log_file = tmp_path / 'vision.log'
+    image = tmp_path / 'page_1.jpg'
+    image.write_bytes(b'x' * 100)
+
+    log_setup.configure(str(log_file), 'INFO', 'json')
+    logging.debug("Encoding image: %s", image)
+    log_setup.log_batch(7, [str(image)], 0, {'usage': {'total_tokens': 1234}}, retries=2)
+    log_setup.shutdown()
+
+    lines = log_file.read_text().splitlines()
+    # The debug line is filtered out before it is ever formatted
+    assert len(lines) == 1
+    entry = json.loads(lines[0])
+    assert entry['msg'] == 'Batch 7 ok'
+    assert (entry['batch'], entry['images'], entry['bytes'], entry['tokens'], entry['retries']) == \
+        (7, 1, 100, 1234, 2)
+
+
+def test_text_format_appends_fields(tmp_path, restore_logging):
+    log_file = tmp_path / 'vision.log'
+    log_setup.configure(str(log_file), 'DEBUG')
+    log_setup.log_batch(3, [], 0)
+    log_setup.shutdown()
+
+    line = log_file.read_text().strip()
+    assert 'WARNING:Batch 3 failed batch=3 status=failed images=0' in line
@@ -0,0 +1,75 @@
+import os
+
+import pytest
+from PIL import Image
+
+import batch_planner
+import manifest as job_manifest
+import vision_ndl
+
+
+@pytest.fixture
+def manifest_path(tmp_path):
+    return str(tmp_path / job_manifest.MANIFEST_FILE_NAME)
+
+
+def test_record_and_resume(manifest_path):
+    images = [f'page_{i}.jpg' for i in range(1, 9)]
+    manifest = job_manifest.JobManifest(manifest_path)
+    assert job_manifest.start_run(manifest, images) == ([], images)
+
+    manifest.add_batch(1, images[0:3])
+    manifest.mark_running(1)
+    manifest.mark_done(1, 'output_batch_1.json')
+    manifest.add_batch(2, images[3:6])
+    manifest.mark_running(2)
+    manifest.mark_failed(2, 'boom')
+    manifest.add_batch(3, images[6:7])
+    manifest.mark_running(3)
+
+    # A new process sees the same state from disk
+    reloaded = job_manifest.JobManifest(manifest_path)
+    assert reloaded.batches[2]['attempts'] == 1
+    assert reloaded.batches[2]['error'] == 'boom'
+    assert reloaded.incomplete(resume=True) == [(3, ['page_7.jpg'])]
+    assert reloaded.incomplete(resume=False, retry_failed=True) == [
+        (2, ['page_4.jpg', 'page_5.jpg', 'page_6.jpg'])]
+    # Resuming replays batch 3 and still has page 8 to batch
+    assert job_manifest.start_run(reloaded, [], resume=True) == (
+        [(3, ['page_7.jpg'])], ['page_8.jpg'])
+    assert reloaded.next_batch_number() == 4
+
+    # Pages of a split batch need batching again
+    reloaded.mark_split(3)
+    assert reloaded.unbatched_pages() == ['page_7.jpg', 'page_8.jpg']
+
+    # Only the manifest itself is left behind, no temporary files
+    assert os.listdir(os.path.dirname(manifest_path)) == [job_manifest.MANIFEST_FILE_NAME]
+
+
+def test_main_retries_only_failed_batches(tmp_path, manifest_path, monkeypatch):
+    for i in range(1, 7):
+        Image.new('RGB', (1024, 1024)).save(tmp_path / f'page_{i}.jpg')
+    calls = []
+
+    def process_images(image_paths, api_key, output_directory, batch_number, cache=None,
+                       preprocessor=None):
+        calls.append(batch_number)
+        # Batch 2 fails the first time round
+        if batch_number == 2 and calls.count(2) == 1:
+            return None
+        return {'choices': []}
+
+    monkeypatch.setattr(vision_ndl, 'process_images', process_images)
+    manifest = job_manifest.JobManifest(manifest_path)
+    planner = batch_planner.BatchPlanner('prompt', max_pages=3)
+    vision_ndl.main(str(tmp_path), 'key', str(tmp_path), manifest=manifest, planner=planner)
+    assert calls == [1, 2]
+    assert manifest.counts() == {'done': 1, 'failed': 1}
+
+    manifest = job_manifest.JobManifest(manifest_path)
+    vision_ndl.main(str(tmp_path), 'key', str(tmp_path), manifest=manifest,
+                    resume=True, retry_failed=True, planner=planner)
+    assert calls == [1, 2, 2]
+    assert manifest.counts() == {'done': 2}
+    assert manifest.batches[2]['attempts'] == 2
@@ -0,0 +1,63 @@
+import json
+import urllib.request
+
+import pytest
+
+import benchmark
+import metrics
+import mock_openai
+import rate_limiter
+import vision_async
+import vision_common
+from batch_planner import BatchPlanner
+
+
+@pytest.fixture
+def registry():
+    metrics.reset()
+    yield metrics.get_registry()
+    metrics.reset()
+
+
+def test_histogram_quantiles():
+    histogram = metrics.Histogram((1, 2, 5))
+    for value in (0.5, 0.5, 1.5, 4, 10):
+        histogram.observe(value)
+    assert histogram.counts == [2, 1, 1, 1]
+    assert histogram.quantile(0.5) == pytest.approx(1.5)
+    assert histogram.quantile(1.0) == 5
+
+
+def test_run_metrics_endpoint_and_summary(registry, tmp_path, monkeypatch):
+    pages = tmp_path / 'pages'
+    benchmark.make_pages(str(pages), 4, size=(600, 800))
+    output_directory = tmp_path / 'outputs'
+    rate_limiter.reset_limiter()
+    with mock_openai.MockOpenAI(burst_every=3, burst_length=1, burst_reset=0.05) as server:
+        monkeypatch.setattr(vision_common, 'API_URL', server.url)
+        vision_async.main(str(pages), 'key', str(output_directory), concurrency=2,
+                          planner=BatchPlanner(vision_common.NDL_PROMPT, max_pages=1))
+    rate_limiter.reset_limiter()
+
+    assert registry.counter_total('vision_images_total') == 4
+    assert registry.counter_total('vision_rate_limited_total') == server.stats['rate_limited'] > 0
+    assert registry.counter_total('vision_retries_total') == server.stats['rate_limited']
+    assert registry.counter_total('vision_completion_tokens_total') == server.stats['completion_tokens']
+    assert registry.gauges['vision_batches_in_flight'] == 0
+
+    http_server = metrics.start_server(0)
+    try:
+        url = f"http://127.0.0.1:{http_server.server_address[1]}/metrics"
+        body = urllib.request.urlopen(url).read().decode()
+    finally:
+        http_server.shutdown()
+    assert 'vision_requests_total{status="200"} 4' in body
+    assert 'vision_request_seconds_count' in body
+
+    summary_path = tmp_path / '.vision_metrics.json'
+    metrics.write_summary(str(summary_path), mode='ndl')
+    with open(summary_path) as f:
+        summary = json.load(f)
+    assert summary['mode'] == 'ndl'
+    assert summary['counters']['vision_batches_total{status="ok"}'] == 4
+    assert summary['histograms']['vision_batch_seconds']['count'] == 4
@@ -0,0 +1,121 @@
+import os
+import json
+import random
+
+import pytest
+from PIL import Image, ImageDraw
+
+import benchmark
+import metrics
+import mock_openai
+import page_classifier
+import rate_limiter
+import vision_common
+import vision_ndl
+from batch_planner import BatchPlanner
+
+PAPER = (245, 242, 235)
+SIZE = (1240, 1754)
+
+
+def write_lines(draw, rng, box, rows, ink=(30, 30, 60)):
+    # Handwriting-like strokes along each of `rows` lines in the box
+    left, top, right, bottom = box
+    step = (bottom - top) / rows
+    for row in range(rows):
+        y = top + row * step + step * 0.3
+        x = left + 10
+        end = rng.randint((left + right) // 2, right - 10)
+        while x < end:
+            width = rng.randint(10, 40)
+            draw.line([(x, y + rng.randint(0, 12)), (x + width, y + rng.randint(0, 12))],
+                      fill=ink, width=3)
+            x += width + rng.randint(4, 14)
+
+
+def make_page(path, kind, seed=0):
+    rng = random.Random(seed)
+    width, height = SIZE
+    image = Image.new('RGB', SIZE, (190, 215, 240) if kind == 'separator' else PAPER)
+    draw = ImageDraw.Draw(image)
+    if kind == 'blank':
+        # Specks of dust
+        for _ in range(40):
+            draw.point((rng.randrange(width), rng.randrange(height)), fill=(120, 120, 120))
+    elif kind == 'bleed':
+        # Writing from the other side, showing through faintly
+        write_lines(draw, rng, (100, 200, width - 100, height - 200), 25, ink=(215, 212, 208))
+    elif kind == 'cover':
+        # A title block and a few lines under it
+        write_lines(draw, rng, (250, 400, width - 250, 900), 8)
+    elif kind == 'ndl':
+        top, bottom = 200, height - 150
+        columns = (80, 230, 600, 850, width - 80)
+        for x in columns:
+            draw.line([(x, top), (x, bottom)], fill=(0, 0, 0), width=3)
+        for y in range(top, bottom + 1, 70):
+            draw.line([(80, y), (width - 80, y)], fill=(0, 0, 0), width=2)
+        for y in range(top, bottom - 70, 70):
+            for left, right in zip(columns, columns[1:]):
+                write_lines(draw, rng, (left, y, right, y + 70), 1)
+    elif kind == 'transcript':
+        draw.rectangle((80, 150, width - 80, height - 150), outline=(0, 0, 0), width=3)
+        for y in range(260, height - 200, 60):
+            draw.line([(110, y), (width - 110, y)], fill=(150, 150, 150), width=2)
+        write_lines(draw, rng, (110, 200, width - 110, height - 260), 22)
+    image.save(path, 'JPEG', quality=80)
+    return path
+
+
+@pytest.mark.parametrize('kind, expected', [
+    ('blank', ('skip', 'blank')),
+    ('bleed', ('skip', 'blank')),
+    ('separator', ('skip', 'blank')),
+    ('cover', ('skip', 'cover')),
+    ('ndl', ('ndl', 'table')),
+    ('transcript', ('transcript', 'ruled lines')),
+])
+def test_pages_are_classified(tmp_path, kind, expected):
+    path = make_page(str(tmp_path / f'{kind}.jpg'), kind)
+    assert page_classifier.classify(page_classifier.page_features(path)) == expected
+
+
+def test_unplaced_pages_go_to_every_mode():
+    classifier = page_classifier.PageClassifier(route=True)
+    assert classifier.wanted(None, 'ndl') and classifier.wanted(None, 'transcript')
+    assert classifier.wanted('transcript', 'combined')
+    assert not classifier.wanted('transcript', 'ndl')
+    assert not classifier.wanted('skip', 'combined')
+    # Without routing, only skipped pages are left out
+    assert page_classifier.PageClassifier().wanted('transcript', 'ndl')
+
+
+def test_skipped_and_misrouted_pages_are_never_sent(tmp_path, monkeypatch):
+    pages = tmp_path / 'pages'
+    # Four pages with no ruled form, which every mode gets
+    benchmark.make_pages(str(pages), 4, size=(600, 800))
+    for kind in ('blank', 'cover', 'ndl', 'transcript'):
+        make_page(str(pages / f'{kind}.jpg'), kind)
+    output_directory = str(tmp_path / 'outputs')
+
+    rate_limiter.reset_limiter()
+    metrics.reset()
+    try:
+        with mock_openai.MockOpenAI() as server:
+            monkeypatch.setattr(vision_common, 'API_URL', server.url)
+            vision_ndl.main(str(pages), 'key', output_directory,
+                            planner=BatchPlanner(vision_common.NDL_PROMPT, max_pages=3),
+                            classifier=page_classifier.PageClassifier(route=True, workers=1))
+            assert server.stats['images'] == 5
+    finally:
+        rate_limiter.reset_limiter()
+
+    registry = metrics.get_registry()
+    assert registry.counter_total('vision_pages_classified_total') == 8
+    assert registry.counter_total('vision_pages_left_out_total') == 3
+    with open(os.path.join(output_directory, page_classifier.REPORT_FILE_NAME)) as f:
+        report = json.load(f)
+    classes = {os.path.basename(path): page['page_class'] for path, page in report['pages'].items()}
+    assert classes['blank.jpg'] == classes['cover.jpg'] == 'skip'
+    assert classes['transcript.jpg'] == 'transcript'
+    assert report['pages'][str(pages / 'ndl.jpg')]['reason'] == 'table'
@@ -1,27 +1,34 @@
 import pytest
 import os
+import shutil
+from PIL import Image
 # Update this line with the correct module name
-from pdf2jpg import convert_pdf_to_jpg
+from pdf2jpg import convert_pdf_to_jpg, split_page_ranges
 
 
 @pytest.fixture
-def setup_pdf_and_output():
-    # Setup a test PDF path and output folder
-    # Ensure you have a test PDF at this location
-    pdf_path = 'PATH_TO_PDF'
-    output_folder = 'PATH_TO_OUTPUT_FOLDER'
+def setup_pdf_and_output(tmp_path):
+    # A small three page PDF, written with Pillow
+    pdf_path = str(tmp_path / 'survey.pdf')
+    output_folder = str(tmp_path / 'pages')
+    pages = [Image.new('RGB', (200, 300), (255, 255, 255)) for _ in range(3)]
+    pages[0].save(pdf_path, save_all=True, append_images=pages[1:])
     yield pdf_path, output_folder
-    # Teardown after tests
-    if os.path.exists(output_folder):
-        for f in os.listdir(output_folder):
-            os.remove(os.path.join(output_folder, f))
-        os.rmdir(output_folder)
 
 
+@pytest.mark.skipif(shutil.which('pdftoppm') is None, reason="poppler is not installed")
 def test_convert_pdf_to_jpg(setup_pdf_and_output):
     pdf_path, output_folder = setup_pdf_and_output
     convert_pdf_to_jpg(pdf_path, output_folder)
 
-    # Add your test assertions here
+    assert sorted(os.listdir(output_folder)) == ['page_1.jpg', 'page_2.jpg', 'page_3.jpg']
 
 # Additional test functions can be added here
+
+
+def test_split_page_ranges():
+    # Ranges are contiguous, cover every page and are sized to the workers
+    assert split_page_ranges(10, 4) == [(1, 3), (4, 6), (7, 9), (10, 10)]
+    assert split_page_ranges(2, 8) == [(1, 1), (2, 2)]
+    assert split_page_ranges(7, 2, chunk_size=5) == [(1, 5), (6, 7)]
+    assert split_page_ranges(0, 4) == []
@@ -0,0 +1,69 @@
+import pytest
+
+import pipeline
+
+
+@pytest.fixture
+def fake_pages(monkeypatch):
+    # Replace rendering with a generator that records how far it runs ahead
+    state = {'rendered': 0, 'sent': 0, 'max_ahead': 0}
+
+    def iter_pdf_pages(pdf_path, output_folder, workers, chunk_size, dpi):
+        for i in range(10):
+            state['rendered'] += 1
+            state['max_ahead'] = max(state['max_ahead'],
+                                     state['rendered'] - state['sent'])
+            yield f'{output_folder}/page_{i + 1}.jpg'
+
+    monkeypatch.setattr(pipeline.pdf2jpg, 'iter_pdf_pages', iter_pdf_pages)
+    return state
+
+
+def test_run_pipeline_batches_pages(fake_pages, monkeypatch, tmp_path):
+    batches = []
+
+    def process_images(image_paths, api_key, output_directory, batch_number):
+        fake_pages['sent'] += len(image_paths)
+        batches.append((batch_number, image_paths))
+
+    monkeypatch.setitem(pipeline.MODES, 'ndl', process_images)
+    total = pipeline.run_pipeline('survey.pdf', 'pages', 'key', str(tmp_path),
+                                  batch_size=3, queue_depth=2)
+
+    # Ten pages make three full batches and one short one, in page order
+    assert total == 4
+    assert [n for n, _ in batches] == [1, 2, 3, 4]
+    assert [len(b) for _, b in batches] == [3, 3, 3, 1]
+    assert batches[0][1][0] == 'pages/page_1.jpg'
+    # Rendering never gets further ahead than the queue, the batch being
+    # built and the page in the renderer's hand
+    assert fake_pages['max_ahead'] <= 2 + 3 + 1
+
+
+class SkipLastPage:
+    # Stands in for a page classifier that finds page 7 blank
+    def keep(self, image_path, mode):
+        return not image_path.endswith('page_7.jpg')
+
+    def write_report(self, output_directory):
+        pass
+
+
+def test_delete_images_keeps_failed_batches(monkeypatch, tmp_path):
+    def iter_pdf_pages(pdf_path, output_folder, workers, chunk_size, dpi):
+        for i in range(7):
+            path = tmp_path / f'page_{i + 1}.jpg'
+            path.write_bytes(b'jpeg')
+            yield str(path)
+
+    def process_images(image_paths, api_key, output_directory, batch_number):
+        # The second batch fails
+        return None if batch_number == 2 else {'choices': []}
+
+    monkeypatch.setattr(pipeline.pdf2jpg, 'iter_pdf_pages', iter_pdf_pages)
+    monkeypatch.setitem(pipeline.MODES, 'ndl', process_images)
+    pipeline.run_pipeline('survey.pdf', str(tmp_path), 'key', str(tmp_path / 'outputs'),
+                          batch_size=3, keep_images=False, classifier=SkipLastPage())
+    # Only the failed batch is left; the skipped page went as soon as it was classified
+    assert sorted(path.name for path in tmp_path.glob('*.jpg')) == [
+        'page_4.jpg', 'page_5.jpg', 'page_6.jpg']
@@ -0,0 +1,51 @@
+import os
+
+import pytest
+from PIL import Image, ImageDraw
+
+import preprocess
+
+
+@pytest.fixture
+def scan(tmp_path):
+    # A white page with a block of "ink" well inside wide margins
+    image = Image.new('RGB', (2400, 3200), 'white')
+    draw = ImageDraw.Draw(image)
+    draw.rectangle((600, 800, 1800, 2400), fill=(20, 20, 20))
+    path = tmp_path / 'page_1.jpg'
+    image.save(path, 'JPEG', quality=95)
+    return str(path)
+
+
+def test_preprocess_image(scan, tmp_path):
+    cache_dir = str(tmp_path / 'cache')
+    output_path, stats = preprocess.preprocess_image(
+        scan, cache_dir, max_edge=512, grayscale=True, crop_margins=True, quality=70)
+
+    with Image.open(output_path) as output:
+        assert output.mode == 'L'
+        assert max(output.size) <= 512
+        # The margins are cropped, so the page is now roughly the ink block's shape
+        assert output.size[0] / output.size[1] == pytest.approx(1200 / 1600, rel=0.05)
+    assert stats['bytes_after'] < stats['bytes_before']
+    assert stats['tokens_after'] < stats['tokens_before']
+
+    # A second call with the same settings reuses the cached file
+    mtime = os.path.getmtime(output_path)
+    assert preprocess.preprocess_image(
+        scan, cache_dir, max_edge=512, grayscale=True, crop_margins=True, quality=70)[0] == output_path
+    assert os.path.getmtime(output_path) == mtime
+
+    # Different settings get their own entry
+    assert preprocess.preprocess_image(scan, cache_dir, max_edge=1024)[0] != output_path
+
+
+def test_preprocessor_prepare(scan, tmp_path):
+    preprocessor = preprocess.Preprocessor(str(tmp_path / 'cache'), max_edge=800, workers=2)
+    try:
+        paths = preprocessor.prepare([scan, scan], batch_number=1)
+    finally:
+        preprocessor.close()
+    assert len(paths) == 2 and paths[0] == paths[1]
+    with Image.open(paths[0]) as output:
+        assert max(output.size) == 800
@@ -0,0 +1,91 @@
+import pytest
+
+from rate_limiter import RateLimiter, is_exhausted, parse_duration
+from vision_common import estimate_image_tokens
+
+# Test the parse_duration function
+
+
+def test_parse_duration():
+    assert parse_duration('19.355s') == pytest.approx(19.355)
+    assert parse_duration('2h2m37.12s') == pytest.approx(7357.12)
+    assert parse_duration('6m0s') == 360
+    assert parse_duration('120ms') == pytest.approx(0.12)
+    assert parse_duration('1m30ms') == pytest.approx(60.03)
+    assert parse_duration(None) is None
+
+    with pytest.raises(ValueError):
+        parse_duration('soon')
+    with pytest.raises(ValueError):
+        parse_duration('5s later')
+
+# Test that headers drive the token bucket
+
+
+def test_limiter_waits_for_token_reset():
+    limiter = RateLimiter()
+    assert limiter.reserve(500) == 0
+    # 400 of 10000 tokens left, refilling fully over 9.6s (1000 tokens/s)
+    limiter.release(500, {
+        'x-ratelimit-limit-tokens': '10000',
+        'x-ratelimit-remaining-tokens': '400',
+        'x-ratelimit-reset-tokens': '9.6s',
+    })
+
+    wait = limiter.reserve(1400)
+    assert wait == pytest.approx(1.0, abs=0.05)
+    assert limiter.reserve(300) == 0
+
+
+def test_limiter_counts_requests_in_flight():
+    limiter = RateLimiter(requests_per_minute=60)
+    limiter.calibrated = True
+    assert limiter.reserve(10) == 0
+    assert limiter.reserve(10) == 0
+    # The server has only seen one of the two requests so far
+    limiter.release(10, {
+        'x-ratelimit-limit-requests': '60',
+        'x-ratelimit-remaining-requests': '2',
+        'x-ratelimit-reset-requests': '58s',
+    })
+    assert limiter.reserve(10) == 0
+    assert limiter.reserve(10) > 0
+
+
+def test_limit_of_zero_waits_for_the_reset():
+    limiter = RateLimiter(requests_per_minute=60)
+    limiter.calibrated = True
+    assert limiter.reserve(10) == 0
+    assert limiter.reserve(10) == 0
+    # One request still in flight when the server reports no quota at all
+    limiter.release(10, {
+        'x-ratelimit-limit-requests': '0',
+        'x-ratelimit-remaining-requests': '0',
+        'x-ratelimit-reset-requests': '2s',
+    })
+    assert limiter.reserve(10) == pytest.approx(2, abs=0.05)
+    # After the reset the bucket is unknown again, so a request can probe
+    assert limiter.requests.wait_time(1, limiter.requests.closed_until + 0.01) == 0
+
+
+def test_limiter_probes_until_first_response():
+    limiter = RateLimiter()
+    assert limiter.reserve(100) == 0
+    assert limiter.reserve(100) > 0
+    limiter.release(100, {})
+    assert limiter.reserve(100) == 0
+
+
+def test_is_exhausted():
+    assert is_exhausted({'x-ratelimit-remaining-tokens': '100'}, 500)
+    assert is_exhausted({'x-ratelimit-remaining-requests': '0'}, 1)
+    assert not is_exhausted({'x-ratelimit-remaining-tokens': '9000'}, 500)
+    assert not is_exhausted({}, 500)
+
+# Test the image token estimate
+
+
+def test_estimate_image_tokens():
+    assert estimate_image_tokens(1024, 1024) == 765
+    assert estimate_image_tokens(2048, 4096) == 1105
+    assert estimate_image_tokens(300, 200) == 255
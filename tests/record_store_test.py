@@ -0,0 +1,131 @@
+import os
+import json
+
+import pytest
+
+import record_store
+import vision_common
+
+
+def write_batches(folder, batches):
+    os.makedirs(folder, exist_ok=True)
+    for batch_number, records in enumerate(batches, 1):
+        data = {'choices': [{'message': {'content': '```json\n' + json.dumps(records) + '\n```'}}]}
+        vision_common.write_batch_output(data, folder, batch_number)
+
+
+@pytest.fixture
+def store(tmp_path):
+    ndl = str(tmp_path / 'ndl')
+    write_batches(ndl, [
+        [{'memorial_number': 1, 'name': 'John Doe', 'date': '1900', 'location': 'Ennis'},
+         {'memorial_number': 2, 'name': "Mary O'Brien", 'date': None, 'location': None}],
+        [{'memorial_number': None, 'name': 'Unknown Doe', 'date': None, 'location': None}],
+    ])
+    transcript = str(tmp_path / 'transcript')
+    write_batches(transcript, [[{'memorial_number': 1, 'inscription': 'IN LOVING MEMORY'}]])
+
+    store = record_store.RecordStore(str(tmp_path / 'records.sqlite'))
+    assert store.load_folder(ndl, 'ndl', 'kilnaboy', workers=1) == 3
+    assert store.load_folder(transcript, 'transcript', 'kilnaboy', workers=1) == 1
+    yield store
+    store.close()
+
+
+def test_layouts_merge_into_one_row_per_memorial(store):
+    [record] = store.find(memorial_number=1)
+    assert record == {'survey': 'kilnaboy', 'memorial_number': 1, 'name': 'John Doe',
+                      'surname': 'DOE', 'date': '1900', 'location': 'Ennis',
+                      'inscription': 'IN LOVING MEMORY'}
+    assert [r['name'] for r in store.find(surname="o'brien", survey='kilnaboy')] == ["Mary O'Brien"]
+
+
+def test_reloading_a_folder_does_not_duplicate(store, tmp_path):
+    store.load_folder(str(tmp_path / 'ndl'), 'ndl', 'kilnaboy', workers=1)
+    assert len(store.find(survey='kilnaboy')) == 3
+    assert [r['name'] for r in store.find(surname='doe')] == ['Unknown Doe', 'John Doe']
+
+
+def test_lookups_use_the_indexes(store):
+    plan = store.conn.execute(
+        'EXPLAIN QUERY PLAN SELECT * FROM memorials WHERE surname = ? AND survey = ?',
+        ('DOE', 'kilnaboy')).fetchall()
+    assert 'memorials_surname' in str(plan)
+
+
+def test_parquet_export(store, tmp_path):
+    parquet = pytest.importorskip('pyarrow.parquet')
+    path = str(tmp_path / 'records.parquet')
+    assert store.export_parquet(path) == 3
+    assert parquet.read_table(path).column('surname').to_pylist().count('DOE') == 2
+
+
+def test_search_ranks_inscription_matches(store, tmp_path):
+    transcript = str(tmp_path / 'more')
+    write_batches(transcript, [[{'memorial_number': 2, 'inscription': 'ERECTED BY THEIR FOND SON'},
+                                {'memorial_number': 3, 'inscription': 'IN LOVING MEMORY OF JOHN DOE LISNAGROOBE'}]])
+    store.load_folder(transcript, 'transcript', 'kilnaboy', workers=1)
+
+    assert sorted(r['memorial_number'] for r in store.search('loving memory')) == [1, 3]
+    # Updated rows are re-indexed: memorial 2 gained its inscription in this load
+    assert [r['memorial_number'] for r in store.search('"fond son"')] == [2]
+    assert [r['memorial_number'] for r in store.search('lisnag*', survey='kilnaboy')] == [3]
+    assert store.search('lisnag*', survey='elsewhere') == []
+    # Matches in the inscription rank above matches in the name
+    assert [r['memorial_number'] for r in store.search('doe')][0] == 3
+    assert '[LISNAGROOBE]' in store.search('lisnagroobe')[0]['snippet']
+
+
+def test_repeated_memorial_numbers_in_one_load(tmp_path):
+    # The same memorial in two batch files, which land in one transaction
+    folder = str(tmp_path / 'kilnaboy')
+    write_batches(folder, [[{'memorial_number': 7, 'name': 'John Doe', 'date': None, 'location': None}],
+                           [{'memorial_number': 7, 'name': None, 'date': '1900', 'location': 'Ennis'}]])
+    store = record_store.RecordStore(str(tmp_path / 'records.sqlite'))
+    try:
+        assert store.load_folder(folder, 'ndl', workers=1) == 2
+        assert store.load([{'memorial_number': 5, 'inscription': 'REST IN PEACE'},
+                           {'memorial_number': 5, 'name': 'Mary Doe'}], 'kilnaboy') == 2
+        [record] = store.find(memorial_number=7)
+        assert (record['name'], record['date'], record['location']) == ('John Doe', '1900', 'Ennis')
+        assert [r['memorial_number'] for r in store.search('peace')] == [5]
+        assert sorted(r['memorial_number'] for r in store.search('doe')) == [5, 7]
+        # Raises if the index no longer matches the table
+        store.conn.execute("INSERT INTO memorials_fts (memorials_fts) VALUES ('integrity-check')")
+    finally:
+        store.close()
+
+
+def test_quoted_and_unquoted_numbers_are_one_memorial(tmp_path):
+    store = record_store.RecordStore(str(tmp_path / 'records.sqlite'))
+    try:
+        assert store.load([{'memorial_number': '69', 'name': 'Ann Roe'},
+                           {'memorial_number': 69, 'inscription': 'ANN ROE'}], 'kilnaboy') == 2
+        [record] = store.find(memorial_number=69)
+        assert (record['name'], record['inscription']) == ('Ann Roe', 'ANN ROE')
+        assert [r['memorial_number'] for r in store.search('roe')] == [69]
+    finally:
+        store.close()
+
+
+def test_memorial_numbers_that_are_not_integers_are_kept(tmp_path):
+    ndl = str(tmp_path / 'ndl')
+    write_batches(ndl, [[{'memorial_number': '12A', 'name': 'John Doe', 'date': None, 'location': None}]])
+    transcript = str(tmp_path / 'transcript')
+    write_batches(transcript, [[{'memorial_number': '12A', 'inscription': 'IN LOVING MEMORY'},
+                                {'memorial_number': '12B', 'inscription': 'REST IN PEACE'},
+                                {'memorial_number': 'unknown', 'inscription': 'ERECTED BY'},
+                                {'memorial_number': '', 'inscription': 'HIS WIFE'}]])
+    store = record_store.RecordStore(str(tmp_path / 'records.sqlite'))
+    try:
+        store.load_folder(ndl, 'ndl', 'kilnaboy', workers=1)
+        store.load_folder(transcript, 'transcript', 'kilnaboy', workers=1)
+        [record] = store.find(memorial_number='12A')
+        assert (record['name'], record['inscription']) == ('John Doe', 'IN LOVING MEMORY')
+        # Nothing is folded together or lost
+        records = store.find(survey='kilnaboy')
+        assert sorted(r['inscription'] for r in records) == [
+            'ERECTED BY', 'HIS WIFE', 'IN LOVING MEMORY', 'REST IN PEACE']
+        assert [r['memorial_number'] for r in records].count(None) == 2
+    finally:
+        store.close()
@@ -0,0 +1,76 @@
+import json
+import time
+
+import pytest
+
+import response_cache
+import vision_common
+import vision_transcript
+
+
+@pytest.fixture
+def cache(tmp_path):
+    cache = response_cache.ResponseCache(str(tmp_path / 'cache.sqlite'))
+    yield cache
+    cache.close()
+
+
+@pytest.fixture
+def images(tmp_path):
+    paths = []
+    for i in range(2):
+        path = tmp_path / f'page_{i + 1}.jpg'
+        path.write_bytes(b'jpeg bytes %d' % i)
+        paths.append(str(path))
+    return paths
+
+
+def test_key_depends_on_request(cache, images):
+    key, hashes = cache.key_for(images, 'prompt', 'model', 1500)
+    assert cache.key_for(images, 'prompt', 'model', 1500)[0] == key
+    assert cache.key_for(images, 'other prompt', 'model', 1500)[0] != key
+    assert cache.key_for(images, 'prompt', 'model', 1000)[0] != key
+    assert cache.key_for(images[::-1], 'prompt', 'model', 1500)[0] != key
+    assert len(hashes) == 2
+
+
+def test_put_get_and_iter_by_prompt(cache, images):
+    key, hashes = cache.key_for(images, 'ndl prompt', 'model', 1500)
+    assert cache.get(key) is None
+    cache.put(key, hashes, 'ndl prompt', 'model', 1500, {'choices': []})
+    assert cache.get(key) == {'choices': []}
+
+    assert [k for k, _ in cache.iter_responses('ndl prompt')] == [key]
+    assert list(cache.iter_responses('transcript prompt')) == []
+
+
+def test_evict_by_age_and_size(cache):
+    for i in range(4):
+        cache.put(f'key{i}', [], 'prompt', 'model', 1500, {'n': 'x' * 100})
+    cache.conn.execute("UPDATE responses SET created_at = 0 WHERE key = 'key0'")
+    assert cache.evict(max_age=3600) == 1
+
+    # Touching key1 makes key2 the least recently used entry
+    time.sleep(0.01)
+    cache.get('key1')
+    size = cache.stats()['bytes'] // 3
+    assert cache.evict(max_bytes=2 * size) == 1
+    assert cache.get('key2') is None
+    assert cache.get('key1') is not None
+
+
+def test_cache_hit_skips_network(cache, images, tmp_path, monkeypatch):
+    response = {'choices': [{'message': {'content': '[]'}}]}
+    key, hashes = cache.key_for(images, vision_common.TRANSCRIPT_PROMPT,
+                                vision_common.MODEL, vision_common.MAX_TOKENS)
+    cache.put(key, hashes, vision_common.TRANSCRIPT_PROMPT,
+              vision_common.MODEL, vision_common.MAX_TOKENS, response)
+
+    def no_network(*args, **kwargs):
+        raise AssertionError("request sent despite cache hit")
+
+    monkeypatch.setattr(vision_transcript.requests, 'post', no_network)
+    result = vision_transcript.process_images(images, 'key', str(tmp_path), 7, cache)
+    assert result == response
+    with open(tmp_path / 'output_batch_7.json') as f:
+        assert json.load(f) == response
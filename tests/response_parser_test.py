@@ -0,0 +1,56 @@
+import json
+
+import pytest
+
+import mock_openai
+import response_parser
+from response_parser import parse_content
+
+
+def test_parses_fenced_json():
+    records = [{'memorial_number': 1, 'inscription': 'R.I.P.\nERECTED BY "HIS SON"'}]
+    assert parse_content('```json\n' + json.dumps(records) + '\n```') == records
+
+
+def test_tolerates_prompt_example_layout():
+    # The layout the prompt's own example asks for
+    content = '{memorial_number: 69, name: John Doe, date: Jan 1, 1800, location: Springfield}'
+    assert parse_content(content) == {'memorial_number': 69, 'name': 'John Doe',
+                                      'date': 'Jan 1, 1800', 'location': 'Springfield'}
+
+
+def test_tolerates_null_and_loose_objects():
+    content = ('Here are the records:\n{"memorial_number": NULL, "inscription": "line one\n'
+               'line two",}\n{memorial_number: 2.5, inscription: None}')
+    assert parse_content(content) == [
+        {'memorial_number': None, 'inscription': 'line one\nline two'},
+        {'memorial_number': 2.5, 'inscription': None}]
+
+
+def test_skips_brackets_in_prose_before_the_records():
+    content = 'memorial 12 [page 1]: {memorial_number: 12, name: X}'
+    assert parse_content(content) == {'memorial_number': 12, 'name': 'X'}
+
+
+def test_bare_values_keep_brackets_and_numbers_as_text():
+    content = ('[{memorial_number: 3, inscription: IN MEMORY OF [illegible] DOE, date: 1900},\n'
+               ' {memorial_number: 4, inscription: [illegible] ROSE, location: NULL}]')
+    assert parse_content(content) == [
+        {'memorial_number': 3, 'inscription': 'IN MEMORY OF [illegible] DOE', 'date': '1900'},
+        {'memorial_number': 4, 'inscription': '[illegible] ROSE', 'location': None}]
+
+
+@pytest.mark.parametrize('content', ["I can't read these images.", '```json\n[{"a": 1},'])
+def test_raises_decode_error_without_json(content):
+    with pytest.raises(json.JSONDecodeError):
+        parse_content(content)
+
+
+def test_mock_replies():
+    records = [mock_openai.make_record('inscription', n) for n in (1, 2)]
+    for style in (None, 'unquoted'):
+        content, _ = mock_openai.render_content(records, style)
+        parsed = parse_content(content)
+        assert [r['memorial_number'] for r in (parsed if isinstance(parsed, list) else [parsed])] == [1, 2]
+    with pytest.raises(response_parser.ParseError):
+        parse_content(mock_openai.render_content(records, 'truncated')[0])
@@ -0,0 +1,76 @@
+import os
+import json
+
+import pytest
+
+import benchmark
+import json2csv_ndl
+import mock_openai
+import rate_limiter
+import scheduler
+import vision_common
+from batch_planner import BatchPlanner
+
+
+class FakeJob:
+    def __init__(self, name, weight, pages):
+        self.name = name
+        self.weight = weight
+        self.queue = list(range(pages))
+        self.virtual_time = 0.0
+
+
+def dispatch(share, jobs, count):
+    order = []
+    for _ in range(count):
+        job = share.pick(jobs)
+        job.queue.pop()
+        share.charge(job, 100)
+        order.append(job.name)
+    return order
+
+
+def test_dispatch_follows_weights_and_late_jobs_dont_starve_others():
+    share = scheduler.FairShare()
+    heavy, light = FakeJob('heavy', 3, 100), FakeJob('light', 1, 100)
+    order = dispatch(share, [heavy, light], 40)
+    assert (order.count('heavy'), order.count('light')) == (30, 10)
+
+    # A job joining late gets its share from now on, not a backlog to catch up
+    late = FakeJob('late', 1, 100)
+    order = dispatch(share, [heavy, light, late], 50)
+    assert (order.count('heavy'), order.count('light'), order.count('late')) == (30, 10, 10)
+
+
+def test_jobs_share_one_run(tmp_path, monkeypatch):
+    rate_limiter.reset_limiter()
+    jobs = []
+    for name, mode, pages in (('north', 'ndl', 4), ('south', 'transcript', 2)):
+        folder = str(tmp_path / name)
+        benchmark.make_pages(folder, pages, size=(600, 800))
+        jobs.append(scheduler.Job(name, folder, str(tmp_path / f"{name}_out"), mode, weight=2 if mode == 'ndl' else 1))
+
+    with mock_openai.MockOpenAI(latency=0.02) as server:
+        monkeypatch.setattr(vision_common, 'API_URL', server.url)
+        status_path = str(tmp_path / 'status.json')
+        progress = scheduler.main(jobs, 'key', concurrency=2,
+                                  make_planner=lambda prompt: BatchPlanner(prompt, max_pages=1),
+                                  status_path=status_path)
+    rate_limiter.reset_limiter()
+
+    assert server.stats['requests'] == 6
+    assert [(p['job'], p['pages_done'], p['pages_total'], p['eta_seconds']) for p in progress] == \
+        [('north', 4, 4, 0.0), ('south', 2, 2, 0.0)]
+    assert os.path.exists(status_path)
+    records = json2csv_ndl.parse_json_file(vision_common.batch_output_path(str(tmp_path / 'north_out'), 1))
+    assert set(records[0]) == set(json2csv_ndl.FIELDNAMES)
+    assert len(os.listdir(tmp_path / 'south_out')) == 2 + 1  # two batches and the manifest
+
+
+def test_jobs_cannot_share_an_output_folder(tmp_path):
+    jobs_path = tmp_path / 'jobs.json'
+    jobs_path.write_text(json.dumps([
+        {'folder': 'kilnaboy', 'output': str(tmp_path / 'out')},
+        {'folder': 'ennis', 'output': str(tmp_path / 'sub' / '..' / 'out'), 'mode': 'transcript'}]))
+    with pytest.raises(ValueError):
+        scheduler.load_jobs(str(jobs_path))
@@ -0,0 +1,35 @@
+import base64
+import json
+
+import vision_common
+
+
+def test_streamed_body_matches_length_and_decodes(tmp_path, monkeypatch):
+    # Small chunks, so images span several of them; 10 and 11 bytes also
+    # exercise the padded final chunk
+    monkeypatch.setattr(vision_common.StreamingPayload, 'chunk_size', 6)
+    contents = [bytes(range(256)) * 3, b'\xff' * 10, b'\x00' * 11, b'']
+    paths = []
+    for i, content in enumerate(contents):
+        path = tmp_path / f'page_{i}.jpg'
+        path.write_bytes(content)
+        paths.append(str(path))
+
+    payload = vision_common.StreamingPayload(paths, 'Read "this"\n', 'gpt-test', 99)
+    body = payload.to_bytes()
+    assert len(body) == len(payload)
+    # Iterating again, as a retry does, gives the same body
+    assert b''.join(payload) == body
+
+    data = json.loads(body)
+    assert (data['model'], data['max_tokens']) == ('gpt-test', 99)
+    text, *images = data['messages'][0]['content']
+    assert text == {'type': 'text', 'text': 'Read "this"\n'}
+    prefix = 'data:image/jpeg;base64,'
+    decoded = [base64.b64decode(image['image_url']['url'][len(prefix):]) for image in images]
+    assert decoded == contents
+
+    streamed = vision_common.StreamingPayload(paths, 'Read "this"\n', 'gpt-test', 99, stream=True)
+    body = streamed.to_bytes()
+    assert len(body) == len(streamed)
+    assert json.loads(body)['stream_options'] == {'include_usage': True}
@@ -0,0 +1,115 @@
+import os
+import json
+import asyncio
+
+import batch_planner
+import metrics
+import manifest as job_manifest
+import mock_openai
+import streaming
+import vision_async
+import vision_common
+from batch_planner import BatchPlanner
+
+
+def test_records_are_emitted_as_they_close():
+    stream = streaming.RecordStream()
+    reply = '```json\n[{"memorial_number": 1, "inscription": "A {brace} and a \\"quote\\""},\n' \
+            '{memorial_number: 2, name: NULL}]\n```'
+    emitted = []
+    for start in range(0, len(reply), 7):
+        emitted.append(stream.feed(reply[start:start + 7]))
+    records = [record for piece in emitted for record in piece]
+    assert records == [{'memorial_number': 1, 'inscription': 'A {brace} and a "quote"'},
+                       {'memorial_number': 2, 'name': None}]
+    # The first record came out while the second was still on its way
+    first = next(i for i, piece in enumerate(emitted) if piece)
+    assert first < len(emitted) - 3
+
+
+def test_stream_is_cut_once_the_batch_cant_fit():
+    stream = streaming.CompletionStream(max_tokens=40, pages=3)
+    events = mock_openai.stream_events({
+        'id': 'x', 'created': 0, 'model': 'm', 'usage': {},
+        'choices': [{'finish_reason': 'stop', 'message': {'content': json.dumps(
+            [{'memorial_number': n, 'name': 'John Doe', 'location': 'Springfield'} for n in (1, 2, 3)])}}]})
+    for event in events:
+        stream.feed_line('data: ' + event)
+        if stream.finished:
+            break
+    assert stream.cut and stream.records.count == 1
+    assert stream.result()['choices'][0]['finish_reason'] == 'length'
+
+
+def test_streamed_run_writes_the_sink(pages, tmp_path, mock_api):
+    mock_api(latency=0.02, token_latency=0.001)
+    output_directory = str(tmp_path / 'outputs')
+    results = vision_async.main(pages, 'key', output_directory, concurrency=2,
+                                planner=BatchPlanner(vision_common.NDL_PROMPT, max_pages=2),
+                                stream=True)
+    assert len(results) == 2 and None not in results
+    # Put back together, the reply reads the same as an unstreamed one
+    assert results[0]['usage']['completion_tokens'] > 0
+    assert results[0]['choices'][0]['finish_reason'] == 'stop'
+
+    records = streaming.read_records(str(tmp_path / 'outputs' / streaming.SINK_FILE_NAME))
+    assert sorted(record['memorial_number'] for record in records) == [1, 2, 3, 4]
+    summary = metrics.get_registry().summary()
+    assert summary['histograms']['vision_first_record_seconds']['count'] == 2
+
+    # A second run over the same folder replaces the sink rather than adding to it
+    vision_async.main(pages, 'key', output_directory, concurrency=2,
+                      planner=BatchPlanner(vision_common.NDL_PROMPT, max_pages=2), stream=True)
+    records = streaming.read_records(str(tmp_path / 'outputs' / streaming.SINK_FILE_NAME))
+    assert len(records) == 4
+
+
+def test_overflowing_batch_is_split_without_waiting(pages, tmp_path, mock_api):
+    mock_api(token_latency=0.01)
+    output_directory = str(tmp_path / 'outputs')
+    image_files = sorted(str(path) for path in (tmp_path / 'pages').glob('*.jpg'))
+    sink = streaming.RecordSink(str(tmp_path / streaming.SINK_FILE_NAME))
+    # Four records need about 125 tokens, and the planner starts out thinking
+    # they need 40
+    planner = BatchPlanner(vision_common.NDL_PROMPT, max_tokens=100,
+                           output_tokens_per_page=10, max_pages=4)
+
+    async def run():
+        async with vision_async.VisionClient('key', 'ndl', 1, max_tokens=100, stream=True) as client:
+            async def process_batch(batch, batch_number):
+                return await client.process_batch(batch, output_directory, batch_number, sink)
+            return await batch_planner.run_batches_async(
+                process_batch, image_files, planner, output_directory, 1)
+
+    os.makedirs(output_directory)
+    results = asyncio.run(run())
+    sink.close()
+
+    assert metrics.get_registry().counter_total('vision_streams_cut_total') == 1
+    # The cut batch, then its pages again in two smaller ones
+    assert [r['choices'][0]['finish_reason'] for r in results] == ['length', 'stop', 'stop']
+    assert os.path.exists(vision_common.batch_output_path(output_directory, 1) + '.truncated')
+    records = streaming.read_records(sink.path)
+    assert len(records) == 4
+    assert len(set(record['memorial_number'] for record in records)) == 4
+
+
+def test_resumed_batch_replaces_its_partial_records(pages, tmp_path, mock_api):
+    mock_api()
+    output_directory = str(tmp_path / 'outputs')
+    os.makedirs(output_directory)
+    image_files = sorted(str(path) for path in (tmp_path / 'pages').glob('*.jpg'))
+    manifest = job_manifest.JobManifest(str(tmp_path / 'outputs' / job_manifest.MANIFEST_FILE_NAME))
+    manifest.reset(image_files)
+    manifest.add_batch(1, image_files[:3])
+    # The run died with batch 1 part way through its stream
+    sink = streaming.RecordSink(os.path.join(output_directory, streaming.SINK_FILE_NAME))
+    for number in (1, 2):
+        sink.write(1, {'memorial_number': number})
+    sink.close()
+
+    vision_async.main(pages, 'key', output_directory, concurrency=1, manifest=manifest,
+                      resume=True, planner=BatchPlanner(vision_common.NDL_PROMPT, max_pages=3),
+                      stream=True)
+    records = streaming.read_records(os.path.join(output_directory, streaming.SINK_FILE_NAME))
+    assert sorted(record['memorial_number'] for record in records) == [1, 2, 3, 4]
@@ -0,0 +1,41 @@
+import json
+
+import pytest
+
+import validate_bulk
+
+
+def write_batch(folder, batch_number, content):
+    with open(folder / f'output_batch_{batch_number}.json', 'w') as f:
+        json.dump({'choices': [{'message': {'content': content}}]}, f)
+
+
+@pytest.fixture
+def batch_folder(tmp_path):
+    folder = tmp_path / 'outputs'
+    folder.mkdir()
+    good = [{'memorial_number': 1, 'name': 'John Doe', 'date': None, 'location': None}]
+    write_batch(folder, 1, '```json\n' + json.dumps(good) + '\n```')
+    bad = good + [{'memorial_number': '2', 'name': 'Jane Doe', 'date': None},
+                  {'memorial_number': 3, 'name': None, 'date': None, 'location': None}]
+    write_batch(folder, 2, json.dumps(bad))
+    write_batch(folder, 3, "I'm sorry, I can't read these images.")
+    return folder
+
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_validate_directory_reports_failures_by_record(batch_folder, tmp_path, workers):
+    report_path = tmp_path / 'report.json'
+    report = validate_bulk.validate_directory(str(batch_folder), 'ndl', workers, str(report_path))
+
+    assert (report['files'], report['valid_files'], report['invalid_files']) == (3, 1, 2)
+    assert report['records'] == 4
+    batch_2, batch_3 = report['failures']
+    assert batch_2['file'].endswith('output_batch_2.json')
+    # The second record has the wrong type and a missing field
+    assert [e['record'] for e in batch_2['errors']] == [1, 1]
+    assert batch_3['errors'][0]['record'] is None
+    assert 'JSON parsing error' in batch_3['errors'][0]['message']
+
+    with open(report_path) as f:
+        assert json.load(f) == report
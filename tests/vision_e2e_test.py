@@ -0,0 +1,88 @@
+import os
+import json
+
+import pytest
+
+import benchmark
+import json2csv_ndl
+import json2csv_trans
+import rate_limiter
+import vision_async
+import vision_common
+import vision_ndl
+import vision_transcript
+from batch_planner import BatchPlanner
+
+
+@pytest.fixture
+def output_directory(tmp_path):
+    folder = tmp_path / 'outputs'
+    folder.mkdir()
+    return str(folder)
+
+
+def read_records(output_directory):
+    records = []
+    for name in sorted(os.listdir(output_directory)):
+        if name.endswith('.json'):
+            records.extend(json2csv_ndl.parse_json_file(os.path.join(output_directory, name)))
+    return records
+
+
+def test_vision_ndl_end_to_end(pages, output_directory, mock_api):
+    server = mock_api()
+    vision_ndl.main(pages, 'key', output_directory,
+                    planner=BatchPlanner(vision_common.NDL_PROMPT, max_pages=3))
+
+    assert server.stats['requests'] == 2
+    records = read_records(output_directory)
+    assert sorted(r['memorial_number'] for r in records) == [1, 2, 3, 4]
+    assert set(records[0]) == set(json2csv_ndl.FIELDNAMES)
+
+
+def test_retries_through_429_bursts(pages, output_directory, mock_api):
+    # Every second request is refused, the limiter waits out the reset
+    server = mock_api(burst_every=2, burst_length=1, burst_reset=0.05)
+    vision_ndl.main(pages, 'key', output_directory,
+                    planner=BatchPlanner(vision_common.NDL_PROMPT, max_pages=1))
+
+    assert server.stats['rate_limited'] >= 3
+    assert len(read_records(output_directory)) == 4
+
+
+def test_transcript_records_and_malformed_content(pages, output_directory, mock_api):
+    server = mock_api(malformed_rate=1.0, seed=3)
+    data = vision_transcript.process_images(
+        [os.path.join(pages, 'page_0001.jpg')], 'key', output_directory, 1)
+
+    assert server.stats['malformed'] == 1
+    with open(vision_common.batch_output_path(output_directory, 1)) as f:
+        assert json.load(f) == data
+    # A refusal doesn't turn into records
+    assert json2csv_ndl.parse_json_file(vision_common.batch_output_path(output_directory, 1)) == []
+
+
+def test_benchmark_reports_throughput(pages, tmp_path):
+    rate_limiter.reset_limiter()
+    result = benchmark.benchmark('vision_async', pages, str(tmp_path), {'latency': 0.05}, 4)
+
+    assert result['outputs'] == result['batches'] >= 1
+    assert result['images_per_second'] > 0
+    assert result['p50_latency'] <= result['p95_latency']
+    assert benchmark.find_regressions([result], [dict(result, images_per_second=1e9)], 0.1)
+
+
+def test_combined_mode_feeds_both_converters(pages, output_directory, mock_api):
+    server = mock_api()
+    vision_async.main(pages, 'key', output_directory, 'combined', concurrency=2,
+                      planner=BatchPlanner(vision_common.COMBINED_PROMPT, max_pages=2))
+
+    # Each page went up once, for both extractions
+    assert (server.stats['requests'], server.stats['images']) == (2, 4)
+    ndl = read_records(os.path.join(output_directory, 'ndl'))
+    assert sorted(r['memorial_number'] for r in ndl) == [1, 2, 3, 4]
+    assert set(ndl[0]) == set(json2csv_ndl.FIELDNAMES)
+    transcript = json2csv_trans.parse_json_file(
+        vision_common.batch_output_path(os.path.join(output_directory, 'transcript'), 1))
+    assert set(transcript[0]) == set(json2csv_trans.FIELDNAMES)
+    assert transcript[0]['inscription'].startswith('IN LOVING MEMORY')
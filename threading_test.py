@@ -1,107 +1,86 @@
 import os
 import json
-import base64
 import requests
 import sys
 import csv
 import glob
 import logging
 from tqdm import tqdm
+import vision_common
+import rate_limiter
+import hedging
+import batch_planner
+import metrics
+import log_setup
 from concurrent.futures import ThreadPoolExecutor
 import time
 
-# Configure logging
-logging.basicConfig(filename='vision_ndl.log', level=logging.DEBUG,
-                    format='%(asctime)s %(levelname)s:%(message)s')
 
-
-def encode_image(image_path):
-    try:
-        with open(image_path, "rb") as image_file:
-            logging.info(f"Encoding image: {image_path}")
-            return base64.b64encode(image_file.read()).decode('utf-8')
-    except FileNotFoundError:
-        logging.error(f"File not found: {image_path}")
-        sys.exit(1)
-    except Exception as e:
-        logging.error(f"Error encoding image {image_path}: {e}")
-        sys.exit(1)
-
-
-def send_request_with_retry(payload, headers, max_retries=5):
+def send_request_with_retry(payload, headers, max_retries=5, tokens=None, stats=None):
+    # Without an estimate, count at least the output allowance against the limit
+    tokens = tokens or payload.max_tokens
+    limiter = rate_limiter.get_limiter()
+    upload_bytes = len(payload)
     retry_delay = 1  # Initial delay of 1 second
     for attempt in range(max_retries):
+        if stats is not None:
+            stats['retries'] = attempt
+        limiter.acquire(tokens)
+        response = hedging.get_hedger().run(
+            lambda: vision_common.post_request(payload, headers, tokens, upload_bytes), tokens,
+            accept=lambda response: response.ok)
         try:
-            response = requests.post("https://api.openai.com/v1/chat/completions",
-                                     headers=headers, json=payload)
             response.raise_for_status()
 
             # Log rate limit info
-            logging.info(f"Rate Limit Info: {response.headers}")
+            logging.debug("Rate limit info: %s", response.headers)
 
             return response
         except requests.exceptions.HTTPError as err:
             if err.response.status_code == 429:
                 # Extract rate limit information from response headers
-                rate_limit_requests = err.response.headers.get(
-                    'x-ratelimit-limit-requests')
                 remaining_requests = err.response.headers.get(
                     'x-ratelimit-remaining-requests')
                 rate_limit_reset_requests = err.response.headers.get(
                     'x-ratelimit-reset-requests')
-                rate_limit_tokens = err.response.headers.get(
-                    'x-ratelimit-limit-tokens')
                 remaining_tokens = err.response.headers.get(
                     'x-ratelimit-remaining-tokens')
                 rate_limit_reset_tokens = err.response.headers.get(
                     'x-ratelimit-reset-tokens')
 
                 logging.warning(
-                    f"Rate limited. Requests remaining: {remaining_requests}, Reset in: {rate_limit_reset_requests}")
+                    "Rate limited. Requests remaining: %s, Reset in: %s",
+                    remaining_requests, rate_limit_reset_requests)
                 logging.warning(
-                    f"Rate limited. Tokens remaining: {remaining_tokens}, Reset in: {rate_limit_reset_tokens}")
-                time.sleep(retry_delay)
-                retry_delay *= 2  # Exponential backoff
+                    "Rate limited. Tokens remaining: %s, Reset in: %s",
+                    remaining_tokens, rate_limit_reset_tokens)
+                if not rate_limiter.is_exhausted(err.response.headers, tokens):
+                    # The limiter can't tell how long to wait, so back off
+                    time.sleep(retry_delay)
+                    retry_delay *= 2  # Exponential backoff
             else:
                 raise
     raise Exception("Max retries reached")
 
 
 def process_images(image_paths, api_key, output_directory, batch_number):
-    logging.info(f"Processing images in batch {batch_number}")
+    logging.debug("Processing images in batch %s", batch_number)
+    started = time.monotonic()
     headers = {
         "Content-Type": "application/json",
         "Authorization": f"Bearer {api_key}"
     }
 
-    messages = [
-        {
-            "role": "user",
-            "content": [
-                {
-                    "type": "text",
-                    "text": "You're an expert in OCR and are working in a heritage/genealogy context assisting in data processing post graveyard survey.Examine these images and extract the names,dates and suspected location names for each memorial number-no other fields..Respond in JSON format only.e.g {memorial_number: 69, name: John Doe, date: Jan 1, 1800, location: Springfield}. If no memorial number,name, date or location is visible in an image,return a json with NULL in each field"
-                }
-            ]
-        }
-    ]
-
-    for image_path in image_paths:
-        base64_image = encode_image(image_path)
-        messages[0]["content"].append({
-            "type": "image_url",
-            "image_url": {"url": f"data:image/jpeg;base64,{base64_image}"}
-        })
-
-    payload = {
-        "model": "gpt-4-vision-preview",
-        "messages": messages,
-        "max_tokens": 1500  # Adjust based on requirements and token limits
-    }
-
-    logging.info("Sending request to OpenAI...")
+    logging.debug("Sending request to OpenAI...")
+    stats = {'retries': 0}
     try:
-        response = send_request_with_retry(payload, headers)
+        # Only the file sizes are read here; the images themselves are
+        # streamed from disk into the request body as it is sent
+        payload = vision_common.StreamingPayload(
+            image_paths, vision_common.NDL_PROMPT, vision_common.MODEL, vision_common.MAX_TOKENS)
+        tokens = vision_common.estimate_request_tokens(
+            image_paths, vision_common.NDL_PROMPT, payload.max_tokens)
+        response = send_request_with_retry(payload, headers, tokens=tokens, stats=stats)
 
         # Extract and log rate limit information from response headers
         rate_limit_requests = response.headers.get(
@@ -115,28 +94,34 @@ def process_images(image_paths, api_key, output_directory, batch_number):
         rate_limit_reset_tokens = response.headers.get(
             'x-ratelimit-reset-tokens')
 
-        logging.info(
-            f"Rate Limit (Requests): {rate_limit_requests}, Remaining: {remaining_requests}, Reset in: {rate_limit_reset_requests}")
-        logging.info(
-            f"Rate Limit (Tokens): {rate_limit_tokens}, Remaining: {remaining_tokens}, Reset in: {rate_limit_reset_tokens}")
+        logging.debug(
+            "Rate Limit (Requests): %s, Remaining: %s, Reset in: %s",
+            rate_limit_requests, remaining_requests, rate_limit_reset_requests)
+        logging.debug(
+            "Rate Limit (Tokens): %s, Remaining: %s, Reset in: %s",
+            rate_limit_tokens, remaining_tokens, rate_limit_reset_tokens)
 
-        logging.info("Received response from OpenAI, writing to file...")
+        logging.debug("Received response from OpenAI, writing to file...")
         output_file_name = f"output_batch_{batch_number}.json"
         output_path = os.path.join(output_directory, output_file_name)
 
+        data = response.json()
         with open(output_path, "w") as json_file:
-            json.dump(response.json(), json_file, indent=4)
+            json.dump(data, json_file, indent=4)
 
-        logging.info(f"Output saved to {output_path}")
-        return response.json()
+        logging.debug("Output saved to %s", output_path)
+        log_setup.log_batch(batch_number, image_paths, started, data, stats['retries'])
+        return data
 
     except Exception as e:
         logging.error(f"Error during API request: {e}")
+    log_setup.log_batch(batch_number, image_paths, started, None, stats['retries'])
 
 
 def process_batch(batch_data):
     image_paths, api_key, output_directory, batch_number = batch_data
-    process_images(image_paths, api_key, output_directory, batch_number)
+    with metrics.in_flight():
+        process_images(image_paths, api_key, output_directory, batch_number)
 
 
 def main(folder_path, api_key, output_directory):
@@ -144,16 +129,21 @@ def main(folder_path, api_key, output_directory):
     image_files = glob.glob(os.path.join(folder_path, '*.jpg'))
     image_files.sort()
 
-    # Adaptive batch size based on token limit
+    # Batch size based on each page's estimated token cost
     token_limit_per_request = 4000
     token_rate_limit_per_minute = 10000
-    max_batch_size = token_rate_limit_per_minute // token_limit_per_request
+    planner = batch_planner.BatchPlanner(
+        vision_common.NDL_PROMPT, token_budget=token_limit_per_request)
+
+    # Until the first response reports the real limits, hold requests to this rate
+    rate_limiter.get_limiter().configure(
+        tokens_per_minute=token_rate_limit_per_minute)
 
     # Limit the number of concurrent threads
     thread_pool_size = 2  # Adjust based on rate limits
 
-    batches = [(image_files[i:i + max_batch_size], api_key, output_directory, i // max_batch_size + 1)
-               for i in range(0, len(image_files), max_batch_size)]
+    batches = [(batch, api_key, output_directory, batch_number)
+               for batch_number, batch in enumerate(planner.plan(image_files), start=1)]
 
     total_batches = len(batches)
 
@@ -163,6 +153,10 @@ def main(folder_path, api_key, output_directory):
 
 
 if __name__ == "__main__":
+    # LOG_LEVEL=DEBUG brings back per-image and header detail, LOG_FORMAT=json
+    # writes compact JSON lines
+    log_setup.configure('vision_ndl.log', os.getenv('LOG_LEVEL', 'INFO'),
+                        os.getenv('LOG_FORMAT', 'text'))
     logging.info("Script started")
     if len(sys.argv) != 2:
         logging.error("Usage: python script.py <path_to_folder>")
@@ -178,6 +172,7 @@ if __name__ == "__main__":
     output_directory = "/Users/danieltierney/Desktop/WebDev/openai-playground/HG_TextHarvest_v1/test_folder/json_outputs"
     logging.info("Starting the image processing script...")
     main(folder_path, api_key, output_directory)
+    metrics.write_summary(os.path.join(output_directory, metrics.SUMMARY_FILE_NAME), mode='ndl')
     logging.info("Script finished")
 
 # To run this script, type 'python3 vision_ndl.py PATH/TO/INPUT/FOLDER' in the terminal
@@ -0,0 +1,121 @@
+import os
+import sys
+import json
+import glob
+import time
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+from jsonschema.validators import validator_for
+
+import response_parser
+import validate_ndl
+import validate_transcript
+
+SCHEMAS = {
+    'ndl': validate_ndl.schema,
+    'transcript': validate_transcript.schema,
+}
+# A combined response carries every field of both
+SCHEMAS['combined'] = {
+    'type': 'array',
+    'items': {
+        'type': 'object',
+        'properties': dict(validate_ndl.schema['items']['properties'],
+                           **validate_transcript.schema['items']['properties']),
+        'required': list(dict.fromkeys(validate_ndl.schema['items']['required'] +
+                                       validate_transcript.schema['items']['required'])),
+    },
+}
+
+# Compiled once per worker process by init_worker
+_validator = None
+
+
+def init_worker(mode):
+    global _validator
+    schema = SCHEMAS[mode]
+    cls = validator_for(schema)
+    cls.check_schema(schema)
+    _validator = cls(schema)
+
+
+def read_records(file_path):
+    with open(file_path, 'r') as file:
+        data = json.load(file)
+    return response_parser.parse_response(data)
+
+
+def validate_file(file_path):
+    # Returns the file's record count and every error found, each tied to
+    # the index of the record it came from where there is one
+    try:
+        records = read_records(file_path)
+    except (KeyError, IndexError, TypeError) as e:
+        return {'file': file_path, 'records': 0,
+                'errors': [{'record': None, 'path': [], 'message': f"Not a chat completion: {e!r}"}]}
+    except json.JSONDecodeError as e:
+        return {'file': file_path, 'records': 0,
+                'errors': [{'record': None, 'path': [], 'message': f"JSON parsing error: {e}"}]}
+
+    errors = []
+    for error in _validator.iter_errors(records):
+        path = list(error.absolute_path)
+        errors.append({'record': path[0] if path and isinstance(records, list) else None,
+                       'path': path[1:] if isinstance(records, list) else path,
+                       'message': error.message})
+    errors.sort(key=lambda e: (e['record'] is None, e['record'] or 0))
+    count = len(records) if isinstance(records, list) else 1
+    return {'file': file_path, 'records': count, 'errors': errors}
+
+
+def validate_files(json_files, mode, workers=None):
+    if workers == 1:
+        init_worker(mode)
+        return [validate_file(json_file) for json_file in json_files]
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker,
+                             initargs=(mode,)) as executor:
+        # Files are small, so hand them out in chunks to keep the pool busy
+        chunksize = max(1, len(json_files) // (4 * executor._max_workers))
+        return list(executor.map(validate_file, json_files, chunksize=chunksize))
+
+
+def validate_directory(folder_path, mode, workers=None, report_path=None):
+    start = time.perf_counter()
+    json_files = sorted(glob.glob(os.path.join(folder_path, '*.json')))
+    results = validate_files(json_files, mode, workers)
+    failures = [result for result in results if result['errors']]
+    report = {
+        'folder': folder_path,
+        'mode': mode,
+        'files': len(results),
+        'valid_files': len(results) - len(failures),
+        'invalid_files': len(failures),
+        'records': sum(result['records'] for result in results),
+        'failures': failures,
+    }
+    if report_path:
+        with open(report_path, 'w') as report_file:
+            json.dump(report, report_file, indent=4)
+    elapsed = time.perf_counter() - start
+    print(f"Validated {len(results)} files ({report['records']} records) in {elapsed:.1f}s: "
+          f"{report['invalid_files']} invalid")
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Validate every output_batch_*.json in a folder against its schema")
+    parser.add_argument("folder_path")
+    parser.add_argument("--mode", choices=sorted(SCHEMAS), default="ndl")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="validation processes, defaults to the number of cores")
+    parser.add_argument("--report", default="validation_report.json",
+                        help="where to write the failures by file and record index")
+    args = parser.parse_args()
+
+    report = validate_directory(args.folder_path, args.mode, args.workers, args.report)
+    for failure in report['failures']:
+        for error in failure['errors']:
+            print(f"{failure['file']} record {error['record']}: {error['message']}")
+    sys.exit(1 if report['invalid_files'] else 0)
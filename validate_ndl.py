@@ -1,6 +1,8 @@
 import json
 from jsonschema import validate, ValidationError
 
+import response_parser
+
 # Define the schema
 schema = {
     "type": "array",
@@ -23,11 +25,7 @@ def validate_json(file_path):
     try:
         with open(file_path, 'r') as file:
             data = json.load(file)
-            content = data['choices'][0]['message']['content']
-            # Remove markdown code block syntax if present
-            content = content.replace(
-                '```json\n', '').replace('\n```', '').strip()
-            records = json.loads(content)
+            records = response_parser.parse_response(data)
             validate(instance=records, schema=schema)
             print(f"JSON file {file_path} is valid according to the schema.")
     except ValidationError as e:
@@ -41,8 +39,9 @@ def validate_json(file_path):
         print(f"Unexpected error occurred in file {file_path}: {e}")
 
 
-# Path to the JSON file
-file_path = 'PATH_TO_YOUR_JSON_FILE'
+if __name__ == "__main__":
+    # Path to the JSON file
+    file_path = 'PATH_TO_YOUR_JSON_FILE'
 
-# Call the validation function
-validate_json(file_path)
+    # Call the validation function
+    validate_json(file_path)
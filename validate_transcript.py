@@ -2,6 +2,8 @@ import json
 from jsonschema import validate
 from jsonschema.exceptions import ValidationError
 
+import response_parser
+
 # Define the JSON schema
 schema = {
     "type": "array",
@@ -31,9 +33,7 @@ def validate_json(json_data, schema):
 def extract_json_content(file_data):
     try:
         # Extract the JSON array from the nested structure
-        content = file_data['choices'][0]['message']['content']
-        content = content.replace('```json\n', '').replace('\n```', '').strip()
-        return json.loads(content)
+        return response_parser.parse_response(file_data)
     except (KeyError, json.JSONDecodeError) as e:
         print(f"Error extracting JSON content: {e}")
         return None
@@ -0,0 +1,325 @@
+import os
+import sys
+import glob
+import time
+import asyncio
+import logging
+import argparse
+
+import aiohttp
+
+import vision_common
+import rate_limiter
+import response_cache
+import manifest as job_manifest
+import preprocess
+import batch_planner
+import metrics
+import hedging
+import streaming
+import log_setup
+import page_classifier
+import dedup
+
+
+async def stream_body(payload):
+    # Encoding a chunk touches the disk, so each one is made on the default
+    # executor and the event loop only forwards it to the socket
+    loop = asyncio.get_running_loop()
+    chunks = iter(payload)
+    while True:
+        chunk = await loop.run_in_executor(None, next, chunks, None)
+        if chunk is None:
+            return
+        yield chunk
+
+
+class VisionClient:
+    # Runs many batches at once over one pooled keep-alive HTTP session.
+    # The caller caps batches in flight, and concurrency sizes the
+    # connection pool to match. Request bodies are streamed from
+    # the image files, so each batch in flight holds about one chunk. With
+    # stream=True replies are streamed back too, and records are handed to
+    # a sink as they are parsed.
+
+    def __init__(self, api_key, mode='ndl', concurrency=8, max_retries=5,
+                 model=vision_common.MODEL, max_tokens=vision_common.MAX_TOKENS,
+                 cache=None, preprocessor=None, stream=False):
+        self.api_key = api_key
+        self.mode = mode
+        self.prompt = vision_common.PROMPTS[mode]
+        self.concurrency = concurrency
+        self.max_retries = max_retries
+        self.model = model
+        self.max_tokens = max_tokens
+        self.cache = cache
+        self.preprocessor = preprocessor
+        self.stream = stream
+        self.session = None
+
+    async def __aenter__(self):
+        hedger = hedging.get_hedger()
+        # A hedge is sent while its batch still holds a connection, so it
+        # needs room in the pool beyond the batches in flight
+        connector = aiohttp.TCPConnector(
+            limit=self.concurrency * 2 if hedger.hedge else self.concurrency)
+        timeout = aiohttp.ClientTimeout(sock_connect=hedger.connect_timeout,
+                                        sock_read=hedger.read_timeout)
+        self.session = aiohttp.ClientSession(connector=connector, timeout=timeout, headers={
+            "Authorization": f"Bearer {self.api_key}"
+        })
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.session.close()
+
+    async def post(self, payload, tokens, upload_bytes, read_stream=None):
+        # One attempt, already admitted by the rate limiter. Returns the
+        # status, the headers and, unless rate limited, the response body,
+        # read by read_stream(response) for a streamed reply.
+        limiter = rate_limiter.get_limiter()
+        released = False
+        sent = time.monotonic()
+        try:
+            async with self.session.post(
+                    vision_common.API_URL, data=stream_body(payload),
+                    headers={'Content-Type': 'application/json',
+                             'Content-Length': str(upload_bytes)}) as response:
+                limiter.release(tokens, response.headers)
+                released = True
+                metrics.record_request(response.status, time.monotonic() - sent, upload_bytes)
+                if response.status == 429:
+                    return response.status, response.headers, None
+                response.raise_for_status()
+                if read_stream is not None:
+                    return response.status, response.headers, await read_stream(response)
+                return response.status, response.headers, await response.json()
+        finally:
+            # Also reached when a hedged request is cancelled
+            if not released:
+                limiter.release(tokens)
+                metrics.record_request(None, time.monotonic() - sent, upload_bytes)
+
+    async def send_request_with_retry(self, payload, tokens, stats=None, read_stream=None):
+        limiter = rate_limiter.get_limiter()
+        hedger = hedging.get_hedger()
+        upload_bytes = len(payload)
+        retry_delay = 1  # Initial delay of 1 second
+        for attempt in range(self.max_retries):
+            if stats is not None:
+                stats['retries'] = attempt
+            await limiter.acquire_async(tokens)
+            if read_stream is None:
+                status, headers, data = await hedger.run_async(
+                    lambda: self.post(payload, tokens, upload_bytes), tokens,
+                    accept=lambda result: 200 <= result[0] < 300)
+            else:
+                # A streamed reply hands out records as it goes, so two
+                # copies of it can't race; a stalled stream hits the read
+                # timeout instead
+                status, headers, data = await self.post(payload, tokens, upload_bytes,
+                                                        read_stream)
+            if status != 429:
+                return data
+            logging.warning(
+                "Rate limited. Requests remaining: %s, Reset in: %s",
+                headers.get('x-ratelimit-remaining-requests'),
+                headers.get('x-ratelimit-reset-requests'))
+            logging.warning(
+                "Rate limited. Tokens remaining: %s, Reset in: %s",
+                headers.get('x-ratelimit-remaining-tokens'),
+                headers.get('x-ratelimit-reset-tokens'))
+            if not rate_limiter.is_exhausted(headers, tokens):
+                # The limiter can't tell how long to wait, so back off
+                await asyncio.sleep(retry_delay)
+                retry_delay *= 2  # Exponential backoff
+        raise Exception("Max retries reached")
+
+    async def read_stream(self, response, image_paths, batch_number, started, sink=None):
+        # Records go to the sink as they complete. A batch whose records so
+        # far show it can't fit in max_tokens is cut off here, so it can be
+        # split and resent without waiting for the rest of the reply.
+        stream = streaming.CompletionStream(self.max_tokens, len(image_paths))
+        async for line in response.content:
+            for record in stream.feed_line(line):
+                if stream.records.count == 1:
+                    metrics.get_registry().observe('vision_first_record_seconds',
+                                                   time.monotonic() - started)
+                if sink is not None:
+                    sink.write(batch_number, record)
+            if stream.finished:
+                break
+        if stream.cut:
+            metrics.get_registry().inc('vision_streams_cut_total')
+            logging.info(f"Batch {batch_number} can't fit in {self.max_tokens} tokens, "
+                         f"cut off after {stream.records.count} of {len(image_paths)} pages")
+        elif stream.finish_reason is None:
+            raise Exception("Response stream ended early")
+        return stream.result()
+
+    async def process_batch(self, image_paths, output_directory, batch_number, sink=None):
+        logging.debug("Processing images in batch %s", batch_number)
+        started = time.monotonic()
+        loop = asyncio.get_running_loop()
+        if self.preprocessor is not None:
+            image_paths = await loop.run_in_executor(
+                None, self.preprocessor.prepare, image_paths, batch_number)
+        if self.cache is not None:
+            # Hashing the images reads them, so keep it off the event loop too
+            cache_key, image_hashes = await loop.run_in_executor(
+                None, self.cache.key_for, image_paths, self.prompt,
+                self.model, self.max_tokens)
+            data = self.cache.get(cache_key)
+            if data is not None:
+                output_path = vision_common.write_batch_output(
+                    data, output_directory, batch_number, self.mode)
+                logging.debug("Cache hit, output saved to %s", output_path)
+                if sink is not None:
+                    sink.write_response(batch_number, data)
+                log_setup.log_batch(batch_number, image_paths, started, data, cached=True)
+                return data
+
+        stats = {'retries': 0}
+        try:
+            # Only stats the files; the encoding happens as the body is sent
+            payload = vision_common.StreamingPayload(
+                image_paths, self.prompt, self.model, self.max_tokens, self.stream)
+            tokens = vision_common.estimate_request_tokens(
+                image_paths, self.prompt, self.max_tokens)
+            read_stream = None
+            if self.stream:
+                read_stream = lambda response: self.read_stream(
+                    response, image_paths, batch_number, started, sink)
+            data = await self.send_request_with_retry(payload, tokens, stats, read_stream)
+        except aiohttp.ClientResponseError as err:
+            logging.error(f"HTTP Error during API request: {err}")
+            data = None
+        except aiohttp.ClientError as e:
+            logging.error(f"Request Exception during API request: {e}")
+            data = None
+        except Exception as e:
+            logging.error(f"Error during API request: {e}")
+            data = None
+        if data is None:
+            if sink is not None:
+                sink.discard(batch_number, 'failed')
+            log_setup.log_batch(batch_number, image_paths, started, None, stats['retries'])
+            return None
+
+        truncated = data['choices'][0].get('finish_reason') == 'length'
+        if sink is not None and truncated and len(image_paths) > 1:
+            # The planner splits the batch and its pages come back in new ones
+            sink.discard(batch_number, 'truncated')
+        output_path = vision_common.write_batch_output(
+            data, output_directory, batch_number, self.mode)
+        # A cut-off stream isn't a reply the model finished, so it isn't kept
+        if self.cache is not None and not (self.stream and truncated):
+            self.cache.put(cache_key, image_hashes, self.prompt,
+                           self.model, self.max_tokens, data)
+
+        logging.debug("Output saved to %s", output_path)
+        log_setup.log_batch(batch_number, image_paths, started, data, stats['retries'])
+        return data
+
+
+async def run(folder_path, api_key, output_directory, mode='ndl', concurrency=8, planner=None,
+              cache=None, manifest=None, resume=False, retry_failed=False, preprocessor=None,
+              deduplicator=None, stream=False, classifier=None):
+    logging.info(f"Searching for image files in {folder_path}...")
+    image_files = glob.glob(os.path.join(folder_path, '*.jpg'))
+    image_files.sort()
+    if classifier is not None:
+        image_files = classifier.filter(image_files, mode)
+        classifier.write_report(output_directory)
+    if deduplicator is not None:
+        image_files = deduplicator.filter(image_files)
+
+    if not image_files and not (resume or retry_failed):
+        logging.error("No JPG files found in the specified directory.")
+        return []
+
+    os.makedirs(output_directory, exist_ok=True)
+    # Batches are sized from each page's estimated token cost
+    if planner is None:
+        planner = batch_planner.BatchPlanner(vision_common.PROMPTS[mode])
+
+    # Records are appended to the sink as each streamed reply is parsed
+    sink = streaming.RecordSink(os.path.join(output_directory, streaming.SINK_FILE_NAME),
+                                append=resume or retry_failed) if stream else None
+    try:
+        async with VisionClient(api_key, mode, concurrency, cache=cache,
+                                preprocessor=preprocessor, stream=stream) as client:
+            async def process_batch(batch, batch_number):
+                return await client.process_batch(batch, output_directory, batch_number, sink)
+
+            results = await batch_planner.run_batches_async(
+                process_batch, image_files, planner, output_directory, concurrency,
+                manifest, resume, retry_failed)
+    finally:
+        if sink is not None:
+            sink.close()
+
+    if manifest is not None:
+        logging.info(f"Manifest status: {manifest.counts()}")
+    if deduplicator is not None:
+        deduplicator.fan_out(output_directory, manifest)
+    if cache is not None:
+        cache.evict()
+    return results
+
+
+def main(folder_path, api_key, output_directory, mode='ndl', concurrency=8, planner=None,
+         cache=None, manifest=None, resume=False, retry_failed=False, preprocessor=None,
+         deduplicator=None, stream=False, classifier=None):
+    return asyncio.run(run(folder_path, api_key, output_directory, mode, concurrency, planner,
+                           cache, manifest, resume, retry_failed, preprocessor, deduplicator,
+                           stream, classifier))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Send batches of page images for OCR concurrently")
+    parser.add_argument("folder_path")
+    parser.add_argument("output_directory")
+    parser.add_argument("--mode", choices=sorted(vision_common.PROMPTS), default="ndl")
+    parser.add_argument("--concurrency", type=int, default=8,
+                        help="batches allowed in flight at once")
+    parser.add_argument("--stream", action="store_true",
+                        help=f"stream replies, appending records to {streaming.SINK_FILE_NAME} "
+                             "in the output folder as they are read")
+    job_manifest.add_arguments(parser)
+    response_cache.add_arguments(parser)
+    preprocess.add_arguments(parser)
+    page_classifier.add_arguments(parser)
+    dedup.add_arguments(parser)
+    batch_planner.add_arguments(parser)
+    metrics.add_arguments(parser)
+    hedging.add_arguments(parser)
+    log_setup.add_arguments(parser, 'vision_async.log')
+    args = parser.parse_args()
+    log_setup.from_args(args)
+    metrics.from_args(args)
+    hedging.from_args(args)
+
+    api_key = os.getenv('OPENAI_API_KEY')
+    if not api_key:
+        logging.error("OPENAI_API_KEY not set.")
+        sys.exit(1)
+
+    logging.info("Starting the image processing script...")
+    cache = response_cache.from_args(args)
+    preprocessor = preprocess.from_args(args)
+    os.makedirs(args.output_directory, exist_ok=True)
+    manifest = job_manifest.from_args(args, args.output_directory)
+    main(args.folder_path, api_key, args.output_directory,
+         args.mode, args.concurrency,
+         batch_planner.from_args(args, vision_common.PROMPTS[args.mode]), cache,
+         manifest, args.resume, args.retry_failed, preprocessor, dedup.from_args(args),
+         args.stream, page_classifier.from_args(args))
+    if preprocessor is not None:
+        preprocessor.close()
+    metrics.write_summary(metrics.summary_path(args, args.output_directory),
+                          mode=args.mode, concurrency=args.concurrency)
+    logging.info("Script finished")
+
+# To run this script, type 'python3 vision_async.py PATH/TO/INPUT/FOLDER PATH/TO/OUTPUT/FOLDER --mode ndl' in the terminal
@@ -0,0 +1,167 @@
+import os
+import json
+import math
+import mmap
+import time
+import glob
+import base64
+
+import requests
+from PIL import Image
+
+import response_parser
+import rate_limiter
+import metrics
+import hedging
+
+# Point OPENAI_BASE_URL at another server, e.g. mock_openai.py, for offline runs
+API_BASE_URL = os.getenv('OPENAI_BASE_URL', "https://api.openai.com/v1").rstrip('/')
+API_URL = f"{API_BASE_URL}/chat/completions"
+MODEL = "gpt-4-vision-preview"
+MAX_TOKENS = 1500  # Adjust based on requirements and token limits
+
+NDL_PROMPT = "You're an expert in OCR and are working in a heritage/genealogy context assisting in data processing post graveyard survey.Examine these images and extract the names,dates and suspected location names for each memorial number-no other fields..Respond in JSON format only.e.g {memorial_number: 69, name: John Doe, date: Jan 1, 1800, location: Springfield}. If no memorial number,name, date or location is visible in an image,return a json with NULL in each field"
+
+TRANSCRIPT_PROMPT = "You're an expert in OCR and are working in a heritage/genealogy context assisting in data processing post graveyard survey.Examine these images and extract the handwritten text from the inscription field for each memorial number-no other fields..Respond in JSON format only.e.g {memorial_number: 69, inscription: SACRED HEART OF JESUS HAVE MERCY ON THE SOUL OF THOMAS RUANE LISNAGROOBE WHO DIED APRIL 16th 1923 AGED 74 YRS AND OF HIS WIFE MARGARET RUANE DIED JULY 26th 1929 AGED 78 YEARS R. I. P .ERECTED BY THEIR FOND SON THOMAS RUANE PHILADELPHIA USA}. If no memorial number or inscription is visible in an image,return a json with NULL in each field"
+
+# Both extractions from a single upload of each page
+COMBINED_PROMPT = "You're an expert in OCR and are working in a heritage/genealogy context assisting in data processing post graveyard survey.Examine these images and for each memorial number extract the names,dates and suspected location names, and the handwritten text from the inscription field-no other fields..Respond in JSON format only.e.g {memorial_number: 69, name: John Doe, date: Jan 1, 1800, location: Springfield, inscription: SACRED HEART OF JESUS HAVE MERCY ON THE SOUL OF JOHN DOE WHO DIED JAN 1st 1800 R. I. P.}. If no memorial number,name, date, location or inscription is visible in an image,return a json with NULL in each field"
+
+# Extraction modes and the prompt sent with each of them
+PROMPTS = {
+    'ndl': NDL_PROMPT,
+    'transcript': TRANSCRIPT_PROMPT,
+    'combined': COMBINED_PROMPT,
+}
+
+# The record fields of each output layout. A combined response is written
+# as it came back, and also split into one folder per layout, so the
+# json2csv scripts read it as if the pages had been sent twice.
+LAYOUTS = {
+    'ndl': ['memorial_number', 'name', 'date', 'location'],
+    'transcript': ['memorial_number', 'inscription'],
+}
+
+
+class StreamingPayload:
+    # A chat completion request body that is produced while it is being sent.
+    # Each image is memory-mapped and base64-encoded a chunk at a time, so a
+    # batch never holds more than one chunk of encoded image in memory, and
+    # no payload dict or serialised copy of the body is built. The length is
+    # known up front, so the request still carries a Content-Length. Can be
+    # iterated again for a retry. With stream=True the reply comes back as
+    # server-sent events, ending with a usage chunk.
+
+    # A multiple of 3, so chunks encode without padding
+    chunk_size = 3 * 64 * 1024
+
+    def __init__(self, image_paths, prompt, model=MODEL, max_tokens=MAX_TOKENS, stream=False):
+        self.image_paths = list(image_paths)
+        self.max_tokens = max_tokens
+        self.sizes = [os.path.getsize(image_path) for image_path in self.image_paths]
+        options = ', "stream": true, "stream_options": {"include_usage": true}' if stream else ''
+        # json.dumps escapes to ASCII, so string length is byte length
+        self.head = ('{"model": %s, "max_tokens": %d%s, "messages": [{"role": "user", '
+                     '"content": [{"type": "text", "text": %s}'
+                     % (json.dumps(model), max_tokens, options, json.dumps(prompt))).encode('ascii')
+        self.image_head = b', {"type": "image_url", "image_url": {"url": "data:image/jpeg;base64,'
+        self.image_tail = b'"}}'
+        self.tail = b']}]}'
+
+    def __len__(self):
+        encoded = sum(4 * math.ceil(size / 3) for size in self.sizes)
+        per_image = len(self.image_head) + len(self.image_tail)
+        return len(self.head) + len(self.tail) + per_image * len(self.sizes) + encoded
+
+    def __iter__(self):
+        yield self.head
+        for image_path, size in zip(self.image_paths, self.sizes):
+            yield self.image_head
+            if size:
+                with open(image_path, 'rb') as image_file, \
+                        mmap.mmap(image_file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                    for offset in range(0, size, self.chunk_size):
+                        yield base64.b64encode(mapped[offset:offset + self.chunk_size])
+            yield self.image_tail
+        yield self.tail
+
+    def to_bytes(self):
+        # The whole body at once, for callers that need it in memory
+        return b''.join(self)
+
+
+def post_request(payload, headers, tokens, upload_bytes):
+    # One attempt, already admitted by the rate limiter
+    limiter = rate_limiter.get_limiter()
+    sent = time.monotonic()
+    try:
+        response = requests.post(API_URL, headers=headers, data=payload,
+                                 timeout=hedging.get_hedger().timeout)
+    except Exception:
+        limiter.release(tokens)
+        metrics.record_request(None, time.monotonic() - sent, upload_bytes)
+        raise
+    limiter.release(tokens, response.headers)
+    metrics.record_request(response.status_code, time.monotonic() - sent, upload_bytes)
+    return response
+
+
+def batch_files(folder_path):
+    # Only batch files match, so the manifest, reports and other files a run
+    # keeps in its output folder never reach the CSV or the record store
+    return sorted(glob.glob(os.path.join(folder_path, 'output_batch_*.json')))
+
+
+def batch_output_path(output_directory, batch_number):
+    output_file_name = f"output_batch_{batch_number}.json"
+    return os.path.join(output_directory, output_file_name)
+
+
+def write_batch_output(data, output_directory, batch_number, mode=None):
+    output_path = batch_output_path(output_directory, batch_number)
+    with open(output_path, "w") as json_file:
+        json.dump(data, json_file, indent=4)
+    if mode == 'combined':
+        for layout, fields in LAYOUTS.items():
+            layout_directory = os.path.join(output_directory, layout)
+            os.makedirs(layout_directory, exist_ok=True)
+            write_batch_output(project_output(data, fields), layout_directory, batch_number)
+    return output_path
+
+
+def project_output(data, fields):
+    # A copy of the response whose reply keeps only the given fields of each
+    # record. A reply that can't be parsed is passed on as it is, so the
+    # json2csv scripts report it the same way for every layout.
+    try:
+        records = response_parser.parse_response(data)
+    except (json.JSONDecodeError, KeyError, IndexError, TypeError):
+        return data
+    if not isinstance(records, list):
+        records = [records]
+    projected = [{field: record.get(field) for field in fields} if isinstance(record, dict) else record
+                 for record in records]
+    choice = data['choices'][0]
+    message = dict(choice['message'], content=json.dumps(projected, indent=4))
+    return dict(data, choices=[dict(choice, message=message)] + data['choices'][1:])
+
+
+def estimate_image_tokens(width, height):
+    # High-detail image cost: the image is fitted inside 2048x2048, its short
+    # side scaled down to 768, then charged 170 tokens per 512px tile plus 85
+    scale = min(1, 2048 / max(width, height))
+    width, height = width * scale, height * scale
+    scale = min(1, 768 / min(width, height))
+    width, height = width * scale, height * scale
+    tiles = math.ceil(width / 512) * math.ceil(height / 512)
+    return 85 + 170 * tiles
+
+
+def estimate_request_tokens(image_paths, prompt, max_tokens=MAX_TOKENS):
+    # Rate limits count the prompt plus the full max_tokens allowance.
+    # Opening an image only reads its header, not the pixel data.
+    tokens = len(prompt) // 4 + max_tokens
+    for image_path in image_paths:
+        with Image.open(image_path) as image:
+            tokens += estimate_image_tokens(*image.size)
+    return tokens